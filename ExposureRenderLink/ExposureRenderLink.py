@@ -1,11 +1,28 @@
 import subprocess
 import os
+import sys
 import json
+import time
+import zlib
+import struct
+import socket
+import mmap
+import tempfile
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import Queue
+import httplib
+import BaseHTTPServer
+import SocketServer
 import unittest
 import logging
+import numpy
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from TransferFunctionEditor import volumeStatisticsCache, pipelineInstrumentation
 
 #
 # ExposureRenderLink
@@ -22,7 +39,7 @@ class ExposureRenderLink(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Exposure Render Link"
     self.parent.categories = ["Examples"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["TransferFunctionEditor"]
     self.parent.contributors = ["Alexander Koehn (Fraunhofer MEVIS)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
     This module allows to control an ExposureRender instance.
@@ -93,6 +110,40 @@ class ExposureRenderLinkWidget(ScriptedLoadableModuleWidget):
     self.dataSharePathWidget.text = "F:\DemoData\Slicer"
     parametersFormLayout.addRow("Data Share Path", self.dataSharePathWidget)
 
+    self.compressionLevelWidget = qt.QSpinBox()
+    self.compressionLevelWidget.minimum = 0
+    self.compressionLevelWidget.maximum = 9
+    self.compressionLevelWidget.value = 0
+    self.compressionLevelWidget.specialValueText = "None"
+    self.compressionLevelWidget.setToolTip("zlib level for the volume written to the data share. Compression saves share bandwidth at the cost of CPU time.")
+    parametersFormLayout.addRow("Volume Compression", self.compressionLevelWidget)
+
+    # crop modes and scalar types of ExposureRenderLinkLogic.prepareExport, by combo box index
+    self.cropModes = [None, 'roi', 'opacity']
+    self.cropSelector = qt.QComboBox()
+    self.cropSelector.addItems(["Whole volume", "Volume rendering ROI", "Visible voxels"])
+    self.cropSelector.setToolTip("Part of the volume that is sent. Visible voxels are the ones with an opacity above zero.")
+    parametersFormLayout.addRow("Crop", self.cropSelector)
+
+    self.scalarTypes = [None, 'uint16', 'uint8']
+    self.scalarTypeSelector = qt.QComboBox()
+    self.scalarTypeSelector.addItems(["Original", "16 bit", "8 bit"])
+    self.scalarTypeSelector.setToolTip("Scalar type of the sent volume. 16 and 8 bit map the intensities with an opacity above zero onto that range.")
+    parametersFormLayout.addRow("Export Type", self.scalarTypeSelector)
+
+    self.filmWidthWidget = qt.QSpinBox()
+    self.filmHeightWidget = qt.QSpinBox()
+    for spinBox, value in ((self.filmWidthWidget, ExposureRenderLinkLogic.defaultFilmSize[0]),
+                           (self.filmHeightWidget, ExposureRenderLinkLogic.defaultFilmSize[1])):
+      spinBox.minimum = 16
+      spinBox.maximum = 8192
+      spinBox.value = value
+      spinBox.suffix = " px"
+    filmSizeLayout = qt.QHBoxLayout()
+    filmSizeLayout.addWidget(self.filmWidthWidget)
+    filmSizeLayout.addWidget(self.filmHeightWidget)
+    parametersFormLayout.addRow("Film Size", filmSizeLayout)
+
     #
     # Use HTTP Connection
     #
@@ -101,10 +152,26 @@ class ExposureRenderLinkWidget(ScriptedLoadableModuleWidget):
     self.useHTTPConnection.setToolTip("If checked, use HTTP connection.")
     parametersFormLayout.addRow("Use HTTP",self.useHTTPConnection)
 
+    self.useSharedMemory = qt.QCheckBox()
+    self.useSharedMemory.checked = 0
+    self.useSharedMemory.setToolTip("If checked, volume, LUT and camera are handed to ExposureRender on this computer through shared memory instead of files on the data share.")
+    parametersFormLayout.addRow("Use Shared Memory", self.useSharedMemory)
+
     self.exposureRenderHostWidget = qt.QLineEdit()
-    self.exposureRenderHostWidget.setToolTip("Enter IP:Port of ExposureRender Host")
+    self.exposureRenderHostWidget.setToolTip("Enter IP:Port of ExposureRender Host, "
+      "several comma separated hosts render one frame together")
     parametersFormLayout.addRow("Host", self.exposureRenderHostWidget)
 
+    self.previewCheckBox = qt.QCheckBox()
+    self.previewCheckBox.checked = 0
+    self.previewCheckBox.setToolTip("If checked, the volume is first sent downsampled by 8, 4 and 2 for a quick preview, then at full resolution.")
+    parametersFormLayout.addRow("Preview First", self.previewCheckBox)
+
+    self.binaryLUTCheckBox = qt.QCheckBox()
+    self.binaryLUTCheckBox.checked = 0
+    self.binaryLUTCheckBox.setToolTip("If checked, the LUT is sent as compact binary table instead of XML. The host has to support it.")
+    parametersFormLayout.addRow("Binary LUT", self.binaryLUTCheckBox)
+
     #
     # Button to send volume and start ExposureRender
     #
@@ -113,9 +180,74 @@ class ExposureRenderLinkWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.visible = False
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop the running send."
+    self.cancelButton.visible = False
+    progressLayout = qt.QHBoxLayout()
+    progressLayout.addWidget(self.progressBar)
+    progressLayout.addWidget(self.cancelButton)
+    parametersFormLayout.addRow(progressLayout)
+
+    self.statusLabel = qt.QLabel()
+    parametersFormLayout.addRow(self.statusLabel)
+
+    self.instrumentationCheckBox = qt.QCheckBox()
+    self.instrumentationCheckBox.checked = 0
+    self.instrumentationCheckBox.setToolTip("If checked, wall time, bytes and peak memory of every stage of the send and of the transfer function updates are measured and summarized below.")
+    parametersFormLayout.addRow("Instrumentation", self.instrumentationCheckBox)
+
+    self.instrumentationLabel = qt.QLabel()
+    self.instrumentationLabel.visible = False
+    parametersFormLayout.addRow(self.instrumentationLabel)
+    self.instrumentationTimer = qt.QTimer()
+    self.instrumentationTimer.setInterval(1000)
+    self.instrumentationTimer.connect('timeout()', self.onInstrumentationTimer)
+
+    #
+    # Rendered image
+    #
+    self.showFramesCheckBox = qt.QCheckBox()
+    self.showFramesCheckBox.checked = 0
+    self.showFramesCheckBox.setToolTip("If checked, the image rendered by ExposureRender is shown in the red slice view while it converges.")
+    parametersFormLayout.addRow("Show Rendered Image", self.showFramesCheckBox)
+
+    self.maxFrameRateSlider = ctk.ctkSliderWidget()
+    self.maxFrameRateSlider.decimals = 0
+    self.maxFrameRateSlider.minimum = 1
+    self.maxFrameRateSlider.maximum = 30
+    self.maxFrameRateSlider.value = 10
+    self.maxFrameRateSlider.suffix = " fps"
+    self.maxFrameRateSlider.setToolTip("Upper limit for the rendered images fetched and shown per second.")
+    parametersFormLayout.addRow("Max Frame Rate", self.maxFrameRateSlider)
+
+    self.frameReceiver = None
+    self.frameTimer = qt.QTimer()
+    self.frameTimer.connect('timeout()', self.onFrameTimer)
+
+    self.liveCameraCheckBox = qt.QCheckBox()
+    self.liveCameraCheckBox.checked = 0
+    self.liveCameraCheckBox.enabled = False
+    self.liveCameraCheckBox.setToolTip("If checked, camera changes in the 3D view are streamed to ExposureRender after a send, at a lower film resolution while interacting.")
+    parametersFormLayout.addRow("Live Camera", self.liveCameraCheckBox)
+    self.cameraSync = None
+
+    # sends run as jobs on a background thread, their progress is polled on the GUI thread
+    self.logic = ExposureRenderLinkLogic()
+    self.job = None
+    self.jobTimer = qt.QTimer()
+    self.jobTimer.setInterval(100)
+    self.jobTimer.connect('timeout()', self.onJobTimer)
+
     # connections
     self.useHTTPConnection.connect('clicked(bool)', self.onUseHTTPConnection)
     self.applyButton.connect('clicked(bool)', self.onSendButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+    self.showFramesCheckBox.connect('toggled(bool)', self.onShowFrames)
+    self.liveCameraCheckBox.connect('toggled(bool)', self.onLiveCamera)
+    self.maxFrameRateSlider.connect('valueChanged(double)', self.onMaxFrameRateChanged)
+    self.instrumentationCheckBox.connect('toggled(bool)', self.onInstrumentation)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 
     # Add vertical spacer
@@ -125,27 +257,143 @@ class ExposureRenderLinkWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.jobTimer.stop()
+    self.instrumentationTimer.stop()
+    if self.job:
+      self.job.cancel()
+    self.onShowFrames(False)
+    self.onLiveCamera(False)
 
   def onUseHTTPConnection(self):
     if self.useHTTPConnection.checked:
       self.exposureRenderPathWidget.enabled = False
       self.exposureRenderHostWidget.enabled = True
+      self.useSharedMemory.enabled = False
+      self.binaryLUTCheckBox.enabled = True
+      self.previewCheckBox.enabled = True
     else:
       self.exposureRenderPathWidget.enabled = True
       self.exposureRenderHostWidget.enabled = False
+      self.useSharedMemory.enabled = True
+      self.binaryLUTCheckBox.enabled = False
+      self.previewCheckBox.enabled = False
 
   def onSelect(self):
-    self.applyButton.enabled = self.inputSelector.currentNode()
+    self.applyButton.enabled = self.inputSelector.currentNode() and not self.job
+    self.liveCameraCheckBox.enabled = bool(self.inputSelector.currentNode() and self.inputSelector.currentNode().GetImageData())
+
+  def getFilmSize(self):
+    return (self.filmWidthWidget.value, self.filmHeightWidget.value)
+
+  def getExportOptions(self):
+    return {
+      'crop': self.cropModes[self.cropSelector.currentIndex],
+      'scalarType': self.scalarTypes[self.scalarTypeSelector.currentIndex]
+    }
 
   def onSendButton(self):
-    logic = ExposureRenderLinkLogic()
-    if self.useHTTPConnection.checked:
+    logic = self.logic
+    hosts = [host.strip() for host in self.exposureRenderHostWidget.text.split(',') if host.strip()]
+    if self.useHTTPConnection.checked and len(hosts) > 1:
+      self.job = logic.runDistributed(self.inputSelector.currentNode(), self.lutSelector.currentNode(), hosts,
+        filmSize=self.getFilmSize(), **self.getExportOptions())
+    elif self.useHTTPConnection.checked:
       exposureHost = self.exposureRenderHostWidget.text
-      logic.runHTTP(self.inputSelector.currentNode(), self.lutSelector.currentNode(), exposureHost)
+      self.job = logic.runHTTP(self.inputSelector.currentNode(), self.lutSelector.currentNode(), exposureHost,
+        binaryLUT=self.binaryLUTCheckBox.checked, filmSize=self.getFilmSize(),
+        previewLevels=3 if self.previewCheckBox.checked else 0, **self.getExportOptions())
+    elif self.useSharedMemory.checked:
+      self.job = logic.runSharedMemory(self.inputSelector.currentNode(), self.lutSelector.currentNode(),
+        self.exposureRenderPathWidget.text or None, filmSize=self.getFilmSize(), **self.getExportOptions())
     else:
       exposureExecutable = self.exposureRenderPathWidget.text
-      logic.runCLI(self.inputSelector.currentNode(),  self.lutSelector.currentNode(), exposureExecutable, self.dataSharePathWidget.text)
+      self.job = logic.runCLI(self.inputSelector.currentNode(),  self.lutSelector.currentNode(), exposureExecutable, self.dataSharePathWidget.text,
+        compressionLevel=self.compressionLevelWidget.value, filmSize=self.getFilmSize(), **self.getExportOptions())
+    if self.job:
+      self.progressBar.visible = True
+      self.cancelButton.visible = True
+      self.jobTimer.start()
+      self.onJobTimer()
+    self.onSelect()
+
+  def onLiveCamera(self, live):
+    if self.cameraSync:
+      self.cameraSync.stop()
+      self.cameraSync = None
+    if not live:
+      return
+    # the camera is normalized to the bounds of the sent volume
+    export = self.logic.prepareExport(self.inputSelector.currentNode(), self.lutSelector.currentNode(), **self.getExportOptions())
+    bounds = export['bounds']
+    if self.useHTTPConnection.checked:
+      self.cameraSync = ExposureRenderCameraSync(self.logic, bounds, host=self.exposureRenderHostWidget.text, filmSize=self.getFilmSize())
+    else:
+      self.cameraSync = ExposureRenderCameraSync(self.logic, bounds, dataSharePath=self.dataSharePathWidget.text, filmSize=self.getFilmSize())
+    self.cameraSync.start()
+
+  def onCancelButton(self):
+    if self.job:
+      self.job.cancel()
+
+  def onJobTimer(self):
+    job = self.job
+    done, total = job.progress
+    self.progressBar.maximum = 1000
+    self.progressBar.value = int(1000 * done / total) if total else 0
+    self.statusLabel.text = '%s: %s' % (job.name, job.stage or job.state)
+    if not job.finished:
+      return
+    self.jobTimer.stop()
+    self.job = None
+    self.progressBar.visible = False
+    self.cancelButton.visible = False
+    self.statusLabel.text = '%s %s (%s)' % (job.name, job.state, job.describeTimings())
+    self.onSelect()
+    if job.error:
+      slicer.util.errorDisplay('Sending to ExposureRender failed: %s' % job.error)
+    elif job.result is not None:
+      self.logic.showRenderedFrame(job.result)
+
+  def onInstrumentation(self, enabled):
+    pipelineInstrumentation.enabled = enabled
+    self.instrumentationLabel.visible = enabled
+    if enabled:
+      self.instrumentationTimer.start()
+      self.onInstrumentationTimer()
+    else:
+      self.instrumentationTimer.stop()
+
+  def onInstrumentationTimer(self):
+    self.instrumentationLabel.text = pipelineInstrumentation.formatSummary() or 'No stage measured yet'
+
+  def onShowFrames(self, show):
+    self.frameTimer.stop()
+    if self.frameReceiver:
+      self.frameReceiver.stop()
+      self.frameReceiver = None
+    if not show:
+      return
+    if self.useHTTPConnection.checked:
+      self.frameReceiver = ExposureRenderFrameReceiver(host=self.exposureRenderHostWidget.text)
+    else:
+      self.frameReceiver = ExposureRenderFrameReceiver(dataSharePath=self.dataSharePathWidget.text)
+    self.frameReceiver.start()
+    self.onMaxFrameRateChanged(self.maxFrameRateSlider.value)
+    self.frameTimer.start()
+
+  def onMaxFrameRateChanged(self, value):
+    if self.frameReceiver:
+      self.frameReceiver.maxFrameRate = value
+    self.frameTimer.setInterval(int(1000 / value))
+
+  def onFrameTimer(self):
+    # only copies the frame the receiver thread fetched, so the GUI does not wait for the renderer
+    receiver = self.frameReceiver
+    if receiver.update():
+      self.logic.showRenderedFrame(receiver.imageData)
+      self.statusLabel.text = 'Rendered image: iteration %d' % receiver.iteration
+    elif receiver.error:
+      self.statusLabel.text = 'Rendered image: %s' % receiver.error
 
 #
 # ExposureRenderLinkLogic
@@ -161,6 +409,15 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # memoized appearance tables, see getLUTEntry
+    self.lutCache = OrderedDict()
+    # volume node ID -> (stamp, pyramid levels), see getImageDataPyramid
+    self.pyramidCache = OrderedDict()
+    # volume node ID -> (stamp, export), see prepareExport
+    self.exportCache = OrderedDict()
+
   def hasImageData(self, volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -174,6 +431,8 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  transferError = None
+
   def isValidInputData(self, inputVolumeNode):
     """Validates if the output is not the same as input
     """
@@ -182,13 +441,53 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def getCameraDataAsXML(self, ext):
+  # film width and height of the camera preset
+  defaultFilmSize = (400, 500)
+
+  def getRASBounds(self, volumeNode, ext):
+    """Returns the RAS bounds (xmin, xmax, ymin, ymax, zmin, zmax) of the index extent ext
+    of volumeNode, at least one voxel thick along each axis.
+    """
+    ext = [ext[index] if index % 2 == 0 else max(ext[index], ext[index - 1] + 1) for index in range(6)]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    corners = numpy.array([ijkToRAS.MultiplyPoint((i, j, k, 1))[:3] for i in ext[0:2] for j in ext[2:4] for k in ext[4:6]])
+    return tuple(float(bound) for axis in range(3) for bound in (corners[:, axis].min(), corners[:, axis].max()))
+
+  def getCameraParameters(self, bounds, filmSize=None, cameraNode=None):
+    """Returns the camera of cameraNode (default: 'Default Scene Camera') as a dict of
+    film ([width, height]), fov, focalDistance, from, target and up, with from and target
+    normalized to the RAS bounds of the sent volume (see getRASBounds) like ExposureRender expects.
+    """
+    camera = cameraNode or slicer.util.getNode('Default Scene Camera')
+    pos =  [0,0,0]
+    up = [0,0,0]
+    target = [0,0,0] 
+    camera.GetPosition(pos)
+    camera.GetViewUp(up)
+    camera.GetFocalPoint(target)
+    size = [max(bounds[2 * axis + 1] - bounds[2 * axis], 1) for axis in range(3)]
+    return {
+      'film': list(filmSize or self.defaultFilmSize),
+      'fov': camera.GetViewAngle(),
+      'focalDistance': camera.GetCamera().GetDistance(),
+      'from': [(pos[axis] - bounds[2 * axis]) / float(size[axis]) for axis in range(3)],
+      'target': [(target[axis] - bounds[2 * axis]) / float(size[axis]) for axis in range(3)],
+      'up': up
+    }
+
+  def getCameraDataAsXML(self, bounds, filmSize=None, cameraNode=None):
+    return self.formatCameraXML(self.getCameraParameters(bounds, filmSize, cameraNode))
+
+  def formatCameraXML(self, parameters):
+    """Returns the CameraPresets XML for parameters (see getCameraParameters).
+    """
     xml = """<!DOCTYPE Camera>
 <Presets>
   <Preset Name="volume">
     <Film>
-      <Width Value="400"/>
-      <Height Value="500"/>
+      <Width Value="{filmWidth}"/>
+      <Height Value="{filmHeight}"/>
       <Exposure Value="0.75"/>
     </Film>
     <Aperture>
@@ -206,38 +505,133 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
   </Preset>
 </Presets>
 """
-    camera = slicer.util.getNode('Default Scene Camera')
-    pos =  [0,0,0]
-    up = [0,0,0]
-    target = [0,0,0] 
-    camera.GetPosition(pos)
-    camera.GetViewUp(up)
-    camera.GetFocalPoint(target)
-    focalDistance = camera.GetCamera().GetDistance()
-    fov = camera.GetViewAngle()
     return xml.format(
-      fov=fov,
-      focalDistance=focalDistance,
-      fromX=pos[0] / ext[1],
-      fromY=pos[1] / ext[3],
-      fromZ=pos[2] / ext[5],
-      targetX=target[0] / ext[1],
-      targetY=target[1] / ext[3],
-      targetZ=target[2] / ext[5],
-      upX=up[0],
-      upY=up[1],
-      upZ=up[2]
+      filmWidth=parameters['film'][0],
+      filmHeight=parameters['film'][1],
+      fov=parameters['fov'],
+      focalDistance=parameters['focalDistance'],
+      fromX=parameters['from'][0],
+      fromY=parameters['from'][1],
+      fromZ=parameters['from'][2],
+      targetX=parameters['target'][0],
+      targetY=parameters['target'][1],
+      targetZ=parameters['target'][2],
+      upX=parameters['up'][0],
+      upY=parameters['up'][1],
+      upZ=parameters['up'][2]
     )
 
-  def getLUTDataAsXML(self, inputLUT, intensityRange):
-    wasModifying = inputLUT.StartModify()
-    
+  # number of memoized appearance tables
+  lutCacheSize = 8
+  densityScale = 100
+  shadingType = 2
+  gradientFactor = 80
+
+  def readLUTNodes(self, function, numberOfValues):
+    """Returns the nodes of a vtkColorTransferFunction (numberOfValues=4: x, r, g, b)
+    or of a vtkPiecewiseFunction (numberOfValues=2: x, y), each followed by midpoint
+    and sharpness, as an array with one row per node.
+    """
+    nodes = numpy.zeros((function.GetSize(), numberOfValues + 2))
+    value = [0.0] * (numberOfValues + 2)
+    for index in range(nodes.shape[0]):
+      function.GetNodeValue(index, value)
+      nodes[index] = value
+    return nodes
+
+  def isLinearFunction(self, function, nodes):
+    """Returns whether function interpolates linearly between its nodes (see readLUTNodes)
+    and clamps outside, so that numpy.interp evaluates it like VTK does.
+    """
+    if not function.GetClamping() or not nodes.shape[0]:
+      return False
+    return not ((nodes[:, -2] != 0.5).any() or (nodes[:, -1] != 0).any() or (numpy.diff(nodes[:, 0]) <= 0).any())
+
+  def isLinearLUT(self, colorTF, colorNodes, opacityTF, opacityNodes):
+    """Returns whether both functions are linear (see isLinearFunction) and the colors
+    are interpolated in RGB.
+    """
+    if not self.isLinearFunction(colorTF, colorNodes) or not self.isLinearFunction(opacityTF, opacityNodes):
+      return False
+    return colorTF.GetColorSpace() == vtk.VTK_CTF_RGB and colorTF.GetScale() == vtk.VTK_CTF_LINEAR
+
+  def evaluateOpacity(self, opacityTF, positions):
+    """Returns the values of opacityTF at positions (array).
+    """
+    nodes = self.readLUTNodes(opacityTF, 2)
+    if self.isLinearFunction(opacityTF, nodes):
+      return numpy.interp(positions, nodes[:, 0], nodes[:, 1])
+    return numpy.array([opacityTF.GetValue(x) for x in positions.tolist()])
+
+  def sampleLUT(self, inputLUT):
+    """Evaluates color and opacity of inputLUT at all of their node positions,
+    returns positions (N), colors (N x 3) and opacities (N).
+    """
+    colorTF = inputLUT.GetColor()
+    opacityTF = inputLUT.GetScalarOpacity()
+    colorNodes = self.readLUTNodes(colorTF, 4)
+    opacityNodes = self.readLUTNodes(opacityTF, 2)
+    positions = numpy.union1d(colorNodes[:, 0], opacityNodes[:, 0])
+    if self.isLinearLUT(colorTF, colorNodes, opacityTF, opacityNodes):
+      colors = numpy.column_stack([numpy.interp(positions, colorNodes[:, 0], colorNodes[:, channel]) for channel in (1, 2, 3)])
+      opacities = numpy.interp(positions, opacityNodes[:, 0], opacityNodes[:, 1])
+    else:
+      colors = numpy.zeros((positions.shape[0], 3))
+      opacities = numpy.zeros(positions.shape[0])
+      color = [0,0,0]
+      for index, x in enumerate(positions.tolist()):
+        colorTF.GetColor(x, color)
+        colors[index] = color
+        opacities[index] = opacityTF.GetValue(x)
+    return positions, colors, opacities
+
+  def getShading(self):
+    """Returns specular and specular power of the volume rendering.
+    """
     # print slicer.util.getNodes('*Display*')
     vr = slicer.util.getNode('VolumeRendering')
-    ambient = vr.GetAmbient()
-    diffuse = vr.GetDiffuse()
-    specular = vr.GetSpecular()
-    specularPower = vr.GetPower() # aka 1-Roughness
+    return vr.GetSpecular(), vr.GetPower() # aka 1-Roughness
+
+  def getLUTEntry(self, inputLUT, intensityRange):
+    """Returns the memoized appearance of inputLUT over intensityRange as a dict whose
+    'table' holds one row per node: normalized intensity, opacity, diffuse RGB, specular RGB,
+    emission RGB and roughness, the values of the AppearancePresets XML. The table is
+    recomputed only when the LUT, the range or the shading changed.
+    """
+    specular, specularPower = self.getShading()
+    colorTF = inputLUT.GetColor()
+    opacityTF = inputLUT.GetScalarOpacity()
+    key = (inputLUT.GetID(), colorTF.GetMTime(), opacityTF.GetMTime(), tuple(intensityRange), specular, specularPower)
+    entry = self.lutCache.get(key)
+    if entry is not None:
+      self.lutCache[key] = self.lutCache.pop(key)
+      return entry
+
+    positions, colors, opacities = self.sampleLUT(inputLUT)
+    minIntensity, maxIntensity = intensityRange
+    normalized = (positions - minIntensity) / float(maxIntensity - minIntensity)
+    # one node at each end of the range: the last one at or below it and the first one at or above it
+    below = numpy.nonzero(normalized <= 0)[0]
+    above = numpy.nonzero(normalized >= 1)[0]
+    inside = numpy.nonzero((normalized > 0) & (normalized < 1))[0]
+    selected = numpy.concatenate((below[-1:], inside, above[:1]))
+
+    table = numpy.zeros((selected.shape[0], 12))
+    table[:, 0] = numpy.clip(normalized[selected], 0, 1)
+    table[:, 1] = opacities[selected]
+    table[:, 2:5] = (colors[selected] * 255).astype(int)
+    table[:, 5:8] = int(specular * 255)
+    table[:, 11] = int((1.0 - specularPower) * 100)
+    entry = {'table': table}
+    self.lutCache[key] = entry
+    while len(self.lutCache) > self.lutCacheSize:
+      self.lutCache.popitem(last=False)
+    return entry
+
+  def getLUTDataAsXML(self, inputLUT, intensityRange):
+    entry = self.getLUTEntry(inputLUT, intensityRange)
+    if 'xml' in entry:
+      return entry['xml']
     xml = """<!DOCTYPE Appearance>
 <Presets>
 <Preset Name="volume">
@@ -250,70 +644,574 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
 </Preset>
 </Presets>"""
     node_xml_template = """<Node>
-<NormalizedIntensity Value="{normalizedIntensity}"/>
-<Opacity Value="{opacity}"/>
-<Diffuse G="{diffuseG}" R="{diffuseR}" B="{diffuseB}"/>
-<Specular G="{specularG}" R="{specularR}" B="{specularB}"/>
-<Emission G="{emissionG}" R="{emissionR}" B="{emissionB}"/>
-<Roughness Value="{roughness}"/>
+<NormalizedIntensity Value="{0}"/>
+<Opacity Value="{1}"/>
+<Diffuse G="{3}" R="{2}" B="{4}"/>
+<Specular G="{6}" R="{5}" B="{7}"/>
+<Emission G="{9}" R="{8}" B="{10}"/>
+<Roughness Value="{11}"/>
 </Node>
 """
-    densityScale = 100
-    shadingType = 2
-    gradientFactor = 80
-    positions = set()
-    opacity_positions = set()
-    info = [0,0,0,0,0,0]
-    colorTF = inputLUT.GetColor()
-    for i in range(colorTF.GetSize()):
-      colorTF.GetNodeValue(i, info)
-      positions.add(info[0])
-    info = [0,0,0,0]
-    opacityTF = inputLUT.GetScalarOpacity()
-    for i in range(opacityTF.GetSize()):
-      opacityTF.GetNodeValue(i, info)
-      positions.add(info[0])
-    color = [0,0,0]
-    opacity = [0,0,0]
-    nodes = OrderedDict()
-    minIntensity, maxIntensity = intensityRange
-    deltaIntensity = maxIntensity - minIntensity
-    for x in sorted(positions):
-      colorTF.GetColor(x, color)
-      opacity = opacityTF.GetValue(x)
-      normalizedIntensity = (x - minIntensity) / deltaIntensity
-      if normalizedIntensity < 0:
-        normalizedIntensity = 0
-      elif normalizedIntensity > 1:
-        normalizedIntensity = 1
-        if 1 in nodes: break
-      node = {
-        'normalizedIntensity': normalizedIntensity,
-        'opacity': opacity,
-        'diffuseR': int(color[0] * 255),
-        'diffuseG': int(color[1] * 255),
-        'diffuseB': int(color[2] * 255),
-        'specularR': int(specular * 255),
-        'specularG': int(specular * 255),
-        'specularB': int(specular * 255),
-        'emissionR': 0,
-        'emissionG': 0,
-        'emissionB': 0,
-        'roughness': int((1.0 - specularPower) * 100)
-      }
-      nodes[normalizedIntensity] = node_xml_template.format(**node)
-    return xml.format(
-      nodes="".join(nodes.values()),
-      densityScale=densityScale,
-      shadingType=shadingType,
-      gradientFactor=gradientFactor
+    table = entry['table']
+    nodes = [node_xml_template.format(*(row[:2] + [int(value) for value in row[2:]])) for row in table.tolist()]
+    entry['xml'] = xml.format(
+      nodes="".join(nodes),
+      densityScale=self.densityScale,
+      shadingType=self.shadingType,
+      gradientFactor=self.gradientFactor
     )
-    
-  def runHTTP(self, inputVolume, inputLUT, host):
-    print 'ToDo', host
-  
-  def runCLI(self, inputVolume, inputLUT, exposurePath, dataSharePath):
+    return entry['xml']
+
+  # header of getLUTDataAsBinary: magic, version, node count, density scale, shading type, gradient factor
+  lutBinaryHeaderFormat = '<4sIIfIf'
+
+  def getLUTDataAsBinary(self, inputLUT, intensityRange):
+    """Returns the content of getLUTDataAsXML in a compact binary form for HTTP: a header
+    (see lutBinaryHeaderFormat, magic 'ERLT') followed by the node table as little endian
+    float32, 12 values per node in the order of getLUTEntry.
+    """
+    entry = self.getLUTEntry(inputLUT, intensityRange)
+    if 'binary' not in entry:
+      table = entry['table']
+      entry['binary'] = struct.pack(self.lutBinaryHeaderFormat, b'ERLT', 1, table.shape[0],
+        self.densityScale, self.shadingType, self.gradientFactor) + table.astype('<f4').tobytes()
+    return entry['binary']
+
+  def getVolumeHeaders(self, imageData):
+    """Returns the HTTP headers describing the voxel layout of imageData.
     """
+    return {
+      'Content-Type': 'application/octet-stream',
+      'X-Dimensions': '%d %d %d' % imageData.GetDimensions(),
+      'X-Spacing': '%r %r %r' % imageData.GetSpacing(),
+      'X-Origin': '%r %r %r' % imageData.GetOrigin(),
+      'X-Scalar-Type': imageData.GetScalarTypeAsString(),
+      'X-Components': str(imageData.GetNumberOfScalarComponents()),
+      'X-Byte-Order': sys.byteorder
+    }
+
+  # number of volumes whose pyramid is kept
+  pyramidCacheSize = 2
+  # output slices averaged per step of downsampleVolume
+  pyramidSlabSize = 16
+
+  def downsampleVolume(self, imageData, factor=2):
+    """Returns imageData averaged over blocks of factor^3 voxels as new image data. Blocks at
+    the upper borders, where the dimensions are no multiple of factor, average the voxels
+    they have. The blocks are summed slab by slab with numpy.add.reduceat, so the float
+    intermediates stay small.
+    """
+    dimensions = imageData.GetDimensions()
+    components = imageData.GetNumberOfScalarComponents()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volume = voxels.reshape(dimensions[2], dimensions[1], dimensions[0], components)
+    sumType = numpy.float32 if voxels.dtype.itemsize <= 2 else numpy.float64
+
+    starts = [numpy.arange(0, size, factor) for size in dimensions]
+    counts = [numpy.diff(numpy.append(start, size)).astype(sumType) for start, size in zip(starts, dimensions)]
+    # voxels per block in a (y, x) plane
+    planeCounts = counts[1][:, numpy.newaxis, numpy.newaxis] * counts[0][numpy.newaxis, :, numpy.newaxis]
+    output = numpy.empty((starts[2].shape[0], starts[1].shape[0], starts[0].shape[0], components), dtype=voxels.dtype)
+    for outputStart in range(0, output.shape[0], self.pyramidSlabSize):
+      outputStop = min(outputStart + self.pyramidSlabSize, output.shape[0])
+      slab = volume[outputStart * factor:outputStop * factor]
+      sums = numpy.add.reduceat(slab, numpy.arange(0, slab.shape[0], factor), axis=0, dtype=sumType)
+      sums = numpy.add.reduceat(sums, starts[1], axis=1)
+      sums = numpy.add.reduceat(sums, starts[0], axis=2)
+      sums /= counts[2][outputStart:outputStop, numpy.newaxis, numpy.newaxis, numpy.newaxis] * planeCounts
+      if voxels.dtype.kind in 'iu':
+        numpy.rint(sums, out=sums)
+      output[outputStart:outputStop] = sums
+
+    downsampled = vtk.vtkImageData()
+    downsampled.SetDimensions(output.shape[2], output.shape[1], output.shape[0])
+    spacing = imageData.GetSpacing()
+    downsampled.SetSpacing([s * factor for s in spacing])
+    # samples sit in the centers of the blocks
+    downsampled.SetOrigin([o + 0.5 * (factor - 1) * s for o, s in zip(imageData.GetOrigin(), spacing)])
+    scalars = numpy_support.numpy_to_vtk(output.reshape(-1, components) if components > 1 else output.reshape(-1))
+    downsampled.GetPointData().SetScalars(scalars)
+    return downsampled
+
+  def getVolumePyramid(self, volumeNode, levels=3):
+    """Returns the image data of volumeNode downsampled by 2, 4, ... 2^levels (see
+    downsampleVolume), each level computed from the previous one, finest first. The
+    pyramid is cached until the image data is modified.
+    """
+    imageData = volumeNode.GetImageData()
+    return self.getImageDataPyramid(imageData, (volumeNode.GetID() or id(volumeNode), imageData.GetMTime()), levels)
+
+  def getImageDataPyramid(self, imageData, volumeKey, levels=3):
+    """Like getVolumePyramid for imageData, cached as long as the rest of volumeKey
+    (identifier, stamp...) stays the same.
+    """
+    key = volumeKey[0]
+    cached = self.pyramidCache.pop(key, None)
+    if cached is None or cached[0] != volumeKey[1:] or len(cached[1]) < levels:
+      pyramid = []
+      level = imageData
+      for index in range(levels):
+        level = self.downsampleVolume(level, 2)
+        pyramid.append(level)
+      cached = (volumeKey[1:], pyramid)
+    self.pyramidCache[key] = cached
+    while len(self.pyramidCache) > self.pyramidCacheSize:
+      self.pyramidCache.popitem(last=False)
+    return cached[1][:levels]
+
+  def showRenderedFrame(self, imageData):
+    """Shows imageData, a frame of ExposureRenderFrameReceiver, in the red slice view
+    through the vector volume "ExposureRender Frame", which is created on first use.
+    """
+    frameNode = slicer.mrmlScene.GetFirstNodeByName('ExposureRender Frame')
+    if not frameNode:
+      frameNode = slicer.vtkMRMLVectorVolumeNode()
+      frameNode.SetName('ExposureRender Frame')
+      # frame columns run to the viewer's right and rows downwards in the axial view
+      frameNode.SetIJKToRASDirections(-1, 0, 0, 0, -1, 0, 0, 0, 1)
+      slicer.mrmlScene.AddNode(frameNode)
+      frameNode.CreateDefaultDisplayNodes()
+    if frameNode.GetImageData() is not imageData:
+      frameNode.SetAndObserveImageData(imageData)
+      slicer.util.setSliceViewerLayers(background=frameNode, fit=True)
+    return frameNode
+
+  # number of volumes whose prepared export is kept, see prepareExport
+  exportCacheSize = 2
+  # bins of the intensity lookup that tells visible voxels, see getVisibleBins
+  visibilityBins = 4096
+  # maximum values of the scalar types prepareExport can narrow to
+  narrowScalarTypes = {'uint8': 255, 'uint16': 65535}
+
+  def getROIBounds(self, volumeNode):
+    """Returns the voxel index bounds (i0, i1, j0, j1, k0, k1) of the volume rendering ROI
+    of volumeNode within its image data, or None if volume rendering does not crop.
+    """
+    displayNode = slicer.modules.volumerendering.logic().GetFirstVolumeRenderingDisplayNode(volumeNode)
+    if not displayNode or not displayNode.GetCroppingEnabled() or not displayNode.GetROINode():
+      return None
+    bounds = [0.0] * 6
+    displayNode.GetROINode().GetRASBounds(bounds)
+    rasToIJK = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJK)
+    corners = numpy.array([rasToIJK.MultiplyPoint((x, y, z, 1.0))[:3]
+      for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+    dimensions = volumeNode.GetImageData().GetDimensions()
+    lower = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int), 0)
+    upper = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int), numpy.array(dimensions) - 1)
+    if (lower > upper).any():
+      return None
+    return (lower[0], upper[0], lower[1], upper[1], lower[2], upper[2])
+
+  def getBinIndices(self, values, scalarRange, numberOfBins):
+    lower, upper = scalarRange
+    scale = numberOfBins / float(upper - lower) if upper > lower else 0.0
+    return numpy.clip(((values - lower) * scale).astype(int), 0, numberOfBins - 1)
+
+  def getVisibleBins(self, opacityTF, scalarRange):
+    """Returns for each of visibilityBins intensity bins over scalarRange whether opacityTF
+    is above zero somewhere in it.
+    """
+    edges = numpy.linspace(scalarRange[0], scalarRange[1], self.visibilityBins + 1)
+    opacities = self.evaluateOpacity(opacityTF, edges)
+    visible = (opacities[:-1] > 0) | (opacities[1:] > 0)
+    # the opacity can rise above zero at a node inside a bin whose edges are transparent
+    nodes = self.readLUTNodes(opacityTF, 2)
+    peaks = nodes[(nodes[:, 1] > 0) & (nodes[:, 0] >= scalarRange[0]) & (nodes[:, 0] <= scalarRange[1]), 0]
+    visible[self.getBinIndices(peaks, scalarRange, self.visibilityBins)] = True
+    return visible
+
+  def getSlabSize(self, volume):
+    """Returns the number of z slices of volume (z, y, x, components) processed per step.
+    """
+    return max(1, self.exportChunkSize // max(1, volume[0].nbytes))
+
+  def findVisibleBounds(self, volume, visible, scalarRange):
+    """Returns the index bounds (i0, i1, j0, j1, k0, k1) of the voxels of volume
+    (z, y, x, components) whose first component falls in a visible bin, or None.
+    """
+    zVisible = numpy.zeros(volume.shape[0], dtype=bool)
+    yVisible = numpy.zeros(volume.shape[1], dtype=bool)
+    xVisible = numpy.zeros(volume.shape[2], dtype=bool)
+    slabSize = self.getSlabSize(volume)
+    for start in range(0, volume.shape[0], slabSize):
+      mask = visible[self.getBinIndices(volume[start:start + slabSize, :, :, 0], scalarRange, visible.shape[0])]
+      zVisible[start:start + slabSize] = mask.any(axis=2).any(axis=1)
+      yVisible |= mask.any(axis=2).any(axis=0)
+      xVisible |= mask.any(axis=1).any(axis=0)
+    if not zVisible.any():
+      return None
+    bounds = []
+    for axisVisible in (xVisible, yVisible, zVisible):
+      indices = numpy.nonzero(axisVisible)[0]
+      bounds += [indices[0], indices[-1]]
+    return tuple(bounds)
+
+  def prepareExport(self, inputVolume, inputLUT, crop=None, scalarType=None):
+    """Returns the volume to send as a dict of imageData, extent (its index bounds within
+    the input image data), bounds (its RAS bounds, what the camera is normalized to, see
+    getRASBounds), intensityRange (the input
+    intensities its scalars span, what the LUT is normalized to) and volumeKey (for
+    ExposureRenderChangeTracker.hashVolume).
+    crop 'roi' cuts the volume to the volume rendering ROI, crop 'opacity' to the bounding
+    box of the voxels with an opacity above zero. scalarType 'uint8' or 'uint16' maps the
+    intensity range in which the opacity is above zero onto that type. Without either,
+    the input image data itself is returned. Results are cached per volume.
+    """
+    imageData = inputVolume.GetImageData()
+    nodeKey = inputVolume.GetID() or id(inputVolume)
+    if not crop and not scalarType:
+      return {
+        'imageData': imageData,
+        'extent': imageData.GetExtent(),
+        'bounds': self.getRASBounds(inputVolume, imageData.GetExtent()),
+        'intensityRange': volumeStatisticsCache.getScalarRange(inputVolume),
+        'volumeKey': (inputVolume.GetID(), imageData.GetMTime())
+      }
+
+    opacityTF = inputLUT.GetScalarOpacity()
+    roiBounds = self.getROIBounds(inputVolume) if crop == 'roi' else None
+    stamp = (crop, scalarType, imageData.GetMTime(), opacityTF.GetMTime(), roiBounds)
+    cached = self.exportCache.pop(nodeKey, None)
+    if cached is None or cached[0] != stamp:
+      cached = (stamp, self.computeExport(inputVolume, opacityTF, crop, scalarType, roiBounds))
+      cached[1]['volumeKey'] = ('%s crop=%s type=%s' % (inputVolume.GetID(), crop, scalarType),) + stamp
+    self.exportCache[nodeKey] = cached
+    while len(self.exportCache) > self.exportCacheSize:
+      self.exportCache.popitem(last=False)
+    # the volume may have been moved since
+    cached[1]['bounds'] = self.getRASBounds(inputVolume, cached[1]['extent'])
+    return cached[1]
+
+  def computeExport(self, inputVolume, opacityTF, crop, scalarType, roiBounds):
+    imageData = inputVolume.GetImageData()
+    dimensions = imageData.GetDimensions()
+    components = imageData.GetNumberOfScalarComponents()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volume = voxels.reshape(dimensions[2], dimensions[1], dimensions[0], components)
+    scalarRange = volumeStatisticsCache.getScalarRange(inputVolume)
+
+    visible = None
+    if crop == 'opacity' or scalarType:
+      visible = self.getVisibleBins(opacityTF, scalarRange)
+    bounds = (0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1)
+    if crop == 'roi' and roiBounds:
+      bounds = roiBounds
+    elif crop == 'opacity':
+      bounds = self.findVisibleBounds(volume, visible, scalarRange) or bounds
+    cropped = volume[bounds[4]:bounds[5] + 1, bounds[2]:bounds[3] + 1, bounds[0]:bounds[1] + 1]
+
+    if scalarType:
+      # the intensities between the first and the last visible bin
+      visibleBins = numpy.nonzero(visible)[0]
+      edges = numpy.linspace(scalarRange[0], scalarRange[1], self.visibilityBins + 1)
+      if visibleBins.shape[0]:
+        intensityRange = (edges[visibleBins[0]], edges[visibleBins[-1] + 1])
+      else:
+        intensityRange = tuple(scalarRange)
+      maximum = self.narrowScalarTypes[scalarType]
+      scale = maximum / float(intensityRange[1] - intensityRange[0]) if intensityRange[1] > intensityRange[0] else 0.0
+      output = numpy.empty(cropped.shape, dtype=scalarType)
+      slabSize = self.getSlabSize(cropped)
+      for start in range(0, cropped.shape[0], slabSize):
+        slab = numpy.clip(cropped[start:start + slabSize], intensityRange[0], intensityRange[1]).astype(numpy.float64)
+        output[start:start + slabSize] = numpy.rint((slab - intensityRange[0]) * scale)
+    else:
+      output = numpy.ascontiguousarray(cropped)
+      intensityRange = (float(output[..., 0].min()), float(output[..., 0].max()))
+
+    exported = vtk.vtkImageData()
+    exported.SetDimensions(output.shape[2], output.shape[1], output.shape[0])
+    spacing = imageData.GetSpacing()
+    exported.SetSpacing(spacing)
+    exported.SetOrigin([imageData.GetOrigin()[axis] + bounds[2 * axis] * spacing[axis] for axis in range(3)])
+    exported.GetPointData().SetScalars(numpy_support.numpy_to_vtk(output.reshape(-1, components) if components > 1 else output.reshape(-1)))
+    ext = imageData.GetExtent()
+    return {
+      'imageData': exported,
+      'extent': tuple(ext[2 * (index // 2)] + bounds[index] for index in range(6)),
+      'intensityRange': intensityRange
+    }
+
+  # MetaImage element types by NumPy dtype name
+  metaImageTypes = {
+    'int8': 'MET_CHAR', 'uint8': 'MET_UCHAR', 'int16': 'MET_SHORT', 'uint16': 'MET_USHORT',
+    'int32': 'MET_INT', 'uint32': 'MET_UINT', 'int64': 'MET_LONG_LONG', 'uint64': 'MET_ULONG_LONG',
+    'float32': 'MET_FLOAT', 'float64': 'MET_DOUBLE'
+  }
+  # bytes copied or compressed per step of exportVolume
+  exportChunkSize = 1 << 24
+
+  def exportVolume(self, imageData, filename, compressionLevel=0, numberOfThreads=None, progressCallback=None):
+    """Writes imageData as MetaImage: the header to filename (.mhd) and the voxels next to it.
+    Uncompressed voxels (compressionLevel 0) are copied into a memory-mapped .raw file.
+    Otherwise chunks are deflated in parallel by numberOfThreads (default: one per CPU)
+    and joined into a single zlib stream (.zraw), like pigz does.
+    progressCallback(bytesDone, bytesTotal) is called after each chunk.
+    Returns a dict with rawBytes, bytesWritten, seconds and throughput (voxel bytes per second).
+    """
+    startTime = time.time()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    data = voxels.reshape(-1).view(numpy.uint8)
+    rawBytes = data.shape[0]
+    base = os.path.splitext(filename)[0]
+
+    if compressionLevel:
+      dataFilename = base + '.zraw'
+      dataBytes = self.writeCompressed(data, dataFilename, compressionLevel, numberOfThreads, progressCallback)
+    else:
+      dataFilename = base + '.raw'
+      dataBytes = self.writeMemoryMapped(data, dataFilename, progressCallback)
+
+    header = [
+      'ObjectType = Image',
+      'NDims = 3',
+      'BinaryData = True',
+      'BinaryDataByteOrderMSB = %s' % (sys.byteorder == 'big'),
+      'CompressedData = %s' % bool(compressionLevel)]
+    if compressionLevel:
+      header.append('CompressedDataSize = %d' % dataBytes)
+    header += [
+      'TransformMatrix = 1 0 0 0 1 0 0 0 1',
+      'Offset = %r %r %r' % imageData.GetOrigin(),
+      'ElementSpacing = %r %r %r' % imageData.GetSpacing(),
+      'DimSize = %d %d %d' % imageData.GetDimensions()]
+    if imageData.GetNumberOfScalarComponents() > 1:
+      header.append('ElementNumberOfChannels = %d' % imageData.GetNumberOfScalarComponents())
+    header += [
+      'ElementType = %s' % self.metaImageTypes[voxels.dtype.name],
+      'ElementDataFile = %s' % os.path.basename(dataFilename)]
+    header = '\n'.join(header) + '\n'
+    with open(filename, 'w') as fp:
+      fp.write(header)
+
+    seconds = max(time.time() - startTime, 1e-6)
+    return {
+      'rawBytes': rawBytes,
+      'bytesWritten': dataBytes + len(header),
+      'seconds': seconds,
+      'throughput': rawBytes / seconds,
+      'compressed': bool(compressionLevel)
+    }
+
+  def writeMemoryMapped(self, data, filename, progressCallback=None):
+    """Copies data (uint8 array) chunk by chunk into a memory-mapped file, returns its size.
+    """
+    with open(filename, 'w+b') as fp:
+      fp.truncate(data.shape[0])
+      if data.shape[0]:
+        mapped = numpy.memmap(fp, dtype=numpy.uint8, mode='r+', shape=data.shape)
+        for start in range(0, data.shape[0], self.exportChunkSize):
+          mapped[start:start + self.exportChunkSize] = data[start:start + self.exportChunkSize]
+          if progressCallback:
+            progressCallback(min(start + self.exportChunkSize, data.shape[0]), data.shape[0])
+        mapped.flush()
+        del mapped
+    return data.shape[0]
+
+  def deflateChunk(self, args):
+    """Returns chunk as raw deflate data, ending in a sync flush so that the deflated
+    chunks can be concatenated, or in a final block for the last chunk.
+    """
+    chunk, level, last = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+  def writeCompressed(self, data, filename, level, numberOfThreads=None, progressCallback=None):
+    """Writes data (uint8 array) as one zlib stream whose chunks are deflated in parallel
+    (zlib releases the GIL), returns the number of bytes written.
+    """
+    starts = range(0, data.shape[0], self.exportChunkSize) or [0]
+    tasks = [(data[start:start + self.exportChunkSize], level, start == starts[-1]) for start in starts]
+    pool = ThreadPool(numberOfThreads)
+    try:
+      with open(filename, 'wb') as fp:
+        fp.write(zlib.compress(b'', level)[:2]) # zlib header
+        bytesWritten = 2
+        checksum = zlib.adler32(b'')
+        bytesDone = 0
+        for index, deflated in enumerate(pool.imap(self.deflateChunk, tasks)):
+          chunk = tasks[index][0]
+          checksum = zlib.adler32(chunk, checksum)
+          fp.write(deflated)
+          bytesWritten += len(deflated)
+          bytesDone += chunk.shape[0]
+          if progressCallback:
+            progressCallback(bytesDone, data.shape[0])
+        fp.write(struct.pack('>I', checksum & 0xffffffff))
+        return bytesWritten + 4
+    finally:
+      # also drops the chunks still queued when an error or cancellation ended the loop
+      pool.terminate()
+
+  def runHTTP(self, inputVolume, inputLUT, host, progressCallback=None, binaryLUT=False, filmSize=None, previewLevels=0,
+              crop=None, scalarType=None):
+    """Sends the volume, the appearance and the camera preset to the ExposureRender host
+    ("IP:Port"). Everything that needs the scene is collected right away, the transfer
+    itself runs as an ExposureRenderJob on the worker thread, the job is returned.
+    progressCallback(bytesSent, bytesTotal) is called from that thread.
+    With previewLevels the volume is first sent downsampled (see uploadHTTPPreviews).
+    crop and scalarType reduce the volume before sending (see prepareExport).
+    The host is expected to accept
+      PUT /volume      raw voxels, chunked, layout in the X-* headers (see getVolumeHeaders)
+      PUT /appearance  AppearancePresets XML, or with binaryLUT getLUTDataAsBinary
+      PUT /camera      CameraPresets XML
+    """
+    if not self.isValidInputData(inputVolume):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return None
+
+    logging.info('Processing started')
+
+    instrumentation = pipelineInstrumentation
+    with instrumentation.stage('prepare export'):
+      export = self.prepareExport(inputVolume, inputLUT, crop, scalarType)
+    imageData = export['imageData']
+    intensityRange = export['intensityRange']
+    with instrumentation.stage('LUT') as stage:
+      lutXML = self.getLUTDataAsXML(inputLUT, intensityRange)
+      lutBinary = self.getLUTDataAsBinary(inputLUT, intensityRange) if binaryLUT else None
+      stage.numberOfBytes = len(lutBinary) if lutBinary is not None else len(lutXML)
+    with instrumentation.stage('camera') as stage:
+      cameraXML = self.getCameraDataAsXML(export['bounds'], filmSize)
+      stage.numberOfBytes = len(cameraXML)
+    # a view on the VTK buffer, streamed without any intermediate copy or file
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volumeKey = export['volumeKey']
+    volumeHeaders = self.getVolumeHeaders(imageData)
+
+    def progressReporter(job):
+      def reportProgress(bytesSent, bytesTotal):
+        job.reportProgress(bytesSent, bytesTotal)
+        if progressCallback:
+          progressCallback(bytesSent, bytesTotal)
+      return reportProgress
+
+    def preview(job):
+      self.uploadHTTPPreviews(host, imageData, volumeKey, previewLevels, lutXML, cameraXML, progressReporter(job), lutBinary)
+
+    def transfer(job):
+      self.uploadHTTP(host, voxels, volumeHeaders, lutXML, cameraXML, progressReporter(job), volumeKey, lutBinary)
+
+    stages = [('preview', preview)] if previewLevels else []
+    stages.append(('transfer', transfer))
+    return exposureRenderJobManager.submit(ExposureRenderJob('Send to ' + host, stages))
+
+  def uploadHTTPPreviews(self, host, imageData, volumeKey, levels, lutXML, cameraXML, progressCallback=None, lutBinary=None):
+    """Uploads the pyramid of imageData (see getImageDataPyramid) to host, coarsest
+    level first, so that the renderer can show something before the full resolution
+    volume arrives. Nothing is sent if the host already has the full resolution volume.
+    The camera stays the one of the full volume, the levels cover the same region.
+    """
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volumeHeaders = self.getVolumeHeaders(imageData)
+    tracker = exposureRenderChangeTracker
+    volumeHash = tracker.hashVolume(voxels, json.dumps(volumeHeaders, sort_keys=True), volumeKey)
+    if not tracker.hasChanged('http://' + host, 'volume', volumeHash):
+      return
+    pyramid = self.getImageDataPyramid(imageData, volumeKey, levels)
+    for index in reversed(range(len(pyramid))):
+      level = pyramid[index]
+      levelVoxels = numpy_support.vtk_to_numpy(level.GetPointData().GetScalars())
+      levelKey = ('%s level %d' % (volumeKey[0], index + 1),) + tuple(volumeKey[1:])
+      self.uploadHTTP(host, levelVoxels, self.getVolumeHeaders(level), lutXML, cameraXML, progressCallback, levelKey, lutBinary)
+
+  def sendHTTP(self, host, voxels, volumeHeaders, lutXML, cameraXML, progressCallback=None, volumeKey=None, lutBinary=None):
+    """Like uploadHTTP, but errors are logged and kept in transferError instead of raised.
+    """
+    self.transferError = None
+    try:
+      self.uploadHTTP(host, voxels, volumeHeaders, lutXML, cameraXML, progressCallback, volumeKey, lutBinary)
+    except Exception as e:
+      logging.error('Sending to ExposureRender host %s failed: %s' % (host, e))
+      self.transferError = e
+
+  def uploadHTTP(self, host, voxels, volumeHeaders, lutXML, cameraXML, progressCallback=None, volumeKey=None, lutBinary=None):
+    """Uploads voxels (a NumPy array) and both presets over the pooled connection to host,
+    skipping the parts the host already received (see ExposureRenderChangeTracker).
+    volumeKey (node ID, image data MTime) lets the volume hash be reused.
+    lutBinary (see getLUTDataAsBinary) is sent instead of lutXML if given.
+    If the host turns out to have been restarted during the send, everything is sent again.
+    """
+    client = ExposureRenderHTTPClient.forHost(host)
+    client.checkSession()
+    resets = client.resets
+    self.uploadHTTPParts(client, voxels, volumeHeaders, lutXML, cameraXML, progressCallback, volumeKey, lutBinary)
+    if client.resets != resets:
+      self.uploadHTTPParts(client, voxels, volumeHeaders, lutXML, cameraXML, progressCallback, volumeKey, lutBinary)
+    logging.info('Processing completed')
+
+  def uploadHTTPParts(self, client, voxels, volumeHeaders, lutXML, cameraXML, progressCallback, volumeKey, lutBinary):
+    tracker = exposureRenderChangeTracker
+    instrumentation = pipelineInstrumentation
+    destination = 'http://' + client.host
+    with instrumentation.stage('hash volume', voxels.nbytes):
+      volumeHash = tracker.hashVolume(voxels, json.dumps(volumeHeaders, sort_keys=True), volumeKey)
+    if tracker.hasChanged(destination, 'volume', volumeHash):
+      with instrumentation.stage('upload volume', voxels.nbytes):
+        client.request('PUT', '/volume', voxels, volumeHeaders, progressCallback)
+      tracker.markSent(destination, 'volume', volumeHash)
+    elif progressCallback:
+      progressCallback(voxels.nbytes, voxels.nbytes)
+    if lutBinary is not None:
+      appearance = (lutBinary, 'application/octet-stream')
+    else:
+      appearance = (lutXML.encode('utf-8'), 'application/xml')
+    camera = (cameraXML.encode('utf-8'), 'application/xml')
+    for part, path, (body, contentType) in (('appearance', '/appearance', appearance), ('camera', '/camera', camera)):
+      bodyHash = tracker.hashBytes(body)
+      if tracker.hasChanged(destination, part, bodyHash):
+        with instrumentation.stage('upload ' + part, len(body)):
+          client.request('PUT', path, body, {'Content-Type': contentType})
+        tracker.markSent(destination, part, bodyHash)
+
+  def runDistributed(self, inputVolume, inputLUT, hosts, filmSize=None, tileSize=(64, 64), crop=None, scalarType=None):
+    """Renders one frame on all hosts together: the volume and the presets are uploaded to
+    every host in parallel (see uploadHTTP), then the film is rendered tile by tile
+    (see ExposureRenderTileScheduler). Returns the ExposureRenderJob, its result is the
+    composited frame as vtkImageData (see showRenderedFrame).
+    """
+    if not self.isValidInputData(inputVolume):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return None
+
+    filmSize = filmSize or self.defaultFilmSize
+    with pipelineInstrumentation.stage('prepare export'):
+      export = self.prepareExport(inputVolume, inputLUT, crop, scalarType)
+    imageData = export['imageData']
+    lutXML = self.getLUTDataAsXML(inputLUT, export['intensityRange'])
+    cameraXML = self.getCameraDataAsXML(export['bounds'], filmSize)
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volumeHeaders = self.getVolumeHeaders(imageData)
+
+    def transfer(job):
+      bytesSent = dict((host, 0) for host in hosts)
+      def upload(host):
+        def reportProgress(sent, total):
+          bytesSent[host] = sent
+          job.reportProgress(sum(bytesSent.values()), total * len(hosts))
+        self.uploadHTTP(host, voxels, volumeHeaders, lutXML, cameraXML, reportProgress, export['volumeKey'])
+      pool = ThreadPool(len(hosts))
+      try:
+        pool.map(upload, hosts)
+      finally:
+        pool.close()
+
+    def render(job):
+      scheduler = ExposureRenderTileScheduler(hosts, filmSize, tileSize)
+      with pipelineInstrumentation.stage('render tiles', filmSize[0] * filmSize[1]):
+        scheduler.render(job.reportProgress)
+      job.result = scheduler.getImageData()
+
+    return exposureRenderJobManager.submit(ExposureRenderJob('Render on ' + ', '.join(hosts),
+      [('transfer', transfer), ('render', render)]))
+
+  def runCLI(self, inputVolume, inputLUT, exposurePath, dataSharePath, compressionLevel=0, filmSize=None,
+             crop=None, scalarType=None):
+    """Writes the presets and the volume to dataSharePath and starts ExposureRender from
+    exposurePath on it, unless that renderer is still running. The scene is read right away,
+    writing and launching run as an ExposureRenderJob on the worker thread, the job is returned.
+    crop and scalarType reduce the volume before writing (see prepareExport).
     """
     if not self.isValidInputData(inputVolume):
       slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
@@ -321,36 +1219,1586 @@ class ExposureRenderLinkLogic(ScriptedLoadableModuleLogic):
     
     logging.info('Processing started')
 
-    imageData = inputVolume.GetImageData()
-    intensityRange = [0, 0]
-    imageData.GetScalarRange(intensityRange)
-    ext = imageData.GetExtent()
-    
-    lut_xml = self.getLUTDataAsXML(inputLUT, intensityRange)
-    filename = os.path.join(dataSharePath, 'AppearancePresets.xml')
-    with open(filename, 'w') as fp:
-      fp.write(lut_xml)
+    instrumentation = pipelineInstrumentation
+    with instrumentation.stage('prepare export'):
+      export = self.prepareExport(inputVolume, inputLUT, crop, scalarType)
+    imageData = export['imageData']
+    intensityRange = export['intensityRange']
+    with instrumentation.stage('LUT') as stage:
+      lutXML = self.getLUTDataAsXML(inputLUT, intensityRange)
+      stage.numberOfBytes = len(lutXML)
+    with instrumentation.stage('camera') as stage:
+      cameraXML = self.getCameraDataAsXML(export['bounds'], filmSize)
+      stage.numberOfBytes = len(cameraXML)
+    presets = (('appearance', 'AppearancePresets.xml', lutXML), ('camera', 'CameraPresets.xml', cameraXML))
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volumeKey = export['volumeKey']
+    volumeLayout = json.dumps(self.getVolumeHeaders(imageData), sort_keys=True)
 
-    filename = os.path.join(dataSharePath, 'CameraPresets.xml')
-    with open(filename, 'w') as fp:
-      fp.write(self.getCameraDataAsXML(ext))
-    
-    return
-    writer = vtk.vtkMetaImageWriter()
-    filename = os.path.join(dataSharePath, 'volume.mhd')
-    writer.SetFileName(filename)
-        
-    if vtk.VTK_MAJOR_VERSION <= 5:
-        writer.SetInputConnection(imageData.GetProducerPort())
+    # only rewrite the files whose content changed since they were last written to this share
+    tracker = exposureRenderChangeTracker
+    destination = os.path.abspath(dataSharePath)
+
+    def writePresets(job):
+      for part, name, xml in presets:
+        filename = os.path.join(dataSharePath, name)
+        xmlHash = tracker.hashText(xml)
+        if tracker.hasChanged(destination, part, xmlHash) or not os.path.exists(filename):
+          with instrumentation.stage('write ' + part, len(xml)):
+            with open(filename, 'w') as fp:
+              fp.write(xml)
+          tracker.markSent(destination, part, xmlHash)
+
+    def writeVolume(job):
+      filename = os.path.join(dataSharePath, 'volume.mhd')
+      with instrumentation.stage('hash volume', voxels.nbytes):
+        volumeHash = tracker.hashVolume(voxels, volumeLayout, volumeKey)
+      # the files also depend on the compression level (.raw or .zraw), the cached voxel hash does not
+      volumeHash = tracker.hashText('%s compression %d' % (volumeHash, compressionLevel))
+      if tracker.hasChanged(destination, 'volume', volumeHash) or not os.path.exists(filename):
+        with instrumentation.stage('export volume') as stage:
+          stats = self.exportVolume(imageData, filename, compressionLevel, progressCallback=job.reportProgress)
+          stage.numberOfBytes = stats['bytesWritten']
+        logging.info('Wrote %d bytes in %.2f s (%.1f MB/s of voxel data)' % (
+          stats['bytesWritten'], stats['seconds'], stats['throughput'] / 1e6))
+        tracker.markSent(destination, 'volume', volumeHash)
+
+    def launch(job):
+      logging.info('Call ExposureRender ' + exposurePath)
+      args = [exposurePath+'/ExposureRender.exe', dataSharePath]
+      with instrumentation.stage('launch renderer'):
+        exposureRenderJobManager.launchRenderer(args, exposurePath)
+      logging.info('Processing completed')
+
+    job = ExposureRenderJob('Export to ' + dataSharePath,
+      [('presets', writePresets), ('export', writeVolume), ('launch', launch)])
+    return exposureRenderJobManager.submit(job)
+
+  # name of the shared memory segment of runSharedMemory
+  sharedMemoryName = 'ExposureRender'
+  # default capacity of the shared memory segment in multiples of the volume size
+  sharedMemoryHeadroom = 2
+
+  def runSharedMemory(self, inputVolume, inputLUT, exposurePath=None, name=None, binaryLUT=False, filmSize=None,
+                      crop=None, scalarType=None, capacity=None):
+    """Publishes the volume, the appearance and the camera preset to the shared memory segment
+    name (default sharedMemoryName, see ExposureRenderSharedMemory) for a renderer on this host
+    and, with exposurePath, starts ExposureRender on it ("shm://" + name) unless it is still
+    running. Like runCLI the scene is read right away and an ExposureRenderJob is returned.
+    capacity is the least size in bytes the segment is created with, by default
+    sharedMemoryHeadroom times the volume. Larger volumes than that recreate the segment,
+    which fails on Windows while the renderer has it mapped.
+    """
+    if not self.isValidInputData(inputVolume):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return None
+
+    logging.info('Processing started')
+
+    name = name or self.sharedMemoryName
+    instrumentation = pipelineInstrumentation
+    with instrumentation.stage('prepare export'):
+      export = self.prepareExport(inputVolume, inputLUT, crop, scalarType)
+    imageData = export['imageData']
+    intensityRange = export['intensityRange']
+    with instrumentation.stage('LUT'):
+      lut = self.getLUTDataAsBinary(inputLUT, intensityRange) if binaryLUT else \
+        self.getLUTDataAsXML(inputLUT, intensityRange).encode('utf-8')
+    with instrumentation.stage('camera'):
+      cameraXML = self.getCameraDataAsXML(export['bounds'], filmSize)
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    volumeKey = export['volumeKey']
+    volumeHeaders = self.getVolumeHeaders(imageData)
+    if capacity is None:
+      capacity = self.sharedMemoryHeadroom * voxels.nbytes
+
+    def publish(job):
+      self.publishSharedMemory(name, voxels, volumeHeaders, lut, cameraXML, job.reportProgress, volumeKey, capacity)
+
+    def launch(job):
+      args = [exposurePath + '/ExposureRender.exe', 'shm://' + name]
+      with instrumentation.stage('launch renderer'):
+        exposureRenderJobManager.launchRenderer(args, exposurePath)
+      logging.info('Processing completed')
+
+    stages = [('publish', publish)]
+    if exposurePath:
+      stages.append(('launch', launch))
+    return exposureRenderJobManager.submit(ExposureRenderJob('Publish to shm://' + name, stages))
+
+  def publishSharedMemory(self, name, voxels, volumeHeaders, lut, cameraXML, progressCallback=None, volumeKey=None,
+                          capacity=0):
+    """Writes the changed parts to the pooled shared memory segment name, returns their names.
+    lut is the appearance as bytes (AppearancePresets XML or getLUTDataAsBinary).
+    capacity is the least size of the segment in bytes, see ExposureRenderSharedMemory.forName.
+    """
+    layout = json.dumps(volumeHeaders, sort_keys=True)
+    with pipelineInstrumentation.stage('hash volume', voxels.nbytes):
+      volumeHash = exposureRenderChangeTracker.hashVolume(voxels, layout, volumeKey)
+    segment = ExposureRenderSharedMemory.forName(name, capacity)
+    with pipelineInstrumentation.stage('publish shared memory') as stage:
+      changed = segment.publish({
+        'layout': layout.encode('utf-8'),
+        'lut': lut,
+        'camera': cameraXML.encode('utf-8'),
+        'volume': voxels,
+        'volumeHash': volumeHash
+      }, progressCallback)
+      stage.numberOfBytes = sum(segment.sections[part]['size'] for part in changed)
+    return changed
+
+
+#
+# ExposureRenderChangeTracker
+#
+
+class ExposureRenderChangeTracker(object):
+  """Remembers content hashes of the volume, LUT and camera last sent to each destination
+  (a data share path or an HTTP host), so that a send only transfers the parts that
+  changed. Volume hashes are computed chunk by chunk and cached per volume and
+  image data MTime. Use the shared instance exposureRenderChangeTracker.
+  """
+
+  # bytes hashed per update call
+  hashChunkSize = 1 << 24
+
+  def __init__(self):
+    self.volumeHashes = {}
+    self.sentHashes = {}
+    # sends to different destinations may run in parallel threads
+    self.lock = threading.Lock()
+
+  def hashText(self, text):
+    return self.hashBytes(text.encode('utf-8'))
+
+  def hashBytes(self, data):
+    return hashlib.sha1(data).hexdigest()
+
+  def hashVolume(self, voxels, layout='', key=None):
+    """Returns the hash of the voxels (a NumPy array) and their layout description.
+    key, e.g. (volume node ID, image data MTime), identifies unchanged voxels
+    whose hash was computed before.
+    """
+    with self.lock:
+      if key is not None and self.volumeHashes.get(key[0], (None, None))[0] == key[1:]:
+        return self.volumeHashes[key[0]][1]
+    digest = hashlib.sha1(layout.encode('utf-8'))
+    data = voxels.reshape(-1).view(numpy.uint8)
+    for start in range(0, data.shape[0], self.hashChunkSize):
+      digest.update(data[start:start + self.hashChunkSize])
+    volumeHash = digest.hexdigest()
+    if key is not None:
+      with self.lock:
+        self.volumeHashes[key[0]] = (key[1:], volumeHash)
+    return volumeHash
+
+  def hasChanged(self, destination, part, contentHash):
+    with self.lock:
+      return self.sentHashes.get((destination, part)) != contentHash
+
+  def markSent(self, destination, part, contentHash):
+    with self.lock:
+      self.sentHashes[(destination, part)] = contentHash
+
+  def forget(self, destination=None):
+    """Makes the next send to destination (or to all destinations) transfer everything.
+    """
+    with self.lock:
+      for key in list(self.sentHashes):
+        if destination is None or key[0] == destination:
+          del self.sentHashes[key]
+
+# shared by all logic instances, what was sent does not depend on who sent it
+exposureRenderChangeTracker = ExposureRenderChangeTracker()
+
+
+#
+# ExposureRenderJobManager
+#
+
+class ExposureRenderJobCancelled(Exception):
+  pass
+
+class ExposureRenderJob(object):
+  """A send to ExposureRender as a list of (stageName, function(job)) stages, run in order
+  on the worker thread of ExposureRenderJobManager. Stages report progress through
+  reportProgress, which also ends the job once cancel was called. state goes from
+  'queued' over 'running' to 'done', 'failed' (see error) or 'cancelled'; timings holds
+  the seconds spent per stage. Stages may leave what they produced in result.
+  Poll these from the GUI thread or wait for the job.
+  """
+
+  def __init__(self, name, stages):
+    self.name = name
+    self.stages = stages
+    self.state = 'queued'
+    self.stage = None
+    self.progress = (0, 0)
+    self.timings = OrderedDict()
+    self.error = None
+    self.result = None
+    self.cancelEvent = threading.Event()
+    self.finishedEvent = threading.Event()
+
+  def cancel(self):
+    self.cancelEvent.set()
+
+  @property
+  def cancelled(self):
+    return self.cancelEvent.is_set()
+
+  @property
+  def finished(self):
+    return self.finishedEvent.is_set()
+
+  def wait(self, timeout=None):
+    """Waits until the job finished, returns False on timeout.
+    """
+    self.finishedEvent.wait(timeout)
+    return self.finished
+
+  def reportProgress(self, done, total):
+    if self.cancelled:
+      raise ExposureRenderJobCancelled()
+    self.progress = (done, total)
+
+  def describeTimings(self):
+    return ', '.join('%s %.2f s' % (stage, seconds) for stage, seconds in self.timings.items())
+
+  def run(self):
+    self.state = 'running'
+    try:
+      for stage, function in self.stages:
+        if self.cancelled:
+          raise ExposureRenderJobCancelled()
+        self.stage = stage
+        self.progress = (0, 0)
+        startTime = time.time()
+        function(self)
+        self.timings[stage] = time.time() - startTime
+      self.state = 'done'
+      logging.info('%s took %s' % (self.name, self.describeTimings()))
+    except ExposureRenderJobCancelled:
+      self.state = 'cancelled'
+      logging.info('%s cancelled during %s' % (self.name, self.stage))
+    except Exception as e:
+      self.state = 'failed'
+      self.error = e
+      logging.error('%s failed during %s: %s' % (self.name, self.stage, e))
+    finally:
+      self.finishedEvent.set()
+
+class ExposureRenderJobManager(object):
+  """Runs ExposureRenderJobs one after the other on a background worker thread, so that
+  writing, uploading and launching never block the GUI and two sends never write the same
+  share at once. Also keeps track of the launched ExposureRender processes: a renderer
+  that is still running is reused instead of starting another one per send.
+  Use the shared instance exposureRenderJobManager.
+  """
+
+  def __init__(self):
+    self.jobs = Queue.Queue()
+    self.worker = None
+    self.lock = threading.Lock()
+    # command line tuple -> subprocess.Popen
+    self.processes = {}
+
+  def submit(self, job):
+    with self.lock:
+      if self.worker is None or not self.worker.is_alive():
+        self.worker = threading.Thread(target=self.work)
+        self.worker.daemon = True
+        self.worker.start()
+    self.jobs.put(job)
+    return job
+
+  def work(self):
+    while True:
+      self.jobs.get().run()
+
+  def getRenderer(self, args):
+    """Returns the running process started with args, or None.
+    """
+    with self.lock:
+      process = self.processes.get(tuple(args))
+      if process is not None and process.poll() is not None:
+        del self.processes[tuple(args)]
+        process = None
+      return process
+
+  def launchRenderer(self, args, cwd=None):
+    """Starts the renderer command line args unless it is still running, returns the process.
+    """
+    process = self.getRenderer(args)
+    if process is not None:
+      logging.info('Reusing ExposureRender process %d' % process.pid)
+      return process
+    process = subprocess.Popen(args, cwd=cwd)
+    with self.lock:
+      self.processes[tuple(args)] = process
+    return process
+
+  def terminateRenderers(self):
+    with self.lock:
+      for process in self.processes.values():
+        if process.poll() is None:
+          process.terminate()
+      self.processes.clear()
+
+exposureRenderJobManager = ExposureRenderJobManager()
+
+#
+# ExposureRenderFrameReceiver
+#
+
+class ExposureRenderFrameReceiver(object):
+  """Receives the progressively refined images of a renderer, either from frame.bin on the
+  data share (the renderer should write it to a temporary name and rename it) or from
+  GET /frame on an HTTP host. A frame is a 20 byte header (magic 'ERFR', then little endian
+  uint32 width, height, components and iteration) followed by the 8 bit pixels, row by row
+  from the top.
+  A background thread fetches at most maxFrameRate frames per second into a receive buffer
+  of its own and, once a frame is complete, swaps it with the back buffer; update, called on
+  the GUI thread, copies the newest frame into imageData. Reading a frame never holds the
+  lock update waits for. The buffers are only reallocated when the frame size changes.
+  """
+
+  magic = b'ERFR'
+  headerFormat = '<4sIIII'
+  headerSize = struct.calcsize(headerFormat)
+
+  @classmethod
+  def packFrame(cls, pixels, iteration):
+    """Returns pixels (height x width x components uint8 array) as frame bytes.
+    """
+    height, width, components = pixels.shape
+    return struct.pack(cls.headerFormat, cls.magic, width, height, components, iteration) + \
+      numpy.ascontiguousarray(pixels, dtype=numpy.uint8).tobytes()
+
+  def __init__(self, dataSharePath=None, host=None, maxFrameRate=10):
+    self.frameFilename = os.path.join(dataSharePath, 'frame.bin') if dataSharePath else None
+    self.client = ExposureRenderHTTPClient(host) if host else None
+    self.maxFrameRate = maxFrameRate
+    self.imageData = vtk.vtkImageData()
+    self.pixels = None
+    self.iteration = -1
+    self.error = None
+    self.backBuffer = None
+    self.receiveBuffer = None
+    self.backLayout = None # (width, height, components, iteration)
+    self.framesReceived = 0
+    self.framesShown = 0
+    self.fileStamp = None
+    self.lock = threading.Lock()
+    self.stopEvent = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.stopEvent.clear()
+    self.thread = threading.Thread(target=self.receive)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopEvent.set()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    if self.client:
+      self.client.close()
+
+  def receive(self):
+    while not self.stopEvent.is_set():
+      startTime = time.time()
+      try:
+        self.fetch()
+        self.error = None
+      except Exception as e:
+        self.error = e
+      self.stopEvent.wait(max(0.0, 1.0 / self.maxFrameRate - (time.time() - startTime)))
+
+  def parseHeader(self, header):
+    magic, width, height, components, iteration = struct.unpack(self.headerFormat, header)
+    if magic != self.magic:
+      raise IOError('Not an ExposureRender frame')
+    return width, height, components, iteration
+
+  def getReceiveBuffer(self, width, height, components):
+    """Returns the receive buffer as a flat uint8 array, reallocated only for a new frame size.
+    Only the fetching thread uses it.
+    """
+    size = width * height * components
+    if self.receiveBuffer is None or self.receiveBuffer.shape[0] != size:
+      self.receiveBuffer = numpy.empty(size, dtype=numpy.uint8)
+    return self.receiveBuffer
+
+  def swapBuffers(self, layout):
+    """Makes the completely received frame the back buffer, the old one is received into next.
+    """
+    with self.lock:
+      self.backBuffer, self.receiveBuffer = self.receiveBuffer, self.backBuffer
+      self.backLayout = layout
+      self.framesReceived += 1
+
+  def fetch(self):
+    """Reads a new frame into the back buffer if there is one, returns whether there was.
+    """
+    if self.frameFilename:
+      return self.fetchFile()
+    return self.fetchHTTP()
+
+  def fetchFile(self):
+    try:
+      stat = os.stat(self.frameFilename)
+    except OSError:
+      return False
+    stamp = (stat.st_mtime, stat.st_size)
+    if stamp == self.fileStamp:
+      return False
+    with open(self.frameFilename, 'rb') as fp:
+      layout = self.parseHeader(fp.read(self.headerSize))
+      buffer = self.getReceiveBuffer(*layout[:3])
+      if fp.readinto(buffer) != buffer.shape[0]:
+        return False # still being written, try again next time
+    self.swapBuffers(layout)
+    self.fileStamp = stamp
+    return True
+
+  def fetchHTTP(self):
+    body = self.client.request('GET', '/frame')
+    layout = self.parseHeader(body[:self.headerSize])
+    if self.backLayout == layout:
+      return False
+    buffer = self.getReceiveBuffer(*layout[:3])
+    buffer[:] = numpy.frombuffer(body, dtype=numpy.uint8, count=buffer.shape[0], offset=self.headerSize)
+    self.swapBuffers(layout)
+    return True
+
+  def update(self):
+    """Copies the newest received frame into imageData, returns whether there was a new one.
+    Call from the GUI thread.
+    """
+    with self.lock:
+      if self.framesShown == self.framesReceived:
+        return False
+      self.framesShown = self.framesReceived
+      width, height, components, self.iteration = self.backLayout
+      if self.pixels is None or self.imageData.GetDimensions() != (width, height, 1) \
+          or self.imageData.GetNumberOfScalarComponents() != components:
+        self.imageData.SetDimensions(width, height, 1)
+        scalars = vtk.vtkUnsignedCharArray()
+        scalars.SetNumberOfComponents(components)
+        scalars.SetNumberOfTuples(width * height)
+        self.imageData.GetPointData().SetScalars(scalars)
+        self.pixels = numpy_support.vtk_to_numpy(scalars).reshape(-1)
+      numpy.copyto(self.pixels, self.backBuffer)
+    self.imageData.Modified()
+    return True
+
+#
+# ExposureRenderCameraSync
+#
+
+class ExposureRenderCameraSync(object):
+  """Streams camera changes to a renderer without resending anything else. Modified events
+  of the camera node are throttled to at most one push per throttleInterval ms, so deltas
+  keep going out while the camera is dragged. Only the camera parameters that changed
+  (see ExposureRenderLinkLogic.getCameraParameters, normalized to bounds) are sent as JSON
+  to POST /camera/delta on host, or, for a data share, CameraPresets.xml is rewritten.
+  While the 3D view is being interacted with the film is scaled by interactionFilmScale,
+  the full filmSize is restored on release. Sending runs on a thread of its own, deltas
+  that pile up meanwhile are merged into one.
+  """
+
+  def __init__(self, logic, bounds, host=None, dataSharePath=None, filmSize=None,
+               interactionFilmScale=0.5, throttleInterval=50):
+    self.logic = logic
+    self.bounds = bounds
+    self.host = host
+    self.dataSharePath = dataSharePath
+    self.filmSize = filmSize or logic.defaultFilmSize
+    self.interactionFilmScale = interactionFilmScale
+    self.interacting = False
+    self.cameraNode = None
+    self.observations = []
+    self.lastParameters = {}
+    self.pendingDelta = {}
+    self.sentParameters = {}
+    self.lock = threading.Lock()
+    self.sendEvent = threading.Event()
+    self.idleEvent = threading.Event()
+    self.idleEvent.set()
+    self.stopEvent = threading.Event()
+    self.thread = None
+    self.client = ExposureRenderHTTPClient(host) if host else None
+    self.error = None
+    self.throttleTimer = qt.QTimer()
+    self.throttleTimer.singleShot = True
+    self.throttleTimer.setInterval(throttleInterval)
+    self.throttleTimer.connect('timeout()', self.push)
+
+  def start(self, cameraNode=None, interactorStyle=None):
+    """Observes cameraNode (default: 'Default Scene Camera') and the interaction of
+    interactorStyle (default: the one of the first 3D view), and sends the full camera.
+    """
+    self.cameraNode = cameraNode or slicer.util.getNode('Default Scene Camera')
+    self.observations.append((self.cameraNode, self.cameraNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onCameraModified)))
+    if interactorStyle is None and slicer.app.layoutManager():
+      threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
+      interactorStyle = threeDView.renderWindow().GetInteractor().GetInteractorStyle()
+    if interactorStyle is not None:
+      self.observations.append((interactorStyle, interactorStyle.AddObserver(vtk.vtkCommand.StartInteractionEvent, self.onStartInteraction)))
+      self.observations.append((interactorStyle, interactorStyle.AddObserver(vtk.vtkCommand.EndInteractionEvent, self.onEndInteraction)))
+    self.stopEvent.clear()
+    self.thread = threading.Thread(target=self.send)
+    self.thread.daemon = True
+    self.thread.start()
+    self.push()
+    return self
+
+  def stop(self):
+    self.throttleTimer.stop()
+    for observed, tag in self.observations:
+      observed.RemoveObserver(tag)
+    self.observations = []
+    self.stopEvent.set()
+    self.sendEvent.set()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    if self.client:
+      self.client.close()
+
+  def onCameraModified(self, caller, event):
+    # restarting a running timer would hold the push back until the drag pauses
+    if not self.throttleTimer.isActive():
+      self.throttleTimer.start()
+
+  def onStartInteraction(self, caller, event):
+    self.interacting = True
+    if not self.throttleTimer.isActive():
+      self.throttleTimer.start()
+
+  def onEndInteraction(self, caller, event):
+    self.interacting = False
+    self.throttleTimer.stop()
+    self.push()
+
+  def getFilmSize(self):
+    if not self.interacting:
+      return self.filmSize
+    return [max(16, int(size * self.interactionFilmScale)) for size in self.filmSize]
+
+  def computeDelta(self, parameters):
+    """Returns the parameters that differ from the ones passed last time.
+    """
+    delta = dict((key, value) for key, value in parameters.items() if self.lastParameters.get(key) != value)
+    self.lastParameters = parameters
+    return delta
+
+  def push(self):
+    """Queues the camera changes since the last push for sending.
+    """
+    delta = self.computeDelta(self.logic.getCameraParameters(self.bounds, self.getFilmSize(), self.cameraNode))
+    if not delta:
+      return
+    with self.lock:
+      self.pendingDelta.update(delta)
+      self.idleEvent.clear()
+    self.sendEvent.set()
+
+  def wait(self, timeout=None):
+    """Waits until all pushed changes were sent, returns False on timeout.
+    """
+    self.idleEvent.wait(timeout)
+    return self.idleEvent.is_set()
+
+  def send(self):
+    while True:
+      self.sendEvent.wait()
+      if self.stopEvent.is_set():
+        return
+      with self.lock:
+        self.sendEvent.clear()
+        delta, self.pendingDelta = self.pendingDelta, {}
+      try:
+        self.sendDelta(delta)
+        self.error = None
+      except Exception as e:
+        logging.error('Sending the camera to ExposureRender failed: %s' % e)
+        self.error = e
+      with self.lock:
+        if not self.pendingDelta:
+          self.idleEvent.set()
+
+  def sendDelta(self, delta):
+    self.sentParameters.update(delta)
+    xml = self.logic.formatCameraXML(self.sentParameters)
+    tracker = exposureRenderChangeTracker
+    if self.client:
+      self.client.request('POST', '/camera/delta', json.dumps(delta).encode('utf-8'), {'Content-Type': 'application/json'})
+      destination = 'http://' + self.host
     else:
-        writer.SetInputData(imageData)
+      with open(os.path.join(self.dataSharePath, 'CameraPresets.xml'), 'w') as fp:
+        fp.write(xml)
+      destination = os.path.abspath(self.dataSharePath)
+    # a full send afterwards only needs to resend a camera that differs from the streamed one
+    tracker.markSent(destination, 'camera', tracker.hashText(xml))
+
+#
+# ExposureRenderTileScheduler
+#
+
+class ExposureRenderTileScheduler(object):
+  """Renders one frame on several ExposureRender hosts at once. The film is cut into tiles of
+  tileSize pixels, hosts render them on request (POST /tile with the JSON tile x, y, width,
+  height and film, answered by a frame as described in ExposureRenderFrameReceiver) and the
+  tiles are composited into image, a height x width x components uint8 array, top row first.
+  Tiles are dealt to one deque per host in proportion to the speed (pixels per second)
+  measured for each host during earlier frames (hostSpeeds, shared by all schedulers).
+  A host whose deque runs empty steals from the back of the deque with the most estimated
+  work left, so that fast hosts take over from slow ones. The tiles of a failing host go
+  to the others. statistics holds the tiles, stolen tiles and seconds per host.
+  """
+
+  # host -> pixels per second
+  hostSpeeds = {}
+  hostSpeedsLock = threading.Lock()
+  # weight of the newest tile in the moving average of a host's speed
+  speedSmoothing = 0.3
+  # seconds an idle host waits for tiles of a failing host before it looks again
+  idleInterval = 0.01
+
+  def __init__(self, hosts, filmSize, tileSize=(64, 64)):
+    self.hosts = list(hosts)
+    self.filmSize = tuple(filmSize)
+    self.tileSize = tuple(tileSize)
+    self.image = None
+    self.queues = dict((host, deque()) for host in self.hosts)
+    self.statistics = dict((host, {'tiles': 0, 'stolen': 0, 'seconds': 0.0}) for host in self.hosts)
+    self.failed = {}
+    self.cancelled = None
+    self.tilesDone = 0
+    self.inFlight = 0
+    self.lock = threading.Lock()
+
+  def getTiles(self):
+    """Returns the (x, y, width, height) tiles covering the film, row by row from the top.
+    """
+    width, height = self.filmSize
+    tileWidth, tileHeight = self.tileSize
+    return [(x, y, min(tileWidth, width - x), min(tileHeight, height - y))
+            for y in range(0, height, tileHeight) for x in range(0, width, tileWidth)]
+
+  def getSpeeds(self):
+    """Returns the measured speed of every host, hosts not measured yet get the mean of the others.
+    """
+    with self.hostSpeedsLock:
+      known = [self.hostSpeeds[host] for host in self.hosts if host in self.hostSpeeds]
+      default = sum(known) / len(known) if known else 1.0
+      return dict((host, self.hostSpeeds.get(host, default)) for host in self.hosts)
+
+  def updateSpeed(self, host, pixelsPerSecond):
+    with self.hostSpeedsLock:
+      speed = self.hostSpeeds.get(host)
+      self.hostSpeeds[host] = pixelsPerSecond if speed is None else \
+        speed + self.speedSmoothing * (pixelsPerSecond - speed)
+
+  def deal(self, tiles):
+    """Hands every tile to the host that would finish its share earliest with it.
+    """
+    speeds = self.getSpeeds()
+    pixels = dict((host, 0) for host in self.hosts)
+    for tile in tiles:
+      area = tile[2] * tile[3]
+      host = min(self.hosts, key=lambda host: (pixels[host] + area) / speeds[host])
+      pixels[host] += area
+      self.queues[host].append(tile)
+
+  def nextTile(self, host):
+    """Returns the next tile for host, its own or a stolen one, None if there are no tiles left.
+    """
+    with self.lock:
+      if self.cancelled:
+        return None
+      queue = self.queues[host]
+      if not queue:
+        speeds = self.getSpeeds()
+        def remainingSeconds(victim):
+          return sum(tile[2] * tile[3] for tile in self.queues[victim]) / speeds[victim]
+        victims = [victim for victim in self.hosts if self.queues[victim] and victim not in self.failed]
+        if not victims:
+          return None
+        queue = self.queues[max(victims, key=remainingSeconds)]
+        self.statistics[host]['stolen'] += 1
+        tile = queue.pop()
+      else:
+        tile = queue.popleft()
+      self.inFlight += 1
+      return tile
+
+  def renderTile(self, host, tile):
+    """Requests tile from host, returns its pixels as height x width x components array.
+    """
+    x, y, width, height = tile
+    body = json.dumps({'x': x, 'y': y, 'width': width, 'height': height, 'film': list(self.filmSize)})
+    data = ExposureRenderHTTPClient.forHost(host).request('POST', '/tile', body.encode('utf-8'),
+                                                          {'Content-Type': 'application/json'})
+    headerSize = ExposureRenderFrameReceiver.headerSize
+    magic, frameWidth, frameHeight, components, iteration = struct.unpack(
+      ExposureRenderFrameReceiver.headerFormat, data[:headerSize])
+    if magic != ExposureRenderFrameReceiver.magic or (frameWidth, frameHeight) != (width, height):
+      raise IOError('Host %s answered tile %r with a %dx%d frame' % (host, tile, frameWidth, frameHeight))
+    return numpy.frombuffer(data, numpy.uint8, width * height * components, headerSize).reshape(height, width, components)
+
+  def work(self, host, progressCallback):
+    numberOfTiles = len(self.getTiles())
+    while True:
+      tile = self.nextTile(host)
+      if tile is None:
+        with self.lock:
+          if self.cancelled or not self.inFlight:
+            return
+        # a failing host may still hand its tiles over
+        time.sleep(self.idleInterval)
+        continue
+      startTime = time.time()
+      try:
+        pixels = self.renderTile(host, tile)
+      except Exception as e:
+        logging.error('ExposureRender host %s failed: %s' % (host, e))
+        with self.lock:
+          self.failed[host] = e
+          orphans = [tile] + list(self.queues[host])
+          self.queues[host].clear()
+          working = [other for other in self.hosts if other not in self.failed]
+          for index, orphan in enumerate(orphans):
+            if working:
+              self.queues[working[index % len(working)]].append(orphan)
+          self.inFlight -= 1
+        return
+      seconds = max(time.time() - startTime, 1e-6)
+      self.updateSpeed(host, tile[2] * tile[3] / seconds)
+      x, y, width, height = tile
+      with self.lock:
+        if self.image is None:
+          self.image = numpy.zeros((self.filmSize[1], self.filmSize[0], pixels.shape[2]), dtype=numpy.uint8)
+        self.image[y:y + height, x:x + width] = pixels
+        statistics = self.statistics[host]
+        statistics['tiles'] += 1
+        statistics['seconds'] += seconds
+        self.tilesDone += 1
+        self.inFlight -= 1
+        tilesDone = self.tilesDone
+      if progressCallback:
+        try:
+          progressCallback(tilesDone, numberOfTiles)
+        except ExposureRenderJobCancelled as e:
+          with self.lock:
+            self.cancelled = e
+          return
+
+  def render(self, progressCallback=None):
+    """Renders all tiles and returns image. progressCallback(tilesDone, tilesTotal) is called
+    from the worker threads, raising ExposureRenderJobCancelled in it stops all of them.
+    """
+    tiles = self.getTiles()
+    self.deal(tiles)
+    threads = []
+    for host in self.hosts:
+      thread = threading.Thread(target=self.work, args=(host, progressCallback))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+    if self.cancelled:
+      raise self.cancelled
+    if self.tilesDone < len(tiles):
+      raise IOError('Rendering tiles failed on all hosts: %s' % ', '.join(
+        '%s: %s' % (host, error) for host, error in self.failed.items()))
+    logging.info('Rendered %d tiles: %s' % (len(tiles), ', '.join('%s %d (%d stolen)' % (
+      host, self.statistics[host]['tiles'], self.statistics[host]['stolen']) for host in self.hosts)))
+    return self.image
+
+  def getImageData(self):
+    """Returns image as vtkImageData laid out like the frames of ExposureRenderFrameReceiver.
+    """
+    height, width, components = self.image.shape
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(width, height, 1)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(self.image.reshape(-1, components), deep=1))
+    return imageData
+
+#
+# ExposureRenderBatch
+#
+
+class ExposureRenderBatch(object):
+  """Renders every volume of a manifest with every appearance preset from every camera pose,
+  without the widget, e.g. from the Python console:
+    import ExposureRenderLink
+    batch = ExposureRenderLink.ExposureRenderBatch('/data/cohort.json')
+    index = batch.run()
+  The manifest (a dict or a JSON file name) holds
+    output        directory for the exports, the renders and index.json
+    exposurePath  directory of ExposureRender.exe
+    volumes       file names to load, or dicts of name and node (node, ID or name) or path
+    presets       volume rendering preset names, .vp file names, or dicts of name and
+                  node, preset or path
+    cameras       camera paths as dicts of name and poses (dicts of position, focalPoint,
+                  viewUp and viewAngle) or node, default: the 'Default Scene Camera'
+  and optionally renderers (instances run at once, default 2), renderSeconds (after which
+  a renderer that did not exit on its own is stopped), compressionLevel, filmSize, crop and
+  scalarType (see ExposureRenderLinkLogic.runCLI and prepareExport).
+  Every render gets its own directory with the presets and a volume.mhd pointing at the
+  shared export of its volume: exports are written once per distinct voxel content (see
+  ExposureRenderChangeTracker.hashVolume) on a background thread, so the next volume is
+  exported while the renders of the previous one run. index.json lists exports and renders.
+  """
+
+  # seconds between polls of the renderers
+  pollInterval = 0.1
+
+  def __init__(self, manifest, logic=None):
+    if isinstance(manifest, basestring):
+      with open(manifest) as fp:
+        manifest = json.load(fp)
+    self.manifest = manifest
+    self.logic = logic or ExposureRenderLinkLogic()
+    self.output = manifest['output']
+    self.exposurePath = manifest.get('exposurePath', '')
+    self.renderers = manifest.get('renderers', 2)
+    self.renderSeconds = manifest.get('renderSeconds')
+    self.exports = OrderedDict() # volume hash -> export record
+    self.pending = []
+    self.running = []
+    self.renders = []
+    self.cancelEvent = threading.Event()
+
+  def cancel(self):
+    self.cancelEvent.set()
+
+  def getVolume(self, entry):
+    """Returns name, volume node and whether the batch loaded it for a volumes entry.
+    """
+    if isinstance(entry, basestring):
+      entry = {'path': entry}
+    if 'path' in entry:
+      loaded, node = slicer.util.loadVolume(entry['path'], returnNode=True)
+      if not loaded:
+        raise IOError('Could not load volume ' + entry['path'])
+      name = os.path.splitext(os.path.basename(entry['path']))[0]
+      return entry.get('name', name), node, True
+    node = entry['node']
+    if isinstance(node, basestring):
+      node = slicer.util.getNode(node)
+    return entry.get('name') or node.GetName(), node, False
+
+  def getPreset(self, entry):
+    """Returns name and volume property node for a presets entry.
+    """
+    if isinstance(entry, basestring):
+      entry = {'path': entry} if os.path.exists(entry) else {'preset': entry}
+    if 'path' in entry:
+      loaded, node = slicer.util.loadNodeFromFile(entry['path'], 'TransferFunctionFile', {}, True)
+      if not loaded:
+        raise IOError('Could not load preset ' + entry['path'])
+      return entry.get('name', os.path.splitext(os.path.basename(entry['path']))[0]), node
+    if 'preset' in entry:
+      node = slicer.modules.volumerendering.logic().GetPresetByName(entry['preset'])
+      if not node:
+        raise ValueError('Unknown volume rendering preset ' + entry['preset'])
+      return entry.get('name', entry['preset']), node
+    node = entry['node']
+    if isinstance(node, basestring):
+      node = slicer.util.getNode(node)
+    return entry.get('name') or node.GetName(), node
+
+  def getCameraNodes(self, entry):
+    """Returns the camera nodes of the poses of a cameras entry.
+    """
+    if 'poses' not in entry:
+      node = entry.get('node', 'Default Scene Camera')
+      return [slicer.util.getNode(node) if isinstance(node, basestring) else node]
+    cameraNodes = []
+    for pose in entry['poses']:
+      cameraNode = slicer.vtkMRMLCameraNode()
+      cameraNode.SetPosition(*pose['position'])
+      cameraNode.SetFocalPoint(*pose.get('focalPoint', (0, 0, 0)))
+      cameraNode.SetViewUp(*pose.get('viewUp', (0, 0, 1)))
+      cameraNode.SetViewAngle(pose.get('viewAngle', 30))
+      cameraNodes.append(cameraNode)
+    return cameraNodes
+
+  def startRenderer(self, args, cwd):
+    """Starts one renderer, returns an object with poll and terminate like subprocess.Popen.
+    """
+    return subprocess.Popen(args, cwd=cwd)
+
+  def exportShared(self, imageData, filename, compressionLevel):
+    with pipelineInstrumentation.stage('batch export') as stage:
+      stats = self.logic.exportVolume(imageData, filename, compressionLevel)
+      stage.numberOfBytes = stats['bytesWritten']
+    return stats
+
+  def queueVolume(self, volumeName, volumeNode, presets, cameras, exportPool):
+    """Exports volumeNode once per distinct prepared volume and queues its renders,
+    returns the pending exports.
+    """
+    manifest = self.manifest
+    tracker = exposureRenderChangeTracker
+    filmSize = manifest.get('filmSize')
+    exports = []
+    for presetName, presetNode in presets:
+      export = self.logic.prepareExport(volumeNode, presetNode, manifest.get('crop'), manifest.get('scalarType'))
+      imageData = export['imageData']
+      voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+      volumeLayout = json.dumps(self.logic.getVolumeHeaders(imageData), sort_keys=True)
+      volumeHash = tracker.hashVolume(voxels, volumeLayout, export['volumeKey'])
+      if volumeHash not in self.exports:
+        filename = os.path.join(self.output, 'volumes', volumeHash[:16] + '.mhd')
+        self.exports[volumeHash] = {
+          'hash': volumeHash,
+          'volume': volumeName,
+          'filename': filename,
+          'result': exportPool.apply_async(self.exportShared, (imageData, filename, manifest.get('compressionLevel', 0)))
+        }
+      exports.append(self.exports[volumeHash])
+      lutXML = self.logic.getLUTDataAsXML(presetNode, export['intensityRange'])
+      for cameraName, cameraNodes in cameras:
+        for poseIndex, cameraNode in enumerate(cameraNodes):
+          directory = os.path.join(self.output, 'renders', volumeName, presetName, '%s_%03d' % (cameraName, poseIndex))
+          if not os.path.isdir(directory):
+            os.makedirs(directory)
+          presetFiles = (('AppearancePresets.xml', lutXML),
+                         ('CameraPresets.xml', self.logic.getCameraDataAsXML(export['bounds'], filmSize, cameraNode)))
+          for name, xml in presetFiles:
+            with open(os.path.join(directory, name), 'w') as fp:
+              fp.write(xml)
+          self.pending.append({
+            'volume': volumeName,
+            'preset': presetName,
+            'camera': cameraName,
+            'pose': poseIndex,
+            'directory': directory,
+            'export': self.exports[volumeHash]
+          })
+    return exports
+
+  def linkVolume(self, render):
+    """Writes the volume.mhd of a render, a copy of the shared header with a relative data file.
+    """
+    filename = render['export']['filename']
+    with open(filename) as fp:
+      header = fp.read().splitlines()
+    dataFile = os.path.join(os.path.dirname(filename), header[-1].split(' = ', 1)[1])
+    header[-1] = 'ElementDataFile = %s' % os.path.relpath(dataFile, render['directory']).replace(os.sep, '/')
+    with open(os.path.join(render['directory'], 'volume.mhd'), 'w') as fp:
+      fp.write('\n'.join(header) + '\n')
+
+  def launch(self, render):
+    self.linkVolume(render)
+    args = [os.path.join(self.exposurePath, 'ExposureRender.exe'), render['directory']]
+    render['startTime'] = time.time()
+    render['process'] = self.startRenderer(args, self.exposurePath or None)
+    self.running.append(render)
+
+  def finish(self, render, state, error=None):
+    render['state'] = state
+    render['error'] = error and str(error)
+    if 'startTime' in render:
+      render['seconds'] = time.time() - render.pop('startTime')
+    process = render.pop('process', None)
+    render['returnCode'] = process.poll() if process else None
+    render['image'] = self.saveImage(render['directory'])
+    logging.info('Render %s/%s/%s %d %s' % (render['volume'], render['preset'], render['camera'], render['pose'], state))
+    self.renders.append(render)
+
+  def saveImage(self, directory):
+    """Converts the last frame.bin written to directory into image.png, returns its name or None.
+    """
+    receiver = ExposureRenderFrameReceiver(dataSharePath=directory)
+    try:
+      if not receiver.fetchFile() or not receiver.update():
+        return None
+    except IOError:
+      return None
+    flip = vtk.vtkImageFlip()
+    flip.SetFilteredAxis(1) # frames are stored from the top row
+    flip.SetInputData(receiver.imageData)
+    writer = vtk.vtkPNGWriter()
+    writer.SetFileName(os.path.join(directory, 'image.png'))
+    writer.SetInputConnection(flip.GetOutputPort())
     writer.Write()
+    return 'image.png'
+
+  def pump(self):
+    """Collects finished renderers and starts queued renders whose export is written,
+    keeping at most renderers running. Returns whether anything is left to do.
+    """
+    for render in list(self.running):
+      stopped = self.cancelEvent.is_set() or (
+        self.renderSeconds is not None and time.time() - render['startTime'] > self.renderSeconds)
+      if render['process'].poll() is None and not stopped:
+        continue
+      if render['process'].poll() is None:
+        render['process'].terminate()
+      self.running.remove(render)
+      if self.cancelEvent.is_set():
+        self.finish(render, 'cancelled')
+      else:
+        self.finish(render, 'done' if stopped or render['process'].poll() == 0 else 'failed')
+    while self.pending and (self.cancelEvent.is_set() or len(self.running) < self.renderers):
+      render = self.pending[0]
+      result = render['export']['result']
+      if not self.cancelEvent.is_set() and not result.ready():
+        break # exports finish in queue order, so do the renders waiting for them
+      self.pending.pop(0)
+      if self.cancelEvent.is_set():
+        self.finish(render, 'cancelled')
+      elif not result.successful():
+        try:
+          result.get()
+        except Exception as e:
+          self.finish(render, 'failed', e)
+      else:
+        try:
+          self.launch(render)
+        except OSError as e:
+          self.finish(render, 'failed', e)
+    return bool(self.pending or self.running)
+
+  def waitFor(self, exports):
+    while not all(export['result'].ready() for export in exports) and not self.cancelEvent.is_set():
+      self.pump()
+      slicer.app.processEvents()
+      time.sleep(self.pollInterval)
+
+  def run(self):
+    """Renders the whole manifest, returns the results index (also written to index.json).
+    Blocks, but keeps the application responsive while waiting.
+    """
+    manifest = self.manifest
+    for directory in ('volumes', 'renders'):
+      if not os.path.isdir(os.path.join(self.output, directory)):
+        os.makedirs(os.path.join(self.output, directory))
+    presets = [self.getPreset(entry) for entry in manifest['presets']]
+    cameras = [(entry.get('name', 'camera%d' % index), self.getCameraNodes(entry))
+               for index, entry in enumerate(manifest.get('cameras') or [{'name': 'default'}])]
+    # one export at a time, while the renders of the previous volume run
+    exportPool = ThreadPool(1)
+    startTime = time.time()
+    try:
+      previousExports = []
+      for entry in manifest['volumes']:
+        if self.cancelEvent.is_set():
+          break
+        volumeName, volumeNode, loaded = self.getVolume(entry)
+        exports = self.queueVolume(volumeName, volumeNode, presets, cameras, exportPool)
+        if loaded:
+          slicer.mrmlScene.RemoveNode(volumeNode)
+          volumeStatisticsCache.invalidate(volumeNode)
+        # at most one volume exported ahead of the renders
+        self.waitFor(previousExports)
+        previousExports = exports
+      while self.pump():
+        slicer.app.processEvents()
+        time.sleep(self.pollInterval)
+    finally:
+      exportPool.close()
+      exportPool.join()
+    return self.writeIndex(time.time() - startTime)
+
+  def writeIndex(self, seconds):
+    exports = []
+    for export in self.exports.values():
+      record = {'hash': export['hash'], 'volume': export['volume'],
+                'filename': os.path.relpath(export['filename'], self.output)}
+      if export['result'].ready() and export['result'].successful():
+        record.update(export['result'].get())
+      exports.append(record)
+    renders = []
+    for render in self.renders:
+      render = dict(render)
+      render['volumeHash'] = render.pop('export')['hash']
+      render['directory'] = os.path.relpath(render['directory'], self.output)
+      renders.append(render)
+    index = {
+      'manifest': dict((key, value) for key, value in self.manifest.items() if isinstance(value, (basestring, int, float, list))),
+      'seconds': seconds,
+      'exports': exports,
+      'renders': renders
+    }
+    with open(os.path.join(self.output, 'index.json'), 'w') as fp:
+      json.dump(index, fp, indent=2, default=str)
+    return index
+
+#
+# ExposureRenderHTTPClient
+#
+
+class ExposureRenderHTTPError(IOError):
+  """The host answered with an HTTP error status.
+  """
+  pass
+
+class ExposureRenderHTTPClient(object):
+  """Persistent HTTP/1.1 connection to an ExposureRender host ("IP:Port").
+  Clients are pooled per host (see forHost), so consecutive sends reuse the same
+  keep-alive connection. NumPy array bodies are streamed straight from their
+  buffer with chunked transfer encoding.
+  What the host received is forgotten (see ExposureRenderChangeTracker) when the session
+  id the host reports in the X-ExposureRender-Session header changes, i.e. the renderer
+  was restarted (see checkSession). Hosts without session ids are forgotten whenever the connection has to be
+  reopened after a failure. resets counts how often that happened.
+  """
+
+  pool = {}
+  poolLock = threading.Lock()
+  # bytes per chunk of a streamed body
+  chunkSize = 1 << 20
+
+  @classmethod
+  def forHost(cls, host):
+    """Returns the pooled client for host, creating it on first use.
+    """
+    with cls.poolLock:
+      client = cls.pool.get(host)
+      if client is None:
+        client = cls.pool[host] = cls(host)
+      return client
+
+  def __init__(self, host, timeout=60):
+    self.host = host
+    self.timeout = timeout
+    self.connection = None
+    self.broken = False
+    self.session = None
+    self.resets = 0
+    # requests on one connection must not interleave
+    self.lock = threading.Lock()
+
+  def close(self):
+    if self.connection:
+      self.connection.close()
+      self.connection = None
+
+  def request(self, method, path, body=b'', headers=None, progressCallback=None):
+    """Sends a request and returns the response body, raises ExposureRenderHTTPError on HTTP errors.
+    If the kept-alive connection was dropped by the host, the request is repeated
+    once on a new connection.
+    """
+    with self.lock:
+      for attempt in range(2):
+        reused = self.connection is not None
+        if not reused:
+          if self.broken and self.session is None:
+            # the host may have been restarted, without a session id there is no telling
+            self.resetHost()
+          self.broken = False
+          self.connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        try:
+          return self.sendRequest(method, path, body, headers or {}, progressCallback)
+        except ExposureRenderHTTPError:
+          # the response was read completely, the connection can be kept
+          raise
+        except (httplib.HTTPException, socket.error):
+          self.close()
+          self.broken = True
+          if not reused or attempt > 0:
+            raise
+        except:
+          # e.g. a cancelled upload, which leaves the connection in the middle of a request
+          self.close()
+          self.broken = True
+          raise
+
+  def checkSession(self):
+    """Asks the host for its session id (GET /session), so that a restart is noticed even
+    if nothing else is requested. Hosts that do not know the request are fine.
+    """
+    try:
+      self.request('GET', '/session')
+    except ExposureRenderHTTPError:
+      pass
+
+  def resetHost(self):
+    exposureRenderChangeTracker.forget('http://' + self.host)
+    self.resets += 1
+
+  def sendRequest(self, method, path, body, headers, progressCallback):
+    connection = self.connection
+    connection.putrequest(method, path, skip_accept_encoding=True)
+    for name, value in headers.items():
+      connection.putheader(name, value)
+    if isinstance(body, numpy.ndarray):
+      data = body.reshape(-1).view(numpy.uint8)
+      bytesTotal = data.shape[0]
+      connection.putheader('Transfer-Encoding', 'chunked')
+      connection.endheaders()
+      for start in range(0, bytesTotal, self.chunkSize):
+        chunk = data[start:start + self.chunkSize]
+        connection.send(('%x\r\n' % chunk.shape[0]).encode('ascii'))
+        connection.send(chunk)
+        connection.send(b'\r\n')
+        if progressCallback:
+          progressCallback(start + chunk.shape[0], bytesTotal)
+      connection.send(b'0\r\n\r\n')
+    else:
+      connection.putheader('Content-Length', str(len(body)))
+      connection.endheaders()
+      connection.send(body)
+    response = connection.getresponse()
+    data = response.read()
+    session = response.getheader('X-ExposureRender-Session')
+    if self.session is not None and session != self.session:
+      self.resetHost()
+    self.session = session
+    if response.status >= 400:
+      raise ExposureRenderHTTPError('%s %s failed: %d %s' % (method, path, response.status, response.reason))
+    return data
+
+#
+# ExposureRenderSharedMemory
+#
+
+class ExposureRenderSharedMemory(object):
+  """Named shared memory segment through which a renderer on the same host maps the volume,
+  the LUT and the camera without any file or socket in between. On Windows it is a named
+  file mapping (tagname), elsewhere a file in /dev/shm (or the temporary directory).
+  The segment starts with a header (magic 'ERSM', little endian uint32 layout version and
+  number of sections, uint64 total size and generation) followed by one table entry per
+  section (8 byte name, uint64 offset, capacity, size and version) and the 64 byte aligned
+  sections:
+    layout  volume layout as JSON of the X-* headers (see getVolumeHeaders)
+    lut     AppearancePresets XML, or the binary LUT (see getLUTDataAsBinary)
+    camera  CameraPresets XML
+    volume  raw voxels, up to the end of the segment
+  The generation is odd while a publish writes and even when it is done, readers retry until
+  they read the same even generation before and after. A section's version only increases
+  when its content changed. Segments are pooled per name (see forName) and stay mapped, so
+  the renderer can keep its mapping; a segment too small for a new volume is replaced by a
+  new one, the old one gets a total size of 0 so that readers map the new one, and the section
+  versions carry on. On Windows a mapping can not grow while the renderer has it open, pass a
+  large enough capacity to forName there.
+  """
+
+  magic = b'ERSM'
+  layoutVersion = 1
+  headerFormat = '<4sIIQQ'
+  headerSize = struct.calcsize(headerFormat)
+  sectionFormat = '<8sQQQQ'
+  sectionSize = struct.calcsize(sectionFormat)
+  sectionNames = ('layout', 'lut', 'camera', 'volume')
+  alignment = 64
+  # bytes copied per step of a volume publish
+  chunkSize = 1 << 24
+
+  pool = {}
+  poolLock = threading.Lock()
+
+  @classmethod
+  def forName(cls, name, capacity=0):
+    """Returns the pooled segment called name, creating it on first use. capacity is the
+    least total size in bytes the mapping is (re)created with, the largest one asked for counts.
+    """
+    with cls.poolLock:
+      segment = cls.pool.get(name)
+      if segment is None:
+        segment = cls.pool[name] = cls(name, capacity)
+      segment.capacity = max(segment.capacity, capacity)
+      return segment
+
+  @classmethod
+  def getFilename(cls, name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+  def __init__(self, name, capacity=0):
+    self.name = name
+    self.capacity = capacity
+    self.mapping = None
+    self.fp = None
+    self.sections = OrderedDict()
+    self.generation = 0
+    # publishes to one segment must not interleave
+    self.lock = threading.Lock()
+
+  @property
+  def destination(self):
+    return 'shm://' + self.name
+
+  def align(self, size):
+    return (size + self.alignment - 1) // self.alignment * self.alignment
+
+  def allocate(self, capacities):
+    """(Re)creates the mapping with sections of at least the given capacities (name -> bytes).
+    """
+    if self.mapping is not None:
+      # a total size of 0 tells readers of the old segment to map the new one
+      self.totalSize = 0
+      self.writeHeader()
+      self.close(unlink=True)
+    offset = self.align(self.headerSize + len(self.sectionNames) * self.sectionSize)
+    for name in self.sectionNames:
+      old = self.sections.get(name, {'capacity': 0, 'version': 0})
+      capacity = max(capacities.get(name, 0), old['capacity'])
+      # a reader that kept a version must see the republished section as newer
+      self.sections[name] = {'offset': offset, 'capacity': self.align(max(capacity, 4096)), 'size': 0, 'version': old['version']}
+      offset += self.sections[name]['capacity']
+    totalSize = max(offset, self.capacity)
+    self.sections['volume']['capacity'] += totalSize - offset
+    if sys.platform == 'win32':
+      self.mapping = mmap.mmap(-1, totalSize, tagname=self.name)
+    else:
+      self.fp = open(self.getFilename(self.name), 'w+b')
+      self.fp.truncate(totalSize)
+      self.mapping = mmap.mmap(self.fp.fileno(), totalSize)
+    if len(self.mapping) < offset:
+      raise ValueError('Shared memory %s is %d bytes, %d needed' % (self.name, len(self.mapping), offset))
+    self.totalSize = totalSize
+    self.writeHeader()
+    for index, name in enumerate(self.sectionNames):
+      self.writeSection(index, name)
+    # the renderer does not have any of the old content anymore
+    exposureRenderChangeTracker.forget(self.destination)
+
+  def writeHeader(self):
+    struct.pack_into(self.headerFormat, self.mapping, 0, self.magic, self.layoutVersion,
+                     len(self.sectionNames), self.totalSize, self.generation)
+
+  def writeSection(self, index, name):
+    section = self.sections[name]
+    struct.pack_into(self.sectionFormat, self.mapping, self.headerSize + index * self.sectionSize,
+                     name.encode('ascii'), section['offset'], section['capacity'], section['size'], section['version'])
+
+  def publish(self, parts, progressCallback=None):
+    """Writes the changed parts, a dict of section name -> bytes or NumPy array, and bumps
+    their versions. Unchanged parts (see ExposureRenderChangeTracker) are skipped,
+    the volume hash is expected under 'volumeHash' to spare hashing it again.
+    progressCallback(bytesDone, bytesTotal) is called while the volume is copied.
+    """
+    tracker = exposureRenderChangeTracker
+    parts = dict(parts)
+    volumeHash = parts.pop('volumeHash', None)
+    with self.lock:
+      if self.mapping is None or any(self.sections[name]['capacity'] < self.getSize(data) for name, data in parts.items()):
+        # room for growing LUTs and cameras without recreating the segment
+        self.allocate(dict((name, self.getSize(data) * (1 if name == 'volume' else 4)) for name, data in parts.items()))
+      hashes = dict((name, volumeHash if name == 'volume' and volumeHash else tracker.hashBytes(self.getBytes(data)))
+                    for name, data in parts.items())
+      changed = [name for name in self.sectionNames if name in parts and tracker.hasChanged(self.destination, name, hashes[name])]
+      if not changed:
+        return changed
+      self.generation += 1 # odd: being written
+      self.writeHeader()
+      for name in changed:
+        self.writeData(self.sections[name], parts[name], progressCallback if name == 'volume' else None)
+        self.sections[name]['version'] += 1
+        self.writeSection(self.sectionNames.index(name), name)
+      self.generation += 1
+      self.writeHeader()
+      self.mapping.flush()
+      for name in changed:
+        tracker.markSent(self.destination, name, hashes[name])
+      return changed
+
+  def getSize(self, data):
+    return data.nbytes if isinstance(data, numpy.ndarray) else len(data)
+
+  def getBytes(self, data):
+    return data.reshape(-1).view(numpy.uint8) if isinstance(data, numpy.ndarray) else data
+
+  def writeData(self, section, data, progressCallback=None):
+    data = self.getBytes(data)
+    size = len(data)
+    self.mapping.seek(section['offset'])
+    for start in range(0, size, self.chunkSize):
+      self.mapping.write(data[start:start + self.chunkSize])
+      if progressCallback:
+        progressCallback(min(start + self.chunkSize, size), size)
+    section['size'] = size
+
+  def close(self, unlink=False):
+    if self.mapping is not None:
+      self.mapping.close()
+      self.mapping = None
+    if self.fp is not None:
+      self.fp.close()
+      self.fp = None
+      if unlink:
+        os.remove(self.getFilename(self.name))
+
+#
+# ExposureRenderStandInServer
+#
+
+class ExposureRenderStandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connectionCount += 1
+    self.server.connections.append(self.request)
+
+  def log_message(self, format, *args):
+    logging.debug('ExposureRender stand-in: ' + format % args)
+
+  def readBody(self):
+    if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+      return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    chunks = []
+    while True:
+      size = int(self.rfile.readline().split(b';')[0], 16)
+      if size == 0:
+        self.rfile.readline()
+        return b''.join(chunks)
+      chunks.append(self.rfile.read(size))
+      self.rfile.readline()
+
+  def sendResponseBody(self, status, body=b''):
+    self.send_response(status)
+    if self.server.session:
+      self.send_header('X-ExposureRender-Session', self.server.session)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_PUT(self):
+    headers = dict((name.lower(), value) for name, value in self.headers.items())
+    self.server.received[self.path] = (headers, self.readBody())
+    self.server.requests.append((self.command, self.path, headers))
+    self.sendResponseBody(200)
+
+  def do_POST(self):
+    if self.path != '/tile':
+      self.do_PUT()
+      return
+    tile = json.loads(self.readBody().decode('utf-8'))
+    self.server.tiles.append(tile)
+    time.sleep(self.server.tileDelay)
+    pixels = self.server.renderTile(tile['x'], tile['y'], tile['width'], tile['height'])
+    self.sendResponseBody(200, ExposureRenderFrameReceiver.packFrame(pixels, 1))
+
+  def do_GET(self):
+    if self.path == '/session' and self.server.session:
+      self.sendResponseBody(200, self.server.session.encode('ascii'))
+      return
+    if self.path not in self.server.received:
+      self.sendResponseBody(404)
+      return
+    self.sendResponseBody(200, self.server.received[self.path][1])
+
+class ExposureRenderStandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Local stand-in for an ExposureRender host, used by the tests.
+  It stores the body and headers of every PUT/POST by path in received,
+  returns them on GET, lists (method, path, headers) of all PUTs/POSTs in requests
+  and counts the connections it accepted. POST /tile is answered with the pixels of
+  renderTile after tileDelay seconds, the requested tiles are listed in tiles.
+  Every response carries the session id of the server, set session to None to leave it out.
+  Call start() to serve from a background thread and shutdown() to stop, or stop() to
+  also drop the open connections like a renderer that exits.
+  """
+  daemon_threads = True
+
+  def __init__(self, port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), ExposureRenderStandInRequestHandler)
+    self.received = {}
+    self.requests = []
+    self.connectionCount = 0
+    self.tiles = []
+    self.tileDelay = 0.0
+    self.connections = []
+    self.session = hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+
+  @property
+  def host(self):
+    return '%s:%d' % self.server_address
+
+  @staticmethod
+  def renderTile(x, y, width, height):
+    """Returns the RGB pixels of a tile of the stand-in frame, a pattern of the film coordinates.
+    """
+    rows, columns = numpy.mgrid[y:y + height, x:x + width]
+    pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    pixels[..., 0] = columns % 256
+    pixels[..., 1] = rows % 256
+    pixels[..., 2] = (columns + rows) % 251
+    return pixels
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+    for connection in self.connections:
+      try:
+        connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+class ExposureRenderSharedMemoryReader(object):
+  """Local stand-in for the renderer side of ExposureRenderSharedMemory, used by the tests.
+  read returns the sections as views into the mapping, nothing is copied.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.mapping = None
+    self.fp = None
+
+  def open(self):
+    if sys.platform == 'win32':
+      self.mapping = mmap.mmap(-1, ExposureRenderSharedMemory.headerSize, tagname=self.name)
+      totalSize = self.readHeader()[3]
+      self.mapping.close()
+      self.mapping = mmap.mmap(-1, totalSize, tagname=self.name)
+    else:
+      self.fp = open(ExposureRenderSharedMemory.getFilename(self.name), 'r+b')
+      self.mapping = mmap.mmap(self.fp.fileno(), 0)
+
+  def close(self):
+    self.mapping.close()
+    if self.fp:
+      self.fp.close()
+
+  def readHeader(self):
+    header = struct.unpack_from(ExposureRenderSharedMemory.headerFormat, self.mapping, 0)
+    if header[0] != ExposureRenderSharedMemory.magic:
+      raise IOError('Not an ExposureRender shared memory segment')
+    return header
+
+  def read(self, timeout=5.0):
+    """Returns the generation and a dict of section name -> (version, uint8 array view),
+    consistent with each other. Remaps if the segment was recreated.
+    """
+    endTime = time.time() + timeout
+    while time.time() < endTime:
+      if self.mapping is None:
+        self.open()
+      magic, layoutVersion, numberOfSections, totalSize, generation = self.readHeader()
+      if totalSize != len(self.mapping):
+        self.close()
+        self.mapping = None
+        continue
+      if generation % 2:
+        time.sleep(0.001)
+        continue
+      sections = {}
+      for index in range(numberOfSections):
+        name, offset, capacity, size, version = struct.unpack_from(ExposureRenderSharedMemory.sectionFormat,
+          self.mapping, ExposureRenderSharedMemory.headerSize + index * ExposureRenderSharedMemory.sectionSize)
+        sections[name.rstrip(b'\0').decode('ascii')] = (version, numpy.frombuffer(self.mapping, numpy.uint8, size, offset))
+      if self.readHeader()[4] == generation:
+        return generation, sections
+    raise IOError('Shared memory %s stayed busy' % self.name)
 
-    logging.info('Call ExposureRender ' + exposurePath)
-    args = [exposurePath+'/ExposureRender.exe', dataSharePath]
-    subprocess.Popen(args, cwd=exposurePath)
-    logging.info('Processing completed')
-    return True
 
 
 class ExposureRenderLinkTest(ScriptedLoadableModuleTest):
@@ -370,6 +2818,30 @@ class ExposureRenderLinkTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ExposureRenderLink1()
+    self.setUp()
+    self.test_ExposureRenderLinkHTTP()
+    self.setUp()
+    self.test_ExposureRenderLinkExport()
+    self.setUp()
+    self.test_ExposureRenderLinkJobs()
+    self.setUp()
+    self.test_ExposureRenderLinkFrames()
+    self.setUp()
+    self.test_ExposureRenderLinkLUT()
+    self.setUp()
+    self.test_ExposureRenderLinkCamera()
+    self.setUp()
+    self.test_ExposureRenderLinkPyramid()
+    self.setUp()
+    self.test_ExposureRenderLinkPrepareExport()
+    self.setUp()
+    self.test_ExposureRenderLinkBatch()
+    self.setUp()
+    self.test_ExposureRenderLinkSharedMemory()
+    self.setUp()
+    self.test_ExposureRenderLinkDistributed()
+    self.setUp()
+    self.test_ExposureRenderLinkCLI()
 
   def test_ExposureRenderLink1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -406,3 +2878,625 @@ class ExposureRenderLinkTest(ScriptedLoadableModuleTest):
     logic = ExposureRenderLinkLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkHTTP(self):
+    """ Sends a synthetic volume and both presets to a local stand-in server.
+    """
+    self.delayDisplay("Starting the HTTP test")
+    server = ExposureRenderStandInServer().start()
+    try:
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(64, 48, 32)
+      voxels = numpy.arange(64 * 48 * 32, dtype=numpy.int16)
+      imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels))
+
+      logic = ExposureRenderLinkLogic()
+      ExposureRenderHTTPClient.chunkSize = 10000 # several chunks
+      progress = []
+      stages = []
+      pipelineInstrumentation.addCollector(stages.append)
+      pipelineInstrumentation.enabled = True
+      for send in range(2):
+        logic.sendHTTP(server.host, voxels, logic.getVolumeHeaders(imageData), '<Appearance/>', '<Camera/>',
+          lambda sent, total: progress.append((sent, total)))
+        self.assertIsNone(logic.transferError)
+
+      headers, body = server.received['/volume']
+      self.assertEqual(body, voxels.tobytes())
+      self.assertEqual(headers['x-dimensions'], '64 48 32')
+      self.assertEqual(headers['x-scalar-type'], 'short')
+      self.assertEqual(server.received['/camera'][1], b'<Camera/>')
+      self.assertEqual(progress[-1], (voxels.nbytes, voxels.nbytes))
+      # both sends went over the same kept-alive connection
+      self.assertEqual(server.connectionCount, 1)
+      # the second send only hashed the volume
+      self.assertEqual([stage['stage'] for stage in stages],
+        ['hash volume', 'upload volume', 'upload appearance', 'upload camera', 'hash volume'])
+      self.assertEqual(stages[1]['bytes'], voxels.nbytes)
+
+      # only the changed camera is sent again
+      del server.received['/volume']
+      logic.sendHTTP(server.host, voxels, logic.getVolumeHeaders(imageData), '<Appearance/>', '<Camera Moved="1"/>')
+      self.assertNotIn('/volume', server.received)
+      self.assertEqual(server.received['/camera'][1], b'<Camera Moved="1"/>')
+
+      # a restarted renderer gets everything again: detected by its new session id,
+      # then without session ids by the connection that had to be reopened
+      client = ExposureRenderHTTPClient.forHost(server.host)
+      for session in ('new', None, None):
+        port = server.server_address[1]
+        server.stop()
+        server = ExposureRenderStandInServer(port)
+        server.session = session
+        server.start()
+        resets = client.resets
+        logic.sendHTTP(server.host, voxels, logic.getVolumeHeaders(imageData), '<Appearance/>', '<Camera Moved="1"/>')
+        self.assertIsNone(logic.transferError)
+        self.assertEqual(client.resets, resets + 1)
+        self.assertEqual(sorted(server.received), ['/appearance', '/camera', '/volume'])
+        self.assertEqual(server.received['/volume'][1], voxels.tobytes())
+    finally:
+      server.shutdown()
+      exposureRenderChangeTracker.forget('http://' + server.host)
+      ExposureRenderHTTPClient.pool.pop(server.host).close()
+      ExposureRenderHTTPClient.chunkSize = 1 << 20
+      pipelineInstrumentation.enabled = False
+      pipelineInstrumentation.removeCollector(stages.append)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkExport(self):
+    """ Writes a synthetic volume uncompressed and compressed and reads both back.
+    """
+    self.delayDisplay("Starting the export test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(40, 30, 20)
+    imageData.SetSpacing(0.5, 0.5, 2.0)
+    voxels = (numpy.arange(40 * 30 * 20) % 1000).astype(numpy.uint16)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels))
+
+    logic = ExposureRenderLinkLogic()
+    logic.exportChunkSize = 5000 # several chunks
+    for compressionLevel in (0, 1):
+      filename = os.path.join(slicer.app.temporaryPath, 'ExposureRenderLinkExport%d.mhd' % compressionLevel)
+      stats = logic.exportVolume(imageData, filename, compressionLevel)
+      self.assertEqual(stats['rawBytes'], voxels.nbytes)
+      if compressionLevel:
+        self.assertLess(stats['bytesWritten'], voxels.nbytes)
+
+      reader = vtk.vtkMetaImageReader()
+      reader.SetFileName(filename)
+      reader.Update()
+      self.assertEqual(reader.GetOutput().GetDimensions(), (40, 30, 20))
+      self.assertEqual(reader.GetOutput().GetSpacing(), (0.5, 0.5, 2.0))
+      readVoxels = numpy_support.vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars())
+      self.assertTrue((readVoxels == voxels).all())
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkJobs(self):
+    """ Runs, cancels and fails jobs on a job manager and reuses a running renderer.
+    """
+    self.delayDisplay("Starting the job test")
+    manager = ExposureRenderJobManager()
+    stagesRun = []
+    job = manager.submit(ExposureRenderJob('ordered', [
+      ('first', lambda job: stagesRun.append('first')),
+      ('second', lambda job: stagesRun.append('second'))]))
+    self.assertTrue(job.wait(10))
+    self.assertEqual(job.state, 'done')
+    self.assertEqual(stagesRun, ['first', 'second'])
+    self.assertEqual(list(job.timings.keys()), ['first', 'second'])
+
+    # a running stage ends at its next progress report after cancel
+    started = threading.Event()
+    def longStage(job):
+      started.set()
+      for step in range(1000):
+        job.reportProgress(step, 1000)
+        time.sleep(0.01)
+    job = manager.submit(ExposureRenderJob('cancelled', [('long', longStage), ('never', lambda job: stagesRun.append('never'))]))
+    self.assertTrue(started.wait(10))
+    job.cancel()
+    self.assertTrue(job.wait(10))
+    self.assertEqual(job.state, 'cancelled')
+    self.assertNotIn('never', stagesRun)
+
+    def failingStage(job):
+      raise IOError('share not writable')
+    job = manager.submit(ExposureRenderJob('failing', [('write', failingStage)]))
+    self.assertTrue(job.wait(10))
+    self.assertEqual(job.state, 'failed')
+    self.assertIsInstance(job.error, IOError)
+
+    # a renderer that is still running is not started again
+    class RunningProcess(object):
+      pid = 0
+      def poll(self):
+        return None
+    process = RunningProcess()
+    manager.processes[('ExposureRender.exe', 'share')] = process
+    self.assertIs(manager.launchRenderer(['ExposureRender.exe', 'share']), process)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkFrames(self):
+    """ Receives frames from the data share and over HTTP into the same image buffer.
+    """
+    self.delayDisplay("Starting the frame test")
+    frame = numpy.random.randint(0, 256, size=(30, 40, 3)).astype(numpy.uint8)
+    dataSharePath = slicer.app.temporaryPath
+    frameFilename = os.path.join(dataSharePath, 'frame.bin')
+    with open(frameFilename, 'wb') as fp:
+      fp.write(ExposureRenderFrameReceiver.packFrame(frame, 1))
+
+    receiver = ExposureRenderFrameReceiver(dataSharePath=dataSharePath)
+    self.assertFalse(receiver.update())
+    self.assertTrue(receiver.fetch())
+    self.assertFalse(receiver.fetch()) # file unchanged
+    self.assertTrue(receiver.update())
+    self.assertEqual(receiver.iteration, 1)
+    self.assertEqual(receiver.imageData.GetDimensions(), (40, 30, 1))
+    pixels = numpy_support.vtk_to_numpy(receiver.imageData.GetPointData().GetScalars())
+    self.assertTrue((pixels.reshape(30, 40, 3) == frame).all())
+
+    # a frame still being written leaves the unshown complete one intact, whatever its size
+    nextFrame = numpy.full((30, 40, 3), 7, dtype=numpy.uint8)
+    with open(frameFilename, 'wb') as fp:
+      fp.write(ExposureRenderFrameReceiver.packFrame(nextFrame, 2))
+    self.assertTrue(receiver.fetch())
+    largerFrame = ExposureRenderFrameReceiver.packFrame(numpy.zeros((60, 80, 3), dtype=numpy.uint8), 3)
+    with open(frameFilename, 'wb') as fp:
+      fp.write(largerFrame[:len(largerFrame) // 2])
+    os.utime(frameFilename, (time.time() + 5, time.time() + 5))
+    self.assertFalse(receiver.fetch())
+    self.assertTrue(receiver.update())
+    self.assertEqual(receiver.iteration, 2)
+    pixels = numpy_support.vtk_to_numpy(receiver.imageData.GetPointData().GetScalars())
+    self.assertTrue((pixels == 7).all())
+    os.remove(frameFilename)
+
+    server = ExposureRenderStandInServer().start()
+    try:
+      client = ExposureRenderHTTPClient(server.host)
+      receiver = ExposureRenderFrameReceiver(host=server.host, maxFrameRate=100)
+      receiver.start()
+      for iteration in (1, 2):
+        frame = numpy.full((30, 40, 3), iteration, dtype=numpy.uint8)
+        client.request('PUT', '/frame', ExposureRenderFrameReceiver.packFrame(frame, iteration))
+        for attempt in range(500):
+          if receiver.update() and receiver.iteration == iteration:
+            break
+          time.sleep(0.01)
+        self.assertEqual(receiver.iteration, iteration)
+        if iteration == 1:
+          pixels = numpy_support.vtk_to_numpy(receiver.imageData.GetPointData().GetScalars())
+      # the second frame was copied into the buffer of the first
+      self.assertTrue((pixels == 2).all())
+      receiver.stop()
+      client.close()
+    finally:
+      server.shutdown()
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkLUT(self):
+    """ Samples linear and non-linear LUTs in bulk and compares them with VTK's evaluation.
+    """
+    self.delayDisplay("Starting the LUT test")
+    logic = ExposureRenderLinkLogic()
+    for sharpness in (0.0, 0.5):
+      volumeProperty = slicer.vtkMRMLVolumePropertyNode()
+      slicer.mrmlScene.AddNode(volumeProperty)
+      colorTF = volumeProperty.GetColor()
+      opacityTF = volumeProperty.GetScalarOpacity()
+      colorTF.AddRGBPoint(-100, 0.0, 0.0, 0.0)
+      colorTF.AddRGBPoint(50, 1.0, 0.5, 0.0)
+      colorTF.AddRGBPoint(300, 1.0, 1.0, 1.0)
+      opacityTF.AddPoint(0, 0.0)
+      opacityTF.AddPoint(120, 0.4, 0.5, sharpness)
+      opacityTF.AddPoint(400, 1.0)
+
+      positions, colors, opacities = logic.sampleLUT(volumeProperty)
+      self.assertEqual(positions.tolist(), [-100, 0, 50, 120, 300, 400])
+      color = [0, 0, 0]
+      for index, x in enumerate(positions.tolist()):
+        colorTF.GetColor(x, color)
+        self.assertTrue(numpy.allclose(colors[index], color))
+        self.assertAlmostEqual(opacities[index], opacityTF.GetValue(x))
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkCamera(self):
+    """ Streams camera deltas to a local stand-in server, at lower resolution while interacting.
+    """
+    self.delayDisplay("Starting the camera test")
+    server = ExposureRenderStandInServer().start()
+    cameraNode = slicer.vtkMRMLCameraNode()
+    cameraNode.SetPosition(0, -500, 0)
+    cameraNode.SetFocalPoint(0, 0, 0)
+    interactorStyle = vtk.vtkInteractorStyleTrackballCamera()
+    logic = ExposureRenderLinkLogic()
+    bounds = (0, 99, 0, 99, 0, 49)
+    sync = ExposureRenderCameraSync(logic, bounds, host=server.host)
+    try:
+      def receivedDelta():
+        self.assertTrue(sync.wait(10))
+        return json.loads(server.received['/camera/delta'][1].decode('utf-8'))
+
+      sync.start(cameraNode, interactorStyle)
+      delta = receivedDelta()
+      self.assertEqual(sorted(delta.keys()), ['film', 'focalDistance', 'fov', 'from', 'target', 'up'])
+      self.assertEqual(delta['film'], [400, 500])
+      self.assertEqual(delta['from'], [0.0, -500.0 / 99, 0.0])
+
+      cameraNode.SetPosition(0, -400, 0)
+      sync.push() # what the throttle timer does
+      self.assertEqual(sorted(receivedDelta().keys()), ['focalDistance', 'from'])
+
+      interactorStyle.InvokeEvent(vtk.vtkCommand.StartInteractionEvent)
+      sync.push()
+      self.assertEqual(receivedDelta(), {'film': [200, 250]})
+      interactorStyle.InvokeEvent(vtk.vtkCommand.EndInteractionEvent)
+      self.assertEqual(receivedDelta(), {'film': [400, 500]})
+
+      # a full send would not resend the streamed camera
+      cameraXML = logic.getCameraDataAsXML(bounds, cameraNode=cameraNode)
+      tracker = exposureRenderChangeTracker
+      self.assertFalse(tracker.hasChanged('http://' + server.host, 'camera', tracker.hashText(cameraXML)))
+
+      # a drag that modifies the camera faster than the throttle interval sends deltas before its end
+      def deltasSent():
+        return len([path for method, path, headers in server.requests if path == '/camera/delta'])
+      sentBefore = deltasSent()
+      interactorStyle.InvokeEvent(vtk.vtkCommand.StartInteractionEvent)
+      for step in range(30):
+        cameraNode.SetPosition(0, -400 + 5 * step, 0)
+        time.sleep(0.01)
+        slicer.app.processEvents()
+      self.assertTrue(sync.interacting)
+      self.assertTrue(sync.wait(10))
+      self.assertGreater(deltasSent() - sentBefore, 1)
+      self.assertTrue('from' in receivedDelta())
+      interactorStyle.InvokeEvent(vtk.vtkCommand.EndInteractionEvent)
+      self.assertEqual(receivedDelta()['film'], [400, 500])
+    finally:
+      sync.stop()
+      server.shutdown()
+      exposureRenderChangeTracker.forget('http://' + server.host)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkPyramid(self):
+    """ Downsamples a volume with odd dimensions and sends its pyramid coarsest first.
+    """
+    self.delayDisplay("Starting the pyramid test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(33, 20, 9)
+    imageData.SetSpacing(1.0, 1.0, 2.0)
+    voxels = numpy.random.randint(0, 4000, size=33 * 20 * 9).astype(numpy.int16)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+
+    logic = ExposureRenderLinkLogic()
+    logic.pyramidSlabSize = 2 # several slabs
+    pyramid = logic.getVolumePyramid(volumeNode)
+    self.assertEqual([level.GetDimensions() for level in pyramid], [(17, 10, 5), (9, 5, 3), (5, 3, 2)])
+    self.assertEqual(pyramid[0].GetSpacing(), (2.0, 2.0, 4.0))
+    self.assertEqual(pyramid[0].GetOrigin(), (0.5, 0.5, 1.0))
+    # the last block along x holds a single voxel column, the others 2 x 2 x 2 voxels
+    volume = voxels.reshape(9, 20, 33)
+    downsampled = numpy_support.vtk_to_numpy(pyramid[0].GetPointData().GetScalars()).reshape(5, 10, 17)
+    self.assertEqual(downsampled[0, 0, 0], numpy.rint(volume[0:2, 0:2, 0:2].mean()))
+    self.assertEqual(downsampled[4, 9, 16], numpy.rint(volume[8:9, 18:20, 32:33].mean()))
+    self.assertIs(logic.getVolumePyramid(volumeNode)[2], pyramid[2])
+
+    server = ExposureRenderStandInServer().start()
+    try:
+      for send in range(2):
+        logic.uploadHTTPPreviews(server.host, imageData, (volumeNode.GetID(), imageData.GetMTime()), 3, '<Appearance/>', '<Camera/>')
+        logic.uploadHTTP(server.host, voxels, logic.getVolumeHeaders(imageData), '<Appearance/>', '<Camera/>')
+      volumeDimensions = [headers['x-dimensions'] for method, path, headers in server.requests if path == '/volume']
+      # no previews for the second send of the same volume
+      self.assertEqual(volumeDimensions, ['5 3 2', '9 5 3', '17 10 5', '33 20 9'])
+    finally:
+      server.shutdown()
+      exposureRenderChangeTracker.forget('http://' + server.host)
+      ExposureRenderHTTPClient.pool.pop(server.host).close()
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkPrepareExport(self):
+    """ Crops a volume to its visible voxels and narrows it to 8 bit.
+    """
+    self.delayDisplay("Starting the prepare export test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(40, 30, 20)
+    volume = numpy.zeros((20, 30, 40), dtype=numpy.int16)
+    volume[5:12, 10:25, 3:30] = 1000
+    volume[6, 12, 4] = 2000
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.reshape(-1)))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeProperty = slicer.vtkMRMLVolumePropertyNode()
+    slicer.mrmlScene.AddNode(volumeProperty)
+    volumeProperty.GetScalarOpacity().AddPoint(0, 0.0)
+    volumeProperty.GetScalarOpacity().AddPoint(500, 0.0)
+    volumeProperty.GetScalarOpacity().AddPoint(1000, 0.5)
+    volumeProperty.GetScalarOpacity().AddPoint(2000, 1.0)
+
+    logic = ExposureRenderLinkLogic()
+    logic.exportChunkSize = 4000 # several slabs
+    export = logic.prepareExport(volumeNode, volumeProperty)
+    self.assertIs(export['imageData'], imageData)
+    self.assertEqual(export['intensityRange'], (0, 2000))
+
+    export = logic.prepareExport(volumeNode, volumeProperty, crop='opacity')
+    self.assertEqual(export['extent'], (3, 29, 10, 24, 5, 11))
+    self.assertEqual(export['imageData'].GetDimensions(), (27, 15, 7))
+    self.assertEqual(export['imageData'].GetOrigin(), (3.0, 10.0, 5.0))
+    self.assertEqual(export['intensityRange'], (1000, 2000))
+    self.assertIs(logic.prepareExport(volumeNode, volumeProperty, crop='opacity'), export)
+
+    export = logic.prepareExport(volumeNode, volumeProperty, crop='opacity', scalarType='uint8')
+    self.assertEqual(export['imageData'].GetScalarTypeAsString(), 'unsigned char')
+    lower, upper = export['intensityRange']
+    self.assertTrue(lower <= 500 < upper and upper >= 2000)
+    narrowed = numpy_support.vtk_to_numpy(export['imageData'].GetPointData().GetScalars()).reshape(7, 15, 27)
+    self.assertEqual(narrowed[1, 2, 1], 255)
+    self.assertEqual(narrowed[0, 0, 0], round((1000 - lower) * 255 / (upper - lower)))
+
+    # the camera is normalized to the sent part of the volume
+    cameraNode = slicer.vtkMRMLCameraNode()
+    cameraNode.SetPosition(3, 24, 8)
+    cameraParameters = logic.getCameraParameters(export['bounds'], cameraNode=cameraNode)
+    self.assertEqual(cameraParameters['from'], [0.0, 1.0, 0.5])
+
+    # in RAS, the extent of a volume mirrored along x with 2 mm voxels along z
+    volumeNode.SetIJKToRASDirections(-1, 0, 0, 0, 1, 0, 0, 0, 1)
+    volumeNode.SetSpacing(1.0, 1.0, 2.0)
+    volumeNode.SetOrigin(10.0, 0.0, 0.0)
+    export = logic.prepareExport(volumeNode, volumeProperty, crop='opacity', scalarType='uint8')
+    self.assertEqual(export['bounds'], (-19.0, 7.0, 10.0, 24.0, 10.0, 22.0))
+    cameraNode.SetPosition(-19, 24, 16)
+    self.assertEqual(logic.getCameraParameters(export['bounds'], cameraNode=cameraNode)['from'], [0.0, 1.0, 0.5])
+    # a single slice is normalized to one voxel
+    self.assertEqual(logic.getRASBounds(volumeNode, (3, 29, 10, 24, 5, 5)), (-19.0, 7.0, 10.0, 24.0, 10.0, 12.0))
+    self.assertEqual(logic.getCameraParameters((0, 10, 0, 10, 5, 5), cameraNode=cameraNode)['from'][2], 11.0)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkBatch(self):
+    """ Renders two volumes with the same voxels and a third one with two presets from two
+    camera poses, with stand-in renderers that write a frame and exit.
+    """
+    self.delayDisplay("Starting the batch test")
+    volumes = []
+    for index, values in enumerate((1000, 1000, 2000)):
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(16, 12, 8)
+      imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(numpy.arange(16 * 12 * 8, dtype=numpy.int16) % values))
+      volumeNode = slicer.vtkMRMLScalarVolumeNode()
+      volumeNode.SetAndObserveImageData(imageData)
+      slicer.mrmlScene.AddNode(volumeNode)
+      volumes.append({'name': 'volume%d' % index, 'node': volumeNode})
+    presets = []
+    for index in range(2):
+      volumeProperty = slicer.vtkMRMLVolumePropertyNode()
+      slicer.mrmlScene.AddNode(volumeProperty)
+      volumeProperty.GetColor().AddRGBPoint(0, index, 0.5, 1.0)
+      volumeProperty.GetScalarOpacity().AddPoint(0, 0.0)
+      volumeProperty.GetScalarOpacity().AddPoint(2000, 1.0)
+      presets.append({'name': 'preset%d' % index, 'node': volumeProperty})
+    poses = [{'position': (8, -50, 4), 'focalPoint': (8, 6, 4)}, {'position': (60, 6, 4), 'focalPoint': (8, 6, 4)}]
+
+    class StandInRenderer(object):
+      def __init__(self, directory):
+        self.directory = directory
+        self.polls = 0
+      def poll(self):
+        self.polls += 1
+        if self.polls < 3:
+          return None
+        if self.polls == 3:
+          with open(os.path.join(self.directory, 'frame.bin'), 'wb') as fp:
+            fp.write(ExposureRenderFrameReceiver.packFrame(numpy.zeros((5, 4, 3), dtype=numpy.uint8), 100))
+        return 0
+      def terminate(self):
+        pass
+
+    class StandInBatch(ExposureRenderBatch):
+      pollInterval = 0.01
+      maxRunning = 0
+      def startRenderer(self, args, cwd):
+        self.maxRunning = max(self.maxRunning, len(self.running) + 1)
+        return StandInRenderer(args[1])
+
+    output = os.path.join(slicer.app.temporaryPath, 'ExposureRenderBatch')
+    logic = ExposureRenderLinkLogic()
+    logic.getShading = lambda: (0.5, 0.5)
+    batch = StandInBatch({'output': output, 'volumes': volumes, 'presets': presets,
+                          'cameras': [{'name': 'orbit', 'poses': poses}], 'renderers': 2}, logic)
+    index = batch.run()
+
+    self.assertEqual(len(index['renders']), 3 * 2 * 2)
+    self.assertTrue(all(render['state'] == 'done' for render in index['renders']))
+    self.assertLessEqual(batch.maxRunning, 2)
+    # the volumes with the same voxels share their export
+    self.assertEqual([export['volume'] for export in index['exports']], ['volume0', 'volume2'])
+    render = index['renders'][0]
+    directory = os.path.join(output, render['directory'])
+    for name in ('volume.mhd', 'AppearancePresets.xml', 'CameraPresets.xml', 'image.png'):
+      self.assertTrue(os.path.exists(os.path.join(directory, name)))
+    with open(os.path.join(directory, 'volume.mhd')) as fp:
+      dataFile = fp.read().splitlines()[-1].split(' = ')[1]
+    self.assertTrue(os.path.exists(os.path.join(directory, dataFile)))
+    with open(os.path.join(output, 'index.json')) as fp:
+      self.assertEqual(len(json.load(fp)['renders']), 12)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkSharedMemory(self):
+    """ Publishes a volume and both presets to shared memory, reads them back through the
+    stand-in reader and checks that only changed sections get a new version.
+    """
+    self.delayDisplay("Starting the shared memory test")
+    name = 'ExposureRenderLinkTest%d' % os.getpid()
+    logic = ExposureRenderLinkLogic()
+    reader = ExposureRenderSharedMemoryReader(name)
+    try:
+      voxels = numpy.arange(32 * 24 * 16, dtype=numpy.int16)
+      volumeHeaders = {'X-Dimensions': '32 24 16', 'X-Scalar-Type': 'short'}
+      ExposureRenderSharedMemory.chunkSize = 5000 # several chunks
+      progress = []
+      # room for a volume of twice the size
+      changed = logic.publishSharedMemory(name, voxels, volumeHeaders, b'<Appearance/>', '<Camera/>',
+        lambda done, total: progress.append((done, total)), capacity=4 * voxels.nbytes)
+      self.assertEqual(changed, ['layout', 'lut', 'camera', 'volume'])
+      self.assertEqual(progress[-1], (voxels.nbytes, voxels.nbytes))
+
+      generation, sections = reader.read()
+      self.assertEqual(generation % 2, 0)
+      self.assertEqual(sections['volume'][1].view(numpy.int16).tolist(), voxels.tolist())
+      self.assertEqual(json.loads(sections['layout'][1].tobytes().decode('utf-8')), volumeHeaders)
+      self.assertEqual(sections['camera'][1].tobytes(), b'<Camera/>')
+      versions = dict((section, version) for section, (version, data) in sections.items())
+      del sections
+
+      # only the moved camera is written again
+      changed = logic.publishSharedMemory(name, voxels, volumeHeaders, b'<Appearance/>', '<Camera Moved="1"/>')
+      self.assertEqual(changed, ['camera'])
+      generation, sections = reader.read()
+      self.assertEqual(sections['camera'], (versions['camera'] + 1, sections['camera'][1]))
+      self.assertEqual(sections['camera'][1].tobytes(), b'<Camera Moved="1"/>')
+      self.assertEqual(sections['volume'][0], versions['volume'])
+      del sections
+
+      # a larger volume within the capacity keeps the mapping
+      totalSize = len(reader.mapping)
+      voxels = numpy.arange(32 * 24 * 32, dtype=numpy.int16)
+      self.assertEqual(logic.publishSharedMemory(name, voxels, volumeHeaders, b'<Appearance/>', '<Camera Moved="1"/>'), ['volume'])
+      generation, sections = reader.read()
+      self.assertEqual(len(reader.mapping), totalSize)
+      self.assertEqual(sections['volume'][1].view(numpy.int16).tolist(), voxels.tolist())
+      versions = dict((section, version) for section, (version, data) in sections.items())
+      del sections
+
+      # one beyond it recreates the segment, the reader follows and every section has a newer version
+      if sys.platform == 'win32':
+        # the old mapping only goes away once the renderer lets go of it
+        reader.close()
+        reader.mapping = None
+      voxels = numpy.arange(64 * 48 * 32, dtype=numpy.int16)
+      logic.publishSharedMemory(name, voxels, volumeHeaders, b'<Appearance/>', '<Camera Moved="1"/>')
+      generation, sections = reader.read()
+      self.assertGreater(len(reader.mapping), totalSize)
+      self.assertEqual(sections['volume'][1].view(numpy.int16)[-1], voxels[-1])
+      self.assertEqual(sections['camera'][1].tobytes(), b'<Camera Moved="1"/>')
+      for section in versions:
+        self.assertGreater(sections[section][0], versions[section])
+      del sections
+    finally:
+      ExposureRenderSharedMemory.chunkSize = 1 << 24
+      if reader.mapping is not None:
+        reader.close()
+      segment = ExposureRenderSharedMemory.pool.pop(name, None)
+      if segment:
+        segment.close(unlink=True)
+      exposureRenderChangeTracker.forget('shm://' + name)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkDistributed(self):
+    """ Renders one frame in tiles on several stand-in hosts, a slow and a failing one among them.
+    """
+    self.delayDisplay("Starting the distributed rendering test")
+    servers = [ExposureRenderStandInServer().start() for index in range(3)]
+    servers[2].tileDelay = 0.05
+    failing = ExposureRenderStandInServer()
+    failing.server_close()
+    hosts = [server.host for server in servers] + [failing.host]
+    try:
+      filmSize = (200, 150)
+      scheduler = ExposureRenderTileScheduler(hosts, filmSize, (32, 32))
+      progress = []
+      image = scheduler.render(lambda done, total: progress.append((done, total)))
+      numberOfTiles = len(scheduler.getTiles())
+      self.assertEqual(numberOfTiles, 35)
+      self.assertEqual(progress[-1], (numberOfTiles, numberOfTiles))
+      self.assertTrue((image == ExposureRenderStandInServer.renderTile(0, 0, filmSize[0], filmSize[1])).all())
+      imageData = scheduler.getImageData()
+      self.assertEqual(imageData.GetDimensions(), (200, 150, 1))
+      self.assertEqual(imageData.GetNumberOfScalarComponents(), 3)
+
+      # every tile was rendered once, the fast hosts took over from the slow and the failing one
+      statistics = scheduler.statistics
+      self.assertEqual(sum(len(server.tiles) for server in servers), numberOfTiles)
+      self.assertEqual(sum(statistics[host]['tiles'] for host in hosts), numberOfTiles)
+      self.assertEqual([failing.host], list(scheduler.failed))
+      self.assertEqual(statistics[failing.host]['tiles'], 0)
+      self.assertTrue(statistics[servers[0].host]['stolen'] + statistics[servers[1].host]['stolen'] > 0)
+      self.assertTrue(statistics[servers[2].host]['tiles'] < statistics[servers[0].host]['tiles'])
+      self.assertTrue(ExposureRenderTileScheduler.hostSpeeds[servers[2].host] <
+                      ExposureRenderTileScheduler.hostSpeeds[servers[0].host])
+
+      # the next frame deals fewer tiles to the slow host right away
+      scheduler = ExposureRenderTileScheduler(hosts[:3], filmSize, (32, 32))
+      scheduler.deal(scheduler.getTiles())
+      self.assertTrue(len(scheduler.queues[servers[2].host]) < len(scheduler.queues[servers[0].host]))
+
+      scheduler = ExposureRenderTileScheduler([failing.host], filmSize, (32, 32))
+      with self.assertRaises(IOError):
+        scheduler.render()
+    finally:
+      for server in servers:
+        server.shutdown()
+      for host in hosts:
+        client = ExposureRenderHTTPClient.pool.pop(host, None)
+        if client:
+          client.close()
+        ExposureRenderTileScheduler.hostSpeeds.pop(host, None)
+    self.delayDisplay('Test passed!')
+
+  def test_ExposureRenderLinkCLI(self):
+    """ Rewrites the volume of a data share only when the voxels or the compression level change.
+    """
+    self.delayDisplay("Starting the data share test")
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(20, 10, 8)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk((numpy.arange(1600) % 100).astype(numpy.int16)))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeProperty = slicer.vtkMRMLVolumePropertyNode()
+    slicer.mrmlScene.AddNode(volumeProperty)
+    volumeProperty.GetScalarOpacity().AddPoint(0, 0.0)
+    volumeProperty.GetScalarOpacity().AddPoint(100, 1.0)
+
+    class ShareLogic(ExposureRenderLinkLogic):
+      def getShading(self):
+        return 0.5, 0.5
+    class RunningProcess(object):
+      pid = 0
+      def poll(self):
+        return None
+    logic = ShareLogic()
+    dataSharePath = os.path.join(slicer.app.temporaryPath, 'ExposureRenderLinkShare')
+    if not os.path.exists(dataSharePath):
+      os.makedirs(dataSharePath)
+    # the renderer counts as running, nothing is launched
+    launchKey = ('ExposureRender/ExposureRender.exe', dataSharePath)
+    exposureRenderJobManager.processes[launchKey] = RunningProcess()
+    stages = []
+    pipelineInstrumentation.addCollector(stages.append)
+    pipelineInstrumentation.enabled = True
+    exported = []
+    try:
+      for compressionLevel in (0, 0, 1):
+        del stages[:]
+        job = logic.runCLI(volumeNode, volumeProperty, 'ExposureRender', dataSharePath, compressionLevel)
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, 'done')
+        exported.append('export volume' in [stage['stage'] for stage in stages])
+      # unchanged voxels are not written again, unless they have to be compressed now
+      self.assertEqual(exported, [True, False, True])
+      self.assertTrue(os.path.exists(os.path.join(dataSharePath, 'volume.zraw')))
+    finally:
+      exposureRenderJobManager.processes.pop(launchKey, None)
+      exposureRenderChangeTracker.forget(os.path.abspath(dataSharePath))
+      pipelineInstrumentation.enabled = False
+      pipelineInstrumentation.removeCollector(stages.append)
+    self.delayDisplay('Test passed!')
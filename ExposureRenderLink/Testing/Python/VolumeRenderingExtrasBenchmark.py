@@ -0,0 +1,243 @@
+"""Offline benchmarks for the hot paths of TransferFunctionEditor and ExposureRenderLink.
+
+Everything runs on synthetic volumes and a local stand-in server, nothing is downloaded.
+Run it inside Slicer, either through ctest or with
+  Slicer --no-main-window --python-script VolumeRenderingExtrasBenchmark.py
+
+Environment variables:
+  VRE_BENCHMARK_SIZES    edge lengths of the cubic test volumes, default "64,128"
+                         (up to 1024, mind the memory: 1024^3 float32 voxels are 4 GB)
+  VRE_BENCHMARK_TYPES    NumPy scalar types of the test volumes, default "uint8,int16,float32"
+  VRE_BENCHMARK_REPEATS  runs per measurement of which the fastest counts, default 3
+  VRE_BENCHMARK_OUTPUT   JSON file for the results, default
+                         VolumeRenderingExtrasBenchmark.json in the Slicer temporary directory
+
+The stand-in server keeps the last uploaded volume in memory, so plan for about twice
+the size of the largest volume.
+
+The JSON file holds the environment and one record per measurement: name, size,
+scalarType, seconds, repeats, bytes and throughput (bytes per second), so runs can be
+compared for regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import timeit
+import platform
+import multiprocessing
+import unittest
+import logging
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+from TransferFunctionEditor import TransferFunctionEditorLogic, volumeStatisticsCache
+from ExposureRenderLink import (ExposureRenderLinkLogic, ExposureRenderStandInServer,
+  ExposureRenderHTTPClient, exposureRenderChangeTracker)
+
+#
+# Benchmark helpers
+#
+
+class BenchmarkExposureRenderLinkLogic(ExposureRenderLinkLogic):
+
+  def getShading(self):
+    # the benchmark scene has no volume rendering
+    return 0.5, 0.5
+
+class VolumeRenderingExtrasBenchmark(object):
+  """Times the hot paths of both modules and collects the results.
+  """
+
+  # value range of the synthetic volumes per scalar type
+  valueRanges = {
+    'uint8': (0, 255), 'int8': (-128, 127), 'uint16': (0, 4095), 'int16': (-1024, 3071),
+    'int32': (-1024, 3071), 'float32': (0.0, 1.0), 'float64': (0.0, 1.0)
+  }
+
+  def __init__(self, sizes=None, scalarTypes=None, repeats=None):
+    environment = os.environ.get
+    self.sizes = sizes or [int(size) for size in environment('VRE_BENCHMARK_SIZES', '64,128').split(',')]
+    self.scalarTypes = scalarTypes or environment('VRE_BENCHMARK_TYPES', 'uint8,int16,float32').split(',')
+    self.repeats = repeats or int(environment('VRE_BENCHMARK_REPEATS', '3'))
+    self.results = []
+
+  def measure(self, name, function, size=None, scalarType=None, numberOfBytes=None, setup=None):
+    """Runs setup (untimed) and function repeats times and records the fastest run.
+    """
+    times = []
+    for repeat in range(self.repeats):
+      if setup:
+        setup()
+      startTime = timeit.default_timer()
+      function()
+      times.append(timeit.default_timer() - startTime)
+    seconds = min(times)
+    self.results.append({
+      'name': name,
+      'size': size,
+      'scalarType': scalarType,
+      'seconds': seconds,
+      'repeats': self.repeats,
+      'bytes': numberOfBytes,
+      'throughput': numberOfBytes / seconds if numberOfBytes and seconds > 0 else None
+    })
+    logging.info('%-28s %6s %-8s %9.4f s' % (name, size or '', scalarType or '', seconds))
+    return seconds
+
+  def makeVolume(self, size, scalarType):
+    """Returns a volume node with a size^3 blob phantom: a smooth radial ramp plus noise,
+    generated slab by slab to bound the temporary memory.
+    """
+    lower, upper = self.valueRanges[scalarType]
+    voxels = numpy.empty((size, size, size), dtype=scalarType)
+    axis = numpy.linspace(-1.0, 1.0, size)
+    yy, xx = numpy.meshgrid(axis, axis, indexing='ij')
+    random = numpy.random.RandomState(size)
+    for z in range(size):
+      radius = numpy.sqrt(xx * xx + yy * yy + axis[z] * axis[z])
+      values = numpy.clip(1.0 - radius, 0.0, 1.0) + 0.05 * random.standard_normal((size, size))
+      voxels[z] = numpy.clip(lower + values * (upper - lower), lower, upper)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(size, size, size)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=1))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName('Benchmark%d%s' % (size, scalarType))
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+    return volumeNode
+
+  def makeWidgets(self, numberOfWidgets, pointsPerWidget=5):
+    """Returns numberOfWidgets random widgets packed like TF_panel.getWidgetsPacked.
+    """
+    random = numpy.random.RandomState(numberOfWidgets)
+    rows = []
+    for widget in range(numberOfWidgets):
+      values = numpy.sort(random.uniform(0, 1, pointsPerWidget))
+      for value in values:
+        rows.append([widget, value] + random.uniform(0, 1, 4).tolist())
+    return base64.b64encode(numpy.asarray(rows, dtype='<f4').tobytes())
+
+  def benchmarkTransferFunctions(self):
+    logic = TransferFunctionEditorLogic()
+    volumeProperty = slicer.vtkMRMLVolumePropertyNode()
+    slicer.mrmlScene.AddNode(volumeProperty)
+    for numberOfWidgets in (4, 16, 64):
+      packed = self.makeWidgets(numberOfWidgets)
+      name = 'compositeTFWidgets %d' % numberOfWidgets
+      self.measure(name, lambda: logic.compositeTFWidgets(logic.decodeTFWidgets(packed)))
+
+      # alternate between two transfer functions, so that every sync has to change nodes
+      pointSets = [logic.compositeTFWidgets(logic.decodeTFWidgets(self.makeWidgets(numberOfWidgets + offset)))
+                   for offset in (0, 1)]
+      def sync():
+        logic.syncTransferFunction(volumeProperty, pointSets[0], (0, 1000))
+        pointSets.reverse()
+      self.measure('syncTransferFunction %d' % numberOfWidgets, sync)
+
+    lutLogic = BenchmarkExposureRenderLinkLogic()
+    for numberOfWidgets in (4, 64):
+      points = logic.compositeTFWidgets(logic.decodeTFWidgets(self.makeWidgets(numberOfWidgets)))
+      logic.syncTransferFunction(volumeProperty, points, (0, 1000))
+      self.measure('getLUTDataAsXML %d' % numberOfWidgets,
+        lambda: lutLogic.getLUTDataAsXML(volumeProperty, (0, 1000)), setup=lutLogic.lutCache.clear)
+
+    cameraNode = slicer.vtkMRMLCameraNode()
+    cameraNode.SetPosition(0, -500, 0)
+    self.measure('getCameraDataAsXML', lambda: lutLogic.getCameraDataAsXML((0, 255, 0, 255, 0, 255), cameraNode=cameraNode))
+
+  def benchmarkVolume(self, size, scalarType, server):
+    volumeNode = self.makeVolume(size, scalarType)
+    imageData = volumeNode.GetImageData()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    nbytes = voxels.nbytes
+    tfLogic = TransferFunctionEditorLogic()
+    logic = BenchmarkExposureRenderLinkLogic()
+
+    def invalidate():
+      volumeStatisticsCache.invalidate(volumeNode)
+    self.measure('computeHistogram preview', lambda: tfLogic.computeHistogram(volumeNode, preview=True),
+      size, scalarType, nbytes, invalidate)
+    self.measure('computeHistogram', lambda: tfLogic.computeHistogram(volumeNode), size, scalarType, nbytes, invalidate)
+
+    filename = os.path.join(slicer.app.temporaryPath, 'VolumeRenderingExtrasBenchmark.mhd')
+    for compressionLevel in (0, 1):
+      self.measure('exportVolume level %d' % compressionLevel,
+        lambda: logic.exportVolume(imageData, filename, compressionLevel), size, scalarType, nbytes)
+    for extension in ('.mhd', '.raw', '.zraw'):
+      if os.path.exists(os.path.splitext(filename)[0] + extension):
+        os.remove(os.path.splitext(filename)[0] + extension)
+
+    volumeHeaders = logic.getVolumeHeaders(imageData)
+    destination = 'http://' + server.host
+    def forget():
+      exposureRenderChangeTracker.forget(destination)
+      server.received.clear()
+    self.measure('uploadHTTP', lambda: logic.uploadHTTP(server.host, voxels, volumeHeaders, '<Appearance/>', '<Camera/>'),
+      size, scalarType, nbytes, forget)
+    forget()
+
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    volumeStatisticsCache.invalidate(volumeNode)
+
+  def run(self):
+    self.benchmarkTransferFunctions()
+    server = ExposureRenderStandInServer().start()
+    try:
+      for size in self.sizes:
+        for scalarType in self.scalarTypes:
+          self.benchmarkVolume(size, scalarType, server)
+    finally:
+      server.shutdown()
+      client = ExposureRenderHTTPClient.pool.pop(server.host, None)
+      if client:
+        client.close()
+    return self.results
+
+  def write(self, filename=None):
+    """Writes the environment and the results as JSON, returns the file name.
+    """
+    filename = filename or os.environ.get('VRE_BENCHMARK_OUTPUT') or \
+      os.path.join(slicer.app.temporaryPath, 'VolumeRenderingExtrasBenchmark.json')
+    with open(filename, 'w') as fp:
+      json.dump({
+        'environment': {
+          'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'platform': platform.platform(),
+          'python': sys.version.split()[0],
+          'numpy': numpy.__version__,
+          'vtk': vtk.vtkVersion.GetVTKVersion(),
+          'cpus': multiprocessing.cpu_count()
+        },
+        'results': self.results
+      }, fp, indent=2)
+    logging.info('Benchmark results written to ' + filename)
+    return filename
+
+#
+# VolumeRenderingExtrasBenchmarkTest
+#
+
+class VolumeRenderingExtrasBenchmarkTest(unittest.TestCase):
+  """Runs the benchmarks as a test, so that ctest produces the results file.
+  """
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def test_Benchmark(self):
+    benchmark = VolumeRenderingExtrasBenchmark()
+    results = benchmark.run()
+    self.assertTrue(results)
+    self.assertTrue(all(result['seconds'] >= 0 for result in results))
+    benchmark.write()
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  benchmark = VolumeRenderingExtrasBenchmark()
+  benchmark.run()
+  benchmark.write()
+  if slicer.app.commandOptions().noMainWindow:
+    sys.exit(0)
@@ -19,6 +19,10 @@
 
 		this.callbacks = [];
 
+		//layers that need to be redrawn in the next animation frame
+		this.dirtyLayers = {};
+		this.frameRequested = false;
+
 		var container = options.container || parent.parentElement || null;
 
 		var collapsiblePanel;
@@ -84,6 +88,12 @@
 		this.panel.dom.appendChild( canvas );
 		this.canvas = canvas;
 
+		//offscreen canvas the histogram is drawn to, only redrawn when the histogram or the size changes
+		this.histogramLayer = document.createElement( 'canvas' );
+		this.histogramLayer.width = panel.width;
+		this.histogramLayer.height = panel.height;
+		this.histogramLOD = null;
+
 		this.options.gradientPresets.container = this.panel.dom;
 		this.panelContextMenu = this.addContextMenu( this.options.gradientPresets );
 
@@ -154,6 +164,8 @@
 		 * style:			'polygon' or 'bars'	whether the histogram should be plotted as a polyline or vertical rectangular bars
 		 * scale:			function			(mathematical) function by which the histogram values should be scaled (e.g. logarithmic, ...)
 		 * overlayUnscaled:	boolean				whether the histogram (scaled by the 'scale' function should be overlayed with an unscaled version
+		 * levelOfDetail:	boolean				whether histograms with more bins than pixels are reduced to one min/max envelope per pixel column
+		 * densityColor:	color				color of the intensity x gradient magnitude histogram, its opacity shows the voxel density
 		 */
 		options.histogram = options.histogram || {};
 		options.histogram.fillColor = options.histogram.fillColor || '#333333';
@@ -161,6 +173,8 @@
 		options.histogram.style = options.histogram.style || 'polygon';
 		options.histogram.scale = options.histogram.scale || Math.log;
 		if( options.histogram.overlayUnscaled === undefined ) options.histogram.overlayUnscaled = true;
+		if( options.histogram.levelOfDetail === undefined ) options.histogram.levelOfDetail = true;
+		options.histogram.densityColor = options.histogram.densityColor || '#aaaaaa';
 
 		/** gradient preset options
 		 * defaultPresets:	boolean			specifies whether the default presets should be loaded and appended to the custom presets. If presets is empty, default presets will be loaded anyway
@@ -267,14 +281,42 @@
 		this.panel.svgContext.setAttribute( 'width', width );
 		this.panel.svgContext.setAttribute( 'height', height );
 
-		this.drawHistogram( this.options.histogram );
+		//resize events come in bursts while dragging the window border, redraw once per frame
+		this.requestDraw( 'histogram' );
+		this.requestDraw( 'widgets' );
+	};
 
-		for( var index = 0; index < this.widgets.length; index++ ) {
-			var widget = this.widgets[ index ];
-			widget.resize( width, height );
-		}
+	TF_panel.requestAnimationFrame = ( window.requestAnimationFrame || window.webkitRequestAnimationFrame ||
+		function( callback ) { return window.setTimeout( callback, 16 ); } ).bind( window );
+
+	/**
+	 * marks a layer ( 'histogram', 'widgets' or 'result' ) for redrawing in the next animation frame,
+	 * any number of requests between two frames cause a single redraw
+	 */
+	TF_panel.prototype.requestDraw = function( layer ) {
+		this.dirtyLayers[ layer ] = true;
+		if( this.frameRequested ) return;
+		this.frameRequested = true;
+		TF_panel.requestAnimationFrame( this.drawDirtyLayers.bind( this ) );
+	};
+
+	TF_panel.prototype.drawDirtyLayers = function() {
+		var dirtyLayers = this.dirtyLayers;
+		this.dirtyLayers = {};
+		this.frameRequested = false;
 
-		//this.draw();
+		if( dirtyLayers.histogram ) {
+			this.drawHistogram( this.options.histogram );
+		}
+		if( dirtyLayers.widgets ) {
+			for( var index = 0; index < this.widgets.length; index++ ) {
+				var widget = this.widgets[ index ];
+				widget.resize( this.panel.width, this.panel.height );
+			}
+		}
+		if( dirtyLayers.result && this.options.panel.showTFResult ) {
+			this.updateTF();
+		}
 	};
 
 	/**
@@ -401,8 +443,23 @@
 		}
 	};
 
+	/**
+	 * attach an object with a setText( string ) method (exposed by the host application)
+	 * which receives the transfer function as packed numbers on every change
+	 */
+	TF_panel.prototype.setBridge = function( bridge ) {
+		this.bridge = bridge;
+	};
+
 	TF_panel.prototype.fireChange = function() {
-		this.updateTF();
+		//the host application blends the widgets itself, only the result bar needs them blended here
+		if( this.options.panel.showTFResult ) {
+			this.requestDraw( 'result' );
+		}
+
+		if( this.bridge ) {
+			this.bridge.setText( this.getWidgetsPacked() );
+		}
 
 		for( var index = 0; index < this.callbacks.length; index++ ) {
 			var callback = this.callbacks[ index ];
@@ -429,26 +486,62 @@
 			this.panel.dom.insertBefore( this.histogramTooltip, this.panel.svgContext );
 		}
 
-		//show tooltips on hover over tf panel
-		this.panel.svgContext.addEventListener( 'mousemove', function ( e ) {
-			var mouse = UI.getRelativePosition( e.clientX, e.clientY, self.panel.dom );
+		//show tooltips on hover over tf panel (registered once, histogram may be replaced later on)
+		if( !this.histogramHoverListener ) {
+			this.histogramHoverListener = function ( e ) {
+				var histogram = this.histogram;
+				var mouse = UI.getRelativePosition( e.clientX, e.clientY, self.panel.dom );
 
-			var binWidth = this.canvas.width / histogram.numBins;
-			var bin = Math.floor( mouse.x / binWidth );
+				var binWidth = this.canvas.width / histogram.numBins;
+				var bin = Math.floor( mouse.x / binWidth );
 
-			var xHover = mouse.x;
-			var yHover = this.canvas.height - this.canvas.height * histogram.scale( this.histogram.bins[ bin ] ) / histogram.scale( this.histogram.maxBinValue );
-			if ( yHover === Infinity ) yHover = this.canvas.height;
+				var xHover = mouse.x;
+				var yHover = this.canvas.height - this.canvas.height * histogram.scale( histogram.bins[ bin ] ) / histogram.scale( histogram.maxBinValue );
+				if ( yHover === Infinity ) yHover = this.canvas.height;
 
-			if ( !isNaN( xHover ) ) this.histogramHover.setAttribute( 'cx', xHover );
-			if ( !isNaN( yHover ) ) this.histogramHover.setAttribute( 'cy', yHover );
+				if ( !isNaN( xHover ) ) this.histogramHover.setAttribute( 'cx', xHover );
+				if ( !isNaN( yHover ) ) this.histogramHover.setAttribute( 'cy', yHover );
 
-			this.histogramTooltip.innerHTML = 'value: ' + Math.floor( ( mouse.x / this.canvas.width ) * 255 ) + '<br>' + 'count: ' + this.histogram.bins[ bin ];
-			this.histogramTooltip.style.left = xHover + 'px';
-			this.histogramTooltip.style.top = yHover + 'px';
-		}.bind( self ), true );
+				//show the data value if the histogram range is known, otherwise fall back to 8 bit
+				var range = histogram.range || { min: 0, max: 255 };
+				var value = range.min + ( mouse.x / this.canvas.width ) * ( range.max - range.min );
+				this.histogramTooltip.innerHTML = 'value: ' + Math.floor( value ) + '<br>' + 'count: ' + histogram.bins[ bin ];
+				this.histogramTooltip.style.left = xHover + 'px';
+				this.histogramTooltip.style.top = yHover + 'px';
+			}.bind( self );
+			this.panel.svgContext.addEventListener( 'mousemove', this.histogramHoverListener, true );
+		}
 
-		this.drawHistogram( this.options.histogram );
+		this.histogramLOD = null;
+		this.requestDraw( 'histogram' );
+	};
+
+	/**
+	 * shows the joint histogram of intensity and gradient magnitude behind the histogram, or hides it if null
+	 * histogram2D contains { width, height, densities: base64 encoded uint8 image (rows from the highest gradient magnitude),
+	 * range: { min, max }, gradientRange: { min, max } }
+	 */
+	TF_panel.prototype.setHistogram2D = function( histogram2D ) {
+		this.histogram2D = histogram2D || null;
+		this.histogram2DImage = null;
+		if( this.histogram2D ) {
+			var densities = window.atob( histogram2D.densities );
+			var image = document.createElement( 'canvas' );
+			image.width = histogram2D.width;
+			image.height = histogram2D.height;
+			var context = image.getContext( '2d' );
+			var imageData = context.createImageData( image.width, image.height );
+			var color = Color.parseColor( this.options.histogram.densityColor );
+			for( var index = 0; index < densities.length; index++ ) {
+				imageData.data[ 4 * index ] = color.r;
+				imageData.data[ 4 * index + 1 ] = color.g;
+				imageData.data[ 4 * index + 2 ] = color.b;
+				imageData.data[ 4 * index + 3 ] = densities.charCodeAt( index );
+			}
+			context.putImageData( imageData, 0, 0 );
+			this.histogram2DImage = image;
+		}
+		this.requestDraw( 'histogram' );
 	};
 
 	//redraw
@@ -459,82 +552,223 @@
 		}
 	};
 
+	/**
+	 * reduces bins to numColumns columns, returns the smallest and largest bin of each column
+	 * as { min: Float64Array, max: Float64Array }
+	 */
+	TF_panel.decimateBins = function( bins, numColumns ) {
+		var min = new Float64Array( numColumns );
+		var max = new Float64Array( numColumns );
+		var binsPerColumn = bins.length / numColumns;
+		for( var column = 0; column < numColumns; column++ ) {
+			var start = Math.floor( column * binsPerColumn );
+			var end = Math.max( start + 1, Math.floor( ( column + 1 ) * binsPerColumn ) );
+			var low = bins[ start ];
+			var high = low;
+			for( var bin = start + 1; bin < end; bin++ ) {
+				var count = bins[ bin ];
+				if( count < low ) low = count;
+				if( count > high ) high = count;
+			}
+			min[ column ] = low;
+			max[ column ] = high;
+		}
+		return { min: min, max: max };
+	};
+
 	/*
-	 * draw the histogram to the histogram canvas
+	 * draw the histogram to the histogram layer and show it in the histogram canvas
 	 */
 	TF_panel.prototype.drawHistogram = function( options ) {
-		if( !this.histogram ) return;
+		if( !this.histogram && !this.histogram2D ) return;
 		if( options === undefined ) options = {};
-		var canvas = this.canvas;
+		var canvas = this.histogramLayer;
+		if( canvas.width !== this.canvas.width || canvas.height !== this.canvas.height ) {
+			canvas.width = this.canvas.width;
+			canvas.height = this.canvas.height;
+		}
 		var context = canvas.getContext( '2d' );
 
+		context.globalAlpha = 1;
 		context.clearRect( 0, 0, canvas.width, canvas.height );
 		context.fillStyle = options.fillColor;
 		context.strokeStyle = options.lineColor;
+		context.lineWidth = 1;
+
+		if( this.histogram2DImage ) {
+			//intensity along x, gradient magnitude upwards, stretched to the panel
+			context.drawImage( this.histogram2DImage, 0, 0, canvas.width, canvas.height );
+			context.fillStyle = options.lineColor;
+			context.font = '10px sans-serif';
+			context.textBaseline = 'top';
+			context.textAlign = 'left';
+			context.fillText( '|grad| ' + Number( this.histogram2D.gradientRange.max.toPrecision( 4 ) ), 2, 2 );
+			//the 1D histogram stays as outline on top
+			context.globalAlpha = 0.3;
+		}
+
+		if( this.histogram ) {
+			//with more bins than pixel columns, draw one min/max envelope per column instead of every bin
+			var levelOfDetail = options.levelOfDetail && this.histogram.numBins > canvas.width;
+			if( levelOfDetail && ( !this.histogramLOD || this.histogramLOD.max.length !== canvas.width ) ) {
+				this.histogramLOD = TF_panel.decimateBins( this.histogram.bins, canvas.width );
+			}
+			var columns = levelOfDetail ? this.histogramLOD.max : this.histogram.bins;
+			var numColumns = levelOfDetail ? canvas.width : this.histogram.numBins;
+			var xScale = canvas.width / numColumns;
+
+			/* plots the histogram bins as a polygon that traces the centers of each bin */
+			var drawPolygonHistogram = function ( scale ) {
+				context.beginPath();
+				var maxVal = scale( this.histogram.maxBinValue );
+
+				context.moveTo( 0, canvas.height );
+				context.lineTo( 0, canvas.height - canvas.height * scale( columns[ 0 ] ) / maxVal );
+
+				var x = xScale / 2;
+				for( var column = 0; column < numColumns; column++ ) {
+					context.lineTo( x, canvas.height - canvas.height * scale( columns[ column ] ) / maxVal );
+					x += xScale;
+				}
+				context.lineTo( canvas.width, canvas.height - canvas.height * scale( columns[ numColumns - 1 ] ) / maxVal );
+				context.lineTo( canvas.width, canvas.height );
+				context.lineTo( 0, canvas.height );
 
-		var xScale = canvas.width / this.histogram.numBins;
+				context.closePath();
+				context.fill();
+				context.stroke();
+			};
 
-		/* plots the histogram bins as a polygon that traces the centers of each bin */
-		var drawPolygonHistogram = function ( scale ) {
-			context.beginPath();
-			var maxVal = scale( this.histogram.maxBinValue );
+			/* plots the histogram bins as a series of n vertical bars (n = number of bins) */
+			var drawBarHistogram = function( scale ) {
+				var maxVal = scale( this.histogram.maxBinValue );
+				context.beginPath();
 
-			context.moveTo( 0, canvas.height );
-			context.lineTo( 0, canvas.height - canvas.height * scale( this.histogram.bins[ 0 ] ) / maxVal );
+				for( var column = 0; column < numColumns; column++ ) {
+					context.moveTo( xScale * column, canvas.height );
+					context.lineTo( xScale * column, canvas.height - ( canvas.height * scale( columns[ column ] ) ) / maxVal );
+				}
 
-			var x = xScale / 2;
-			for( var bin = 0; bin < this.histogram.numBins; bin++ ) {
-				context.lineTo( x, canvas.height - canvas.height * scale( this.histogram.bins[ bin ] ) / maxVal );
-				x += xScale;
-			}
-			context.lineTo( canvas.width, canvas.height - canvas.height * scale( this.histogram.bins[ this.histogram.numBins - 1 ] ) / maxVal );
-			context.lineTo( canvas.width, canvas.height );
-			context.lineTo( 0, canvas.height );
+				context.closePath();
+				context.strokeStyle = options.fillColor;
+				context.lineWidth = xScale;
+				context.stroke();
+				context.strokeStyle = options.lineColor;
+				context.lineWidth = 1;
+			};
 
-			context.closePath();
-			context.fill();
-			context.stroke();
-		};
+			/* marks the spread between the smallest and the largest bin of each column */
+			var drawEnvelope = function( scale ) {
+				var maxVal = scale( this.histogram.maxBinValue );
+				var min = this.histogramLOD.min;
+				var max = this.histogramLOD.max;
+				context.beginPath();
+				for( var column = 0; column < numColumns; column++ ) {
+					var low = canvas.height - canvas.height * scale( min[ column ] ) / maxVal;
+					if( !isFinite( low ) ) low = canvas.height;
+					context.moveTo( column + 0.5, low );
+					context.lineTo( column + 0.5, canvas.height - canvas.height * scale( max[ column ] ) / maxVal );
+				}
+				context.stroke();
+			};
 
-		/* plots the histogram bins as a series of n vertical bars (n = number of bins) */
-		var drawBarHistogram = function( scale ) {
-			var maxVal = scale( this.histogram.maxBinValue );
-			context.beginPath();
+			var style = options.style || 'polygon';
+			var scale = options.scale || Math.log;
+			this.histogram.scale = scale;
+			var overlayUnscaled = options.overlayUnscaled;
+			var identityFunction = function( x ) { return x; };
+			if( overlayUnscaled ) {
+				context.globalAlpha *= 0.6;
+			}
+			if( style === 'polygon' ) {
+				drawPolygonHistogram.call( this, scale );
+				if( overlayUnscaled ) {
+					drawPolygonHistogram.call( this, identityFunction );
+				}
+			} else if( style === 'bars' ) {
+				drawBarHistogram.call( this, scale );
+				if( overlayUnscaled ) {
+					drawBarHistogram.call( this, identityFunction );
+				}
+			}
+			if( levelOfDetail ) {
+				drawEnvelope.call( this, scale );
+			}
 
-			for( var bin = 0; bin < this.histogram.numBins; bin++ ) {
-				context.moveTo( xScale * bin, canvas.height );
-				context.lineTo( xScale * bin, canvas.height - ( canvas.height * scale( this.histogram.bins[ bin ] ) ) / maxVal );
+			//label the data values the ends of the axis are mapped to
+			if( this.histogram.range ) {
+				context.globalAlpha = 1;
+				context.fillStyle = options.lineColor;
+				context.font = '10px sans-serif';
+				context.textBaseline = 'bottom';
+				context.textAlign = 'left';
+				context.fillText( Number( this.histogram.range.min.toPrecision( 4 ) ), 2, canvas.height - 2 );
+				context.textAlign = 'right';
+				context.fillText( Number( this.histogram.range.max.toPrecision( 4 ) ), canvas.width - 2, canvas.height - 2 );
 			}
+		}
 
-			context.closePath();
-			context.strokeStyle = options.fillColor;
-			context.lineWidth = xScale;
-			context.stroke();
-		};
+		var visibleContext = this.canvas.getContext( '2d' );
+		visibleContext.clearRect( 0, 0, this.canvas.width, this.canvas.height );
+		visibleContext.drawImage( canvas, 0, 0 );
+	};
+
+	TF_panel.prototype.getTF = function() {
+		this.updateTF();
+		return this.tf_values;
+	};
 
-		var style = options.style || 'polygon';
-		var scale = options.scale || Math.log;
-		this.histogram.scale = scale;
-		var overlayUnscaled = options.overlayUnscaled;
-		var identityFunction = function( x ) { return x; };
-		if( overlayUnscaled ) {
-			context.globalAlpha = 0.6;
+	/**
+	 * returns the transfer function as flat array of x, r, g, b, a values, all normalized to [0,1]
+	 */
+	TF_panel.prototype.getTFArray = function() {
+		var tf_values = this.getTF();
+		var array = [];
+		for( var index = 0; index < tf_values.length; index++ ) {
+			var item = tf_values[ index ];
+			var rgba = item[ 1 ];
+			array.push( item[ 0 ], rgba.r / 255, rgba.g / 255, rgba.b / 255, rgba.a );
 		}
-		if( style === 'polygon' ) {
-			drawPolygonHistogram.call( this, scale );
-			if( overlayUnscaled ) {
-				drawPolygonHistogram.call( this, identityFunction );
-			}
-		} else if( style === 'bars' ) {
-			drawBarHistogram.call( this, scale );
-			if( overlayUnscaled ) {
-				drawBarHistogram.call( this, identityFunction );
+		return array;
+	};
+
+	/**
+	 * returns the transfer function as base64 encoded Float32Array of N x 5 values ( x, r, g, b, a ),
+	 * all normalized to [0,1]
+	 */
+	TF_panel.prototype.getTFPacked = function() {
+		return TF_panel.packFloat32( this.getTFArray() );
+	};
+
+	/**
+	 * returns the control points of all widgets (back to front) as base64 encoded Float32Array
+	 * of N x 6 values ( widget index, value, r, g, b, a ), colors normalized to [0,1]
+	 */
+	TF_panel.prototype.getWidgetsPacked = function() {
+		var array = [];
+		for( var indexW = 0; indexW < this.widgets.length; indexW++ ) {
+			var controlPoints = this.widgets[ indexW ].controlPoints;
+			for( var indexC = 0; indexC < controlPoints.length; indexC++ ) {
+				var controlPoint = controlPoints[ indexC ];
+				var color = controlPoint.color;
+				array.push( indexW, controlPoint.value, color.r / 255, color.g / 255, color.b / 255, controlPoint.alpha );
 			}
 		}
+		return TF_panel.packFloat32( array );
 	};
 
-	TF_panel.prototype.getTF = function() {
-		return this.tf_values;
+	/**
+	 * encodes an array of numbers as base64 encoded Float32Array
+	 * in the byte order of the platform (little endian on x86)
+	 */
+	TF_panel.packFloat32 = function( array ) {
+		var bytes = new Uint8Array( new Float32Array( array ).buffer );
+		var chunkSize = 0x8000; //stay below the argument limit of String.fromCharCode.apply
+		var binary = '';
+		for( var index = 0; index < bytes.length; index += chunkSize ) {
+			binary += String.fromCharCode.apply( null, bytes.subarray( index, index + chunkSize ) );
+		}
+		return window.btoa( binary );
 	};
 
 	TF_panel.prototype.updateTF = function() {
@@ -619,9 +853,17 @@
 	};
 
 	TF_panel.prototype.plotTFResults = function( img ) {
-		var tfCanvas = document.createElement( 'canvas' );
-		tfCanvas.height = img.height || img.clientHeight;
-		tfCanvas.width = img.width || img.clientWidth;
+		//reused between plots, only resized with the image
+		if( !this.tfResultCanvas ) {
+			this.tfResultCanvas = document.createElement( 'canvas' );
+		}
+		var tfCanvas = this.tfResultCanvas;
+		var height = img.height || img.clientHeight;
+		var width = img.width || img.clientWidth;
+		if( tfCanvas.height !== height || tfCanvas.width !== width ) {
+			tfCanvas.height = height;
+			tfCanvas.width = width;
+		}
 
 		var context = tfCanvas.getContext( '2d' );
 
@@ -635,6 +877,7 @@
 			gradient.addColorStop( Math.clamp( value, 0, 1 ), rgbaColorString );
 		}
 
+		context.clearRect( 0, 0, tfCanvas.width, tfCanvas.height );
 		context.fillStyle = gradient;
 		context.fillRect( 0, 0, tfCanvas.width, tfCanvas.height );
 
@@ -1,8 +1,19 @@
 import os
+import re
+import sys
+import json
+import base64
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import unittest
+import numpy
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 import logging
+from collections import OrderedDict, deque
 
 #
 # TransferFunctionEditor
@@ -36,18 +47,11 @@ class TransferFunctionEditorWidget(ScriptedLoadableModuleWidget):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  #found this method of connecting Python to JS
-  #http://pysnippet.blogspot.com/2010/01/calling-python-from-javascript-in-pyqts.html
-  #but couldn't (yet) make it work
-  # class StupidClass():
-    # """Simple class with one slot and one read-only property."""
-    # @qt.pyqtSlot(str)
-    # def showMessage(self, msg):
-      # """Open a message box and display the specified message."""
-      # qt.QMessageBox.information(None, "Info", msg)
-
-
   def setup(self):
+    with pipelineInstrumentation.stage( 'TF module setup' ):
+      self.setupWidgets()
+
+  def setupWidgets(self):
     ScriptedLoadableModuleWidget.setup(self)
 
     # Instantiate and connect widgets ...
@@ -58,42 +62,245 @@ class TransferFunctionEditorWidget(ScriptedLoadableModuleWidget):
     parametersCollapsibleButton = ctk.ctkCollapsibleButton()
     parametersCollapsibleButton.text = "Parameters"
     self.layout.addWidget(parametersCollapsibleButton)
-	
+
+    # Layout within the dummy collapsible button
+    parametersFormLayout = qt.QFormLayout(parametersCollapsibleButton)
+
+    #
+    # input volume selector, its histogram is shown in the editor
+    #
+    self.inputSelector = slicer.qMRMLNodeComboBox()
+    self.inputSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+    self.inputSelector.selectNodeUponCreation = True
+    self.inputSelector.addEnabled = False
+    self.inputSelector.removeEnabled = False
+    self.inputSelector.noneEnabled = True
+    self.inputSelector.showHidden = False
+    self.inputSelector.showChildNodeTypes = False
+    self.inputSelector.setMRMLScene( slicer.mrmlScene )
+    self.inputSelector.setToolTip( "Pick the volume whose histogram is shown in the editor." )
+    parametersFormLayout.addRow("Input Volume: ", self.inputSelector)
+
+    #
+    # volume property the transfer function is applied to
+    #
+    self.volumePropertySelector = slicer.qMRMLNodeComboBox()
+    self.volumePropertySelector.nodeTypes = ["vtkMRMLVolumePropertyNode"]
+    self.volumePropertySelector.selectNodeUponCreation = True
+    self.volumePropertySelector.addEnabled = False
+    self.volumePropertySelector.removeEnabled = False
+    self.volumePropertySelector.noneEnabled = False
+    self.volumePropertySelector.showHidden = False
+    self.volumePropertySelector.showChildNodeTypes = False
+    self.volumePropertySelector.setMRMLScene( slicer.mrmlScene )
+    self.volumePropertySelector.setToolTip( "Pick the volume property the transfer function is applied to." )
+    parametersFormLayout.addRow("Volume Property: ", self.volumePropertySelector)
+
+    #
+    # map the editor axis onto a robust percentile window instead of the full scalar range
+    #
+    self.autoWindowCheckBox = qt.QCheckBox()
+    self.autoWindowCheckBox.checked = False
+    self.autoWindowCheckBox.setToolTip("If checked, the editor axis spans the percentile window below, so outliers (air, metal) do not squeeze the transfer function.")
+    parametersFormLayout.addRow("Auto window", self.autoWindowCheckBox)
+
+    self.percentileRangeWidget = ctk.ctkRangeWidget()
+    self.percentileRangeWidget.singleStep = 0.1
+    self.percentileRangeWidget.minimum = 0
+    self.percentileRangeWidget.maximum = 100
+    self.percentileRangeWidget.minimumValue = 1
+    self.percentileRangeWidget.maximumValue = 99
+    self.percentileRangeWidget.suffix = " %"
+    self.percentileRangeWidget.enabled = False
+    self.percentileRangeWidget.setToolTip("Lower and upper percentile of the voxel values mapped onto the editor axis.")
+    parametersFormLayout.addRow("Window percentiles", self.percentileRangeWidget)
+
+    #
+    # frame rate cap for applying transfer function changes while dragging
+    #
+    self.maxUpdateRateSlider = ctk.ctkSliderWidget()
+    self.maxUpdateRateSlider.singleStep = 1
+    self.maxUpdateRateSlider.minimum = 1
+    self.maxUpdateRateSlider.maximum = 60
+    self.maxUpdateRateSlider.value = 30
+    self.maxUpdateRateSlider.suffix = " fps"
+    self.maxUpdateRateSlider.setToolTip("Maximum number of transfer function updates per second sent to the volume property.")
+    parametersFormLayout.addRow("Max update rate", self.maxUpdateRateSlider)
+
+    #
+    # joint histogram of intensity and gradient magnitude, shows where the boundaries between materials are
+    #
+    self.gradientHistogramCheckBox = qt.QCheckBox()
+    self.gradientHistogramCheckBox.checked = False
+    self.gradientHistogramCheckBox.setToolTip("If checked, the editor background shows the voxel density over intensity (horizontal) and gradient magnitude (vertical), boundaries between materials appear as arcs.")
+    parametersFormLayout.addRow("Gradient histogram", self.gradientHistogramCheckBox)
+
+    self.logic = TransferFunctionEditorLogic()
+    self.pageLoaded = False
+    self.pendingHistogramVolume = None
+    self.pendingHistogram2DVolume = None
+
+    # Python cannot add slots visible to the page, so a hidden line edit is exposed instead:
+    # the page posts the packed transfer function through its setText slot
+    # and we receive it through textChanged (which also drops repeated states)
+    self.tfBridge = qt.QLineEdit()
+    self.tfBridge.maxLength = 1 << 24 # the default of 32767 characters would truncate large transfer functions
+    self.tfBridge.connect('textChanged(QString)', self.onTFPosted)
+    self.pendingTF = None
+    self.lastTFUpdateTime = 0
+    self.tfUpdateTimer = qt.QTimer()
+    self.tfUpdateTimer.singleShot = True
+    self.tfUpdateTimer.connect('timeout()', self.applyPendingTF)
+
+    # the web view is created and the page loaded on first enter, see createWebView
+    self.webView = None
+    self.firstInteractiveStage = None
+    self.pageBundle = TransferFunctionEditorPageBundle(
+      os.path.abspath( os.path.join( os.path.dirname( __file__ ), "Resources/web/TF.html" ) ) )
+
+    self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.autoWindowCheckBox.connect('toggled(bool)', self.onAutoWindowChanged)
+    self.percentileRangeWidget.connect('valuesChanged(double,double)', self.onWindowPercentilesChanged)
+    self.gradientHistogramCheckBox.connect('toggled(bool)', self.onGradientHistogramChanged)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+    self.onSelect()
+  def enter(self):
+    if self.webView is None:
+      # ends once the page shows the histogram, see onPageLoaded
+      self.firstInteractiveStage = pipelineInstrumentation.start( 'TF first interactive' )
+      with pipelineInstrumentation.stage( 'TF web view setup' ):
+        self.createWebView()
+    else:
+      self.webView.show()
+  def createWebView(self):
     self.webView = qt.QWebView()
     self.webView.resize( 1000, 280 )
     self.webView.setWindowTitle( 'Transfer Function Editor' )
     self.webView.settings().setAttribute(qt.QWebSettings.DeveloperExtrasEnabled, True)
+    #expose the bridge whenever the page (re)creates its window object, before any script runs
+    self.webView.page().mainFrame().connect( 'javaScriptWindowObjectCleared()', self.onJavaScriptWindowObjectCleared )
 
-    #load HTML from local path
-    file_path = os.path.abspath( os.path.join( os.path.dirname( __file__ ), "Resources/web/TF.html" ) )
+    #load the bundled page (see TransferFunctionEditorPageBundle) from local path
+    file_path = self.pageBundle.getPageFilename()
     local_url = qt.QUrl.fromLocalFile( file_path )
     self.webView.setUrl( local_url )
 
-    #myObj = StupidClass()
-    #self.webView.page().mainFrame().addToJavaScriptWindowObject("pyObj", myObj)
-
     ''' #COMMENT
     window resizing (after window creation) currently has issues:
     window.onresize (in TF.html) apparently does not get called when slicer module window is resized
     '''
 
     ''' #COMMENT
-    histogram is still missing because of missing data input
-    calculate data for histogram with
-    var histogram = Statistics.calcHistogram( data ); //(in ui.cs, expects data array and optional options)
-    tf_panel.setHistogram( histogram )
-    histogram object should contain { numBins: number, bins: array[numBins], maxBinValue: number }
+    the histogram is computed by TransferFunctionEditorLogic.computeHistogram instead of
+    Statistics.calcHistogram (in ui.js), only the compact result is handed to the page
+    histogram object contains { numBins: number, bins: array[numBins], maxBinValue: number, range: { min, max } }
     '''
     self.webView.show()
     self.webView.page().setLinkDelegationPolicy( qt.QWebPage.DelegateAllLinks )
     #connect web view to click events within webpage
     self.webView.connect( 'linkClicked(QUrl)', self.webViewCallback )
+    self.webView.connect( 'loadFinished(bool)', self.onPageLoaded )
     #frame = self.webView.page().mainFrame().evaluateJavaScript("console.log('loaded')")
-
-    # Add vertical spacer
-    self.layout.addStretch(1)
   def cleanup(self):
-    pass
+    self.tfUpdateTimer.stop()
+    if self.webView:
+      self.webView.close()
+  def onJavaScriptWindowObjectCleared(self):
+    self.webView.page().mainFrame().addToJavaScriptWindowObject( 'tfBridge', self.tfBridge )
+  def onTFPosted(self, text):
+    # keep only the latest state, it is applied at most maxUpdateRate times per second
+    self.pendingTF = text
+    if self.tfUpdateTimer.isActive():
+      return
+    interval = 1.0 / self.maxUpdateRateSlider.value
+    delay = interval - ( time.time() - self.lastTFUpdateTime )
+    self.tfUpdateTimer.start( int( max( 0, delay ) * 1000 ) )
+  def applyPendingTF(self):
+    text, self.pendingTF = self.pendingTF, None
+    if text is None:
+      return
+    self.lastTFUpdateTime = time.time()
+    vp = self.volumePropertySelector.currentNode()
+    if not vp:
+      return
+    self.applyTF( text )
+
+  def applyTF(self, packed):
+    vp = self.volumePropertySelector.currentNode()
+    with pipelineInstrumentation.stage( 'TF composite' ):
+      points = self.logic.compositeTFWidgets( self.logic.decodeTFWidgets( packed ) )
+    with pipelineInstrumentation.stage( 'TF intensity range' ):
+      intensityRange = self.getIntensityRange()
+    with pipelineInstrumentation.stage( 'TF sync' ):
+      self.logic.syncTransferFunction( vp, points, intensityRange )
+
+  def getIntensityRange(self):
+    """Range of voxel values the editor axis spans: the percentile window in auto window mode,
+    the scalar range of the input volume otherwise (None if there is no input volume).
+    """
+    percentiles = None
+    if self.autoWindowCheckBox.checked:
+      percentiles = (self.percentileRangeWidget.minimumValue, self.percentileRangeWidget.maximumValue)
+    return self.logic.getIntensityRange(self.inputSelector.currentNode(), percentiles)
+  def onAutoWindowChanged(self, checked):
+    self.percentileRangeWidget.enabled = checked
+    self.onWindowPercentilesChanged()
+  def onWindowPercentilesChanged(self, *args):
+    if not self.pageLoaded:
+      return
+    # the histogram shows the mapping, the transfer function has to follow it.
+    # Both come from the cached statistics, the transfer function at most maxUpdateRate times per second
+    self.pendingHistogramVolume = self.inputSelector.currentNode()
+    self.onExactHistogram()
+    if self.volumePropertySelector.currentNode():
+      self.onTFPosted( self.readTF() )
+  def onPageLoaded(self, ok):
+    self.pageLoaded = ok
+    if ok:
+      self.onSelect()
+    if self.firstInteractiveStage:
+      self.firstInteractiveStage.finish()
+      self.firstInteractiveStage = None
+  def onSelect(self):
+    volumeNode = self.inputSelector.currentNode()
+    if not self.pageLoaded or not self.logic.hasImageData(volumeNode):
+      return
+    # show a subsampled preview right away, the exact histogram follows once the GUI is idle
+    intensityRange = self.getIntensityRange()
+    self.setHistogram(self.logic.computeHistogram(volumeNode, preview=True, scalarRange=intensityRange))
+    self.pendingHistogramVolume = volumeNode
+    qt.QTimer.singleShot(0, self.onExactHistogram)
+  def onExactHistogram(self):
+    volumeNode = self.pendingHistogramVolume
+    self.pendingHistogramVolume = None
+    if volumeNode is None or volumeNode != self.inputSelector.currentNode() or not self.logic.hasImageData(volumeNode):
+      return
+    scalarRange = self.getIntensityRange() if self.autoWindowCheckBox.checked else None
+    self.setHistogram(self.logic.computeHistogram(volumeNode, scalarRange=scalarRange))
+    if self.gradientHistogramCheckBox.checked:
+      # the gradients take longest, they come last
+      self.pendingHistogram2DVolume = volumeNode
+      qt.QTimer.singleShot(0, self.onHistogram2D)
+  def onGradientHistogramChanged(self, checked):
+    if checked:
+      self.onSelect()
+    elif self.pageLoaded:
+      self.setHistogram2D(None)
+  def onHistogram2D(self):
+    volumeNode = self.pendingHistogram2DVolume
+    self.pendingHistogram2DVolume = None
+    if volumeNode is None or volumeNode != self.inputSelector.currentNode() or not self.gradientHistogramCheckBox.checked:
+      return
+    scalarRange = self.getIntensityRange() if self.autoWindowCheckBox.checked else None
+    with pipelineInstrumentation.stage( 'TF gradient histogram' ):
+      self.setHistogram2D(self.logic.computeHistogram2D(volumeNode, scalarRange=scalarRange))
+  def setHistogram(self, histogram):
+    self.webView.page().mainFrame().evaluateJavaScript( 'tf_panel.setHistogram( %s )' % json.dumps( histogram ) )
+  def setHistogram2D(self, histogram2D):
+    self.webView.page().mainFrame().evaluateJavaScript( 'tf_panel.setHistogram2D( %s )' % json.dumps( histogram2D ) )
   def webViewCallback(self,qurl):
     #url = qurl.toString()
     #print(url)
@@ -101,41 +308,15 @@ class TransferFunctionEditorWidget(ScriptedLoadableModuleWidget):
     self.updateTF()
     pass
   def updateTF(self):
-    vp = slicer.util.getNode('VolumeProperty')
-    wasModifying = vp.StartModify()
-    colorTF = vp.GetColor()
-    opacityTF = vp.GetScalarOpacity()
-
-    colorRange = colorTF.GetRange()
-    cR = colorRange[ 1 ] - colorRange[ 0 ]
-    opacityRange = opacityTF.GetRange()
-    cO = opacityRange[ 1 ] - opacityRange[ 0 ]
-
-    colorTF.RemoveAllPoints() #probably shouldn't remove all of them at each update
-    opacityTF.RemoveAllPoints()
-
-    tf_values = self.webView.page().mainFrame().evaluateJavaScript( 'tf_panel.getTF()' )
-    colorTF.SetColorSpaceToRGB()
-
-    colorTF.AddRGBPoint( colorRange[ 0 ], 0, 0, 0 ) #add points for 0 and 1
-    colorTF.AddRGBPoint( colorRange[ 1 ], 0, 0, 0 )
-
-    opacityTF.AddPoint( opacityRange[ 0 ], 0 ) #add points for 0 and 1
-    opacityTF.AddPoint( opacityRange[ 1 ], 0 )
-
-    for( x, color ) in tf_values:
-      x = max( 0, min( x, 1 ) ) #prevent x from going out of range
-
-      xC = colorRange[ 0 ] + ( cR * x ) #'denormalize' range
-      xO = opacityRange[ 0 ] + ( cO * x ) #'denormalize' range
-      r = color[ 'r' ] / 255 #normalize RGB
-      g = color[ 'g' ] / 255
-      b = color[ 'b' ] / 255
-      a = color[ 'a' ]
-      colorTF.AddRGBPoint( xC, r, g, b )
-      opacityTF.AddPoint( xO, a )
-    vp.EndModify(wasModifying)
-    pass
+    vp = self.volumePropertySelector.currentNode()
+    if not vp:
+      return
+    self.applyTF( self.readTF() )
+  def readTF(self):
+    with pipelineInstrumentation.stage( 'TF read widgets' ) as stage:
+      packed = self.webView.page().mainFrame().evaluateJavaScript( 'tf_panel.getWidgetsPacked()' )
+      stage.numberOfBytes = len( packed )
+    return packed
 #
 # TransferFunctionEditorLogic
 #
@@ -150,6 +331,11 @@ class TransferFunctionEditorLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # (volume property node ID, 'color' or 'opacity') -> (function MTime, applied points)
+    self.appliedTFPoints = {}
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -177,6 +363,454 @@ class TransferFunctionEditorLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  # number of voxels processed per vectorized pass, bounds the temporaries to a few MB
+  histogramChunkSize = 1 << 22
+  # approximate number of voxels used for a preview histogram
+  previewSampleCount = 1 << 20
+
+  def getScalarArray(self, imageData):
+    """Returns the first scalar component of imageData as a flat NumPy array.
+    The array is a view on the VTK buffer, no voxel data is copied.
+    """
+    scalars = imageData.GetPointData().GetScalars()
+    array = numpy_support.vtk_to_numpy(scalars)
+    if array.ndim > 1:
+      array = array[:, 0]
+    return array
+
+  def iterateChunks(self, array, sampleStep=1):
+    """Yields consecutive views of at most histogramChunkSize voxels,
+    taking every sampleStep-th voxel of array.
+    """
+    chunkSize = self.histogramChunkSize * sampleStep
+    for start in range(0, array.shape[0], chunkSize):
+      yield array[start:start + chunkSize:sampleStep]
+
+  def getFiniteValues(self, chunk):
+    """Returns chunk without NaN and infinite values, which have no place on the editor axis.
+    """
+    if chunk.dtype.kind != 'f':
+      return chunk
+    finite = numpy.isfinite(chunk)
+    return chunk if finite.all() else chunk[finite]
+
+  def computeScalarRange(self, array, sampleStep=1, sketch=None):
+    """Returns (min, max) of the finite values of array computed chunk by chunk,
+    (0, 0) if there are none. If a QuantileSketch is given, it is fed in the same pass.
+    """
+    minValue, maxValue = None, None
+    for chunk in self.iterateChunks(array, sampleStep):
+      chunk = self.getFiniteValues(chunk)
+      if chunk.shape[0] == 0:
+        continue
+      chunkMin, chunkMax = chunk.min(), chunk.max()
+      if minValue is None or chunkMin < minValue:
+        minValue = chunkMin
+      if maxValue is None or chunkMax > maxValue:
+        maxValue = chunkMax
+      if sketch is not None:
+        sketch.update(chunk[::sketch.sampleStep], sampleStep * sketch.sampleStep)
+    if minValue is None:
+      return 0.0, 0.0
+    return float(minValue), float(maxValue)
+
+  def computeHistogramBins(self, array, numBins, scalarRange, sampleStep=1):
+    """Counts the voxels of array in numBins equally sized bins spanning scalarRange.
+    Values outside of scalarRange are counted in the first and last bin, NaN and
+    infinite values are not counted.
+    """
+    minValue, maxValue = scalarRange
+    binScale = numBins / (maxValue - minValue) if maxValue > minValue else 0.0
+    bins = numpy.zeros(numBins, dtype=numpy.int64)
+    for chunk in self.iterateChunks(array, sampleStep):
+      indices = (self.getFiniteValues(chunk) - minValue) * binScale
+      numpy.clip(indices, 0, numBins - 1, out=indices)
+      bins += numpy.bincount(indices.astype(numpy.intp), minlength=numBins)
+    return bins
+
+  def computeHistogram(self, volumeNode, numBins=256, preview=False, scalarRange=None):
+    """Computes the histogram of volumeNode in the format expected by TF_panel.setHistogram:
+    { numBins, bins, maxBinValue, range: { min, max } }
+    If preview is set, only about previewSampleCount voxels are visited
+    and the counts are scaled up to the full voxel count.
+    Exact histograms come from volumeStatisticsCache, windows onto the scalar range are
+    re-binned from its finest histogram, so moving a window does not scan the voxels.
+    """
+    if not preview:
+      scalarRange = scalarRange or volumeStatisticsCache.getScalarRange(volumeNode)
+      bins = volumeStatisticsCache.getHistogram(volumeNode, numBins, scalarRange)
+    else:
+      array = self.getScalarArray(volumeNode.GetImageData())
+      sampleStep = max(1, array.shape[0] // self.previewSampleCount)
+      if scalarRange is None:
+        scalarRange = self.computeScalarRange(array, sampleStep)
+      bins = self.computeHistogramBins(array, numBins, scalarRange, sampleStep) * sampleStep
+    return {
+      'numBins': numBins,
+      'bins': bins.tolist(),
+      'maxBinValue': int(bins.max()),
+      'range': {'min': scalarRange[0], 'max': scalarRange[1]}
+    }
+
+  def getIntensityRange(self, volumeNode, percentiles=None):
+    """Range of voxel values the editor axis spans: the window between the (lower, upper)
+    percentiles if given (see computeAutoWindow), the scalar range of volumeNode otherwise.
+    None if volumeNode has no image data.
+    """
+    if not self.hasImageData(volumeNode):
+      return None
+    if percentiles:
+      return self.computeAutoWindow(volumeNode, *percentiles)
+    return volumeStatisticsCache.getScalarRange(volumeNode)
+
+  def computeAutoWindow(self, volumeNode, lowerPercentile=1.0, upperPercentile=99.0):
+    """Returns the (lower, upper) percentile values of volumeNode, a window onto which the
+    editor axis can be mapped without outlier voxels squeezing the interesting range.
+    """
+    lower = volumeStatisticsCache.getPercentile(volumeNode, lowerPercentile)
+    upper = volumeStatisticsCache.getPercentile(volumeNode, upperPercentile)
+    if upper <= lower:
+      return volumeStatisticsCache.getScalarRange(volumeNode)
+    return lower, upper
+
+  # voxels per slab of the gradient computation, every worker thread holds a few float32 copies of one slab
+  gradientSlabVoxels = 1 << 20
+  # slices per slab at least, thinner slabs would spend most of their time on the halo slices
+  gradientSlabMinimumSlices = 8
+  # slices visited to estimate the gradient magnitude range
+  gradientRangeSampleSlices = 16
+  # sampled gradient magnitudes above this percentile end up in the last gradient bin
+  gradientRangePercentile = 99.5
+
+  def getVolumeArray(self, imageData):
+    """Returns the first scalar component of imageData as (z, y, x) NumPy array view.
+    """
+    dimensions = imageData.GetDimensions()
+    return self.getScalarArray(imageData).reshape(dimensions[2], dimensions[1], dimensions[0])
+
+  def getSlabs(self, volume):
+    """Returns (start, stop) slice ranges of at most gradientSlabVoxels voxels covering volume,
+    but of at least gradientSlabMinimumSlices slices.
+    """
+    slabSize = max(self.gradientSlabMinimumSlices, self.gradientSlabVoxels // (volume.shape[1] * volume.shape[2]))
+    return [(start, min(start + slabSize, volume.shape[0])) for start in range(0, volume.shape[0], slabSize)]
+
+  def computeGradientMagnitude(self, volume, spacing, start, stop):
+    """Returns the gradient magnitude of the slices start to stop of volume (z, y, x) as float32,
+    by central differences like numpy.gradient over the whole volume: the slab is read with one
+    slice of halo on either side. spacing is (x, y, z) like volume node spacing.
+    """
+    lower, upper = max(0, start - 1), min(volume.shape[0], stop + 1)
+    block = volume[lower:upper].astype(numpy.float32)
+    # axes of a single voxel (e.g. 2D images) have no gradient
+    axes = [axis for axis in range(3) if block.shape[axis] > 1]
+    magnitude = numpy.zeros((stop - start,) + block.shape[1:], dtype=numpy.float32)
+    if not axes:
+      return magnitude
+    squeezed = block.reshape([block.shape[axis] for axis in axes])
+    gradients = numpy.gradient(squeezed, *[spacing[2 - axis] for axis in axes])
+    if len(axes) == 1:
+      gradients = [gradients]
+    for gradient in gradients:
+      gradient = gradient.reshape(block.shape)[start - lower:stop - lower]
+      magnitude += gradient * gradient
+    return numpy.sqrt(magnitude, out=magnitude)
+
+  def estimateGradientRange(self, volume, spacing):
+    """Returns (0, upper) with upper the gradientRangePercentile of the gradient magnitudes
+    in gradientRangeSampleSlices evenly spaced slices of volume.
+    """
+    slices = numpy.unique(numpy.linspace(0, volume.shape[0] - 1, self.gradientRangeSampleSlices).astype(int))
+    samples = [self.computeGradientMagnitude(volume, spacing, start, start + 1).ravel() for start in slices]
+    upper = float(numpy.percentile(numpy.concatenate(samples), self.gradientRangePercentile))
+    if upper <= 0:
+      upper = float(max(sample.max() for sample in samples)) or 1.0
+    return 0.0, upper
+
+  def computeJointHistogram(self, volume, spacing, numBins, numGradientBins, scalarRange, gradientRange,
+                            numberOfThreads=None):
+    """Counts the voxels of volume (z, y, x) in numBins x numGradientBins bins of intensity and
+    gradient magnitude spanning scalarRange and gradientRange, values outside in the border bins.
+    Slabs are processed in parallel by numberOfThreads (default: one per CPU), NumPy releases
+    the interpreter lock in the heavy parts.
+    """
+    minValue, maxValue = scalarRange
+    binScale = numBins / (maxValue - minValue) if maxValue > minValue else 0.0
+    gradientScale = numGradientBins / (gradientRange[1] - gradientRange[0]) if gradientRange[1] > gradientRange[0] else 0.0
+
+    def countSlab(slab):
+      start, stop = slab
+      magnitude = self.computeGradientMagnitude(volume, spacing, start, stop)
+      magnitude -= gradientRange[0]
+      magnitude *= gradientScale
+      numpy.clip(magnitude, 0, numGradientBins - 1, out=magnitude)
+      indices = (volume[start:stop] - minValue) * binScale
+      numpy.clip(indices, 0, numBins - 1, out=indices)
+      joint = indices.astype(numpy.intp) * numGradientBins
+      joint += magnitude.astype(numpy.intp)
+      return numpy.bincount(joint.ravel(), minlength=numBins * numGradientBins)
+
+    pool = ThreadPool(numberOfThreads or multiprocessing.cpu_count())
+    try:
+      bins = numpy.zeros(numBins * numGradientBins, dtype=numpy.int64)
+      for counts in pool.imap_unordered(countSlab, self.getSlabs(volume)):
+        bins += counts
+    finally:
+      pool.terminate()
+    return bins.reshape(numBins, numGradientBins)
+
+  def computeHistogram2D(self, volumeNode, numBins=256, numGradientBins=128, scalarRange=None):
+    """Computes the joint histogram of intensity and gradient magnitude of volumeNode in the
+    format expected by TF_panel.setHistogram2D:
+    { width, height, densities, range: { min, max }, gradientRange: { min, max } }
+    densities is a base64 encoded width x height uint8 image of the logarithmic counts,
+    row by row from the highest gradient magnitude. The counts come from volumeStatisticsCache.
+    """
+    scalarRange = scalarRange or volumeStatisticsCache.getScalarRange(volumeNode)
+    bins, gradientRange = volumeStatisticsCache.getHistogram2D(volumeNode, numBins, numGradientBins, scalarRange)
+    densities = numpy.log1p(bins.astype(numpy.float64))
+    if densities.max() > 0:
+      densities *= 255.0 / densities.max()
+    image = numpy.ascontiguousarray(densities.T[::-1], dtype=numpy.uint8)
+    return {
+      'width': numBins,
+      'height': numGradientBins,
+      'densities': base64.b64encode(image.tobytes()).decode('ascii'),
+      'range': {'min': scalarRange[0], 'max': scalarRange[1]},
+      'gradientRange': {'min': gradientRange[0], 'max': gradientRange[1]}
+    }
+
+  def denormalizeTFPoints(self, points, colorRange, opacityRange):
+    """Maps editor points (x, r, g, b, a) with x in [0,1] onto the color and opacity ranges.
+    Returns sorted color nodes (x, r, g, b) and opacity nodes (x, a) including
+    transparent black nodes at both range ends. Later points replace earlier
+    points at the same position, as AddRGBPoint/AddPoint would.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 5)
+    x = numpy.clip(points[:, 0], 0, 1) #prevent x from going out of range
+    cR = colorRange[1] - colorRange[0]
+    cO = opacityRange[1] - opacityRange[0]
+    colorNodes = numpy.empty((points.shape[0] + 2, 4))
+    colorNodes[:2] = [[colorRange[0], 0, 0, 0], [colorRange[1], 0, 0, 0]]
+    colorNodes[2:, 0] = colorRange[0] + cR * x #'denormalize' range
+    colorNodes[2:, 1:] = points[:, 1:4]
+    opacityNodes = numpy.empty((points.shape[0] + 2, 2))
+    opacityNodes[:2] = [[opacityRange[0], 0], [opacityRange[1], 0]]
+    opacityNodes[2:, 0] = opacityRange[0] + cO * x
+    opacityNodes[2:, 1] = points[:, 4]
+    return self.uniqueTFNodes(colorNodes), self.uniqueTFNodes(opacityNodes)
+
+  def decodeTFPoints(self, packed):
+    """Decodes the base64 encoded Float32Array posted by TF_panel.getTFPacked
+    into an N x 5 array of x, r, g, b, a values.
+    """
+    return numpy.frombuffer(base64.b64decode(packed), dtype='<f4').reshape(-1, 5)
+
+  def decodeTFWidgets(self, packed):
+    """Decodes the base64 encoded Float32Array posted by TF_panel.getWidgetsPacked
+    into a list of K x 5 arrays of control points (value, r, g, b, a), one per widget.
+    """
+    rows = numpy.frombuffer(base64.b64decode(packed), dtype='<f4').reshape(-1, 6)
+    starts = numpy.flatnonzero(numpy.diff(rows[:, 0])) + 1
+    return [widget for widget in numpy.split(rows[:, 1:], starts) if len(widget)]
+
+  def parseTFWidget(self, widget):
+    """Returns the control points of a widget as K x 5 array (value, r, g, b, a) sorted by value.
+    widget is either such an array or a dict as returned by TF_widget.getOptions,
+    {'controlPoints': [{'value': 0.2, 'alpha': 0.5, 'color': '#ff8000'}, ...]},
+    where color may also be given as {'r': 255, 'g': 128, 'b': 0}.
+    """
+    if isinstance(widget, dict):
+      rows = []
+      for point in widget['controlPoints']:
+        color = point['color']
+        if isinstance(color, dict):
+          rgb = (color['r'], color['g'], color['b'])
+        else:
+          color = color.lstrip('#')
+          rgb = (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16))
+        rows.append((point['value'], rgb[0] / 255.0, rgb[1] / 255.0, rgb[2] / 255.0, point['alpha']))
+      widget = rows
+    points = numpy.asarray(widget, dtype=numpy.float64).reshape(-1, 5)
+    return points[numpy.argsort(points[:, 0], kind='mergesort')]
+
+  def compositeTFWidgets(self, widgets, eps=1e-4):
+    """Blends overlapping transfer function widgets into one transfer function like
+    TF_panel.updateTF does: every widget is sampled at all control point positions
+    (plus just outside of each widget to keep its edges vertical) and the widgets are
+    composited front to back, the last widget being in front.
+    widgets is a list of widget definitions accepted by parseTFWidget.
+    Returns an N x 5 array of (x, r, g, b, a) with colors normalized to [0,1].
+    """
+    widgets = [points for points in map(self.parseTFWidget, widgets) if len(points)]
+    if not widgets:
+      return numpy.zeros((0, 5))
+    samples = numpy.unique(numpy.concatenate(
+      [numpy.concatenate((points[:, 0], [points[0, 0] - eps, points[-1, 0] + eps])) for points in widgets]))
+
+    color = numpy.zeros((samples.shape[0], 3))
+    alpha = numpy.zeros(samples.shape[0])
+    for points in reversed(widgets):
+      inside = (samples >= points[0, 0]) & (samples <= points[-1, 0])
+      widgetColor = numpy.column_stack([numpy.interp(samples, points[:, 0], points[:, channel]) for channel in (1, 2, 3)])
+      # alpha this widget adds behind the widgets in front of it
+      weight = numpy.interp(samples, points[:, 0], points[:, 4]) * inside * (1 - alpha)
+      color += weight[:, numpy.newaxis] * widgetColor
+      alpha += weight
+    visible = alpha > 0
+    color[visible] /= alpha[visible, numpy.newaxis]
+    return numpy.column_stack((samples, color, alpha))
+
+  def uniqueTFNodes(self, nodes):
+    """Returns the rows of nodes sorted by their first column as list of tuples.
+    Of several rows at the same position the last one is kept.
+    """
+    # numpy.unique reports the first occurrence, so look at the rows in reverse
+    reversedNodes = nodes[::-1]
+    positions, indices = numpy.unique(reversedNodes[:, 0], return_index=True)
+    return [tuple(node) for node in reversedNodes[indices].tolist()]
+
+  def readTFPoints(self, function, numberOfValues):
+    """Returns the nodes of a vtkColorTransferFunction (numberOfValues=4: x, r, g, b)
+    or of a vtkPiecewiseFunction (numberOfValues=2: x, y) as a list of tuples.
+    """
+    points = []
+    value = [0.0] * (numberOfValues + 2) # + midpoint and sharpness
+    for index in range(function.GetSize()):
+      function.GetNodeValue(index, value)
+      points.append(tuple(value[:numberOfValues]))
+    return points
+
+  def computeTFChanges(self, oldPoints, newPoints):
+    """Returns the (removed, moved, added) changes that turn the sorted oldPoints into
+    the sorted newPoints, or None if they are equal.
+    removed lists x positions, moved lists (index, point) pairs for SetNodeValue
+    in an order that never lets nodes pass each other, added lists points.
+    """
+    if oldPoints == newPoints:
+      return None
+    if len(oldPoints) == len(newPoints):
+      # same number of nodes: update the ones that differ in place, moving nodes to
+      # the right from the top and nodes to the left from the bottom keeps the order
+      rightMoves, leftMoves = [], []
+      for index, (oldPoint, newPoint) in enumerate(zip(oldPoints, newPoints)):
+        if oldPoint == newPoint:
+          continue
+        if newPoint[0] >= oldPoint[0]:
+          rightMoves.append((index, newPoint))
+        else:
+          leftMoves.append((index, newPoint))
+      return [], rightMoves[::-1] + leftMoves, []
+    newPositions = set(point[0] for point in newPoints)
+    oldPointSet = set(oldPoints)
+    removed = [point[0] for point in oldPoints if point[0] not in newPositions]
+    added = [point for point in newPoints if point not in oldPointSet]
+    return removed, [], added
+
+  def applyTFChanges(self, function, changes, points, addPoint):
+    """Applies changes from computeTFChanges to function, addPoint is its AddRGBPoint/AddPoint.
+    If most nodes change anyway, function is refilled from points in one call.
+    """
+    removed, moved, added = changes
+    if len(removed) + len(moved) + len(added) >= len(points):
+      function.FillFromDataPointer(len(points), numpy.array(points, dtype=numpy.float64).ravel())
+      return
+    for x in removed:
+      function.RemovePoint(x)
+    for index, point in moved:
+      function.SetNodeValue(index, list(point) + [0.5, 0.0])
+    for point in added:
+      addPoint(*point)
+
+  def getAppliedTFPoints(self, key, function, numberOfValues):
+    """Returns the points last applied to function by syncTransferFunction,
+    or its current nodes if it was modified elsewhere since.
+    """
+    applied = self.appliedTFPoints.get(key)
+    if applied and applied[0] == function.GetMTime():
+      return applied[1]
+    return self.readTFPoints(function, numberOfValues)
+
+  def syncTransferFunction(self, volumePropertyNode, points, intensityRange=None):
+    """Makes the color and scalar opacity functions of volumePropertyNode match the
+    editor points (N x 5 array or sequence of x, r, g, b, a), all normalized to [0,1].
+    x is mapped onto intensityRange if given (e.g. from computeAutoWindow),
+    otherwise onto the current range of each function.
+    Returns False if nothing had to change.
+    """
+    if intensityRange is not None:
+      colorRange = opacityRange = tuple(intensityRange)
+    else:
+      colorRange = volumePropertyNode.GetColor().GetRange()
+      opacityRange = volumePropertyNode.GetScalarOpacity().GetRange()
+    colorPoints, opacityPoints = self.denormalizeTFPoints(points, colorRange, opacityRange)
+    return self.syncTransferFunctionNodes(volumePropertyNode, colorPoints, opacityPoints)
+
+  def syncTransferFunctionNodes(self, volumePropertyNode, colorPoints, opacityPoints):
+    """Makes the functions of volumePropertyNode match the color nodes (x, r, g, b) and
+    opacity nodes (x, a) from denormalizeTFPoints. Only nodes that differ from the
+    last applied state are touched, all in a single StartModify/EndModify batch.
+    Returns False if nothing had to change.
+    """
+    colorTF = volumePropertyNode.GetColor()
+    opacityTF = volumePropertyNode.GetScalarOpacity()
+    colorKey = (volumePropertyNode.GetID(), 'color')
+    opacityKey = (volumePropertyNode.GetID(), 'opacity')
+
+    colorChanges = self.computeTFChanges(self.getAppliedTFPoints(colorKey, colorTF, 4), colorPoints)
+    opacityChanges = self.computeTFChanges(self.getAppliedTFPoints(opacityKey, opacityTF, 2), opacityPoints)
+    if colorChanges is None and opacityChanges is None and colorTF.GetColorSpace() == vtk.VTK_CTF_RGB:
+      return False
+
+    wasModifying = volumePropertyNode.StartModify()
+    colorTF.SetColorSpaceToRGB()
+    if colorChanges:
+      self.applyTFChanges(colorTF, colorChanges, colorPoints, colorTF.AddRGBPoint)
+    if opacityChanges:
+      self.applyTFChanges(opacityTF, opacityChanges, opacityPoints, opacityTF.AddPoint)
+    volumePropertyNode.EndModify(wasModifying)
+
+    self.appliedTFPoints[colorKey] = (colorTF.GetMTime(), colorPoints)
+    self.appliedTFPoints[opacityKey] = (opacityTF.GetMTime(), opacityPoints)
+    return True
+
+  def loadTransferFunction(self, tf):
+    """Returns the normalized N x 5 points (x, r, g, b, a) of a serialized transfer function.
+    tf is a JSON string or dict in the format written by TF_panel.exportOptions
+    ({'widgets': [...]}, blended with compositeTFWidgets) or with a 'points' list,
+    or directly a sequence of points.
+    """
+    if isinstance(tf, basestring):
+      tf = json.loads(tf)
+    if isinstance(tf, dict):
+      if 'widgets' in tf:
+        return self.compositeTFWidgets(tf['widgets'])
+      tf = tf['points']
+    return numpy.asarray(tf, dtype=numpy.float64).reshape(-1, 5)
+
+  def applyTransferFunction(self, volumePropertyNodes, tf, intensityRange=None):
+    """Applies the serialized transfer function tf (see loadTransferFunction) to all
+    volumePropertyNodes without any GUI. The editor axis is mapped onto intensityRange
+    if given, otherwise onto the current range of each node's functions.
+    Nodes sharing the same ranges reuse the same denormalized points.
+    Returns the number of nodes that were modified.
+    """
+    points = self.loadTransferFunction(tf)
+    denormalizedPoints = {}
+    modifiedCount = 0
+    for volumePropertyNode in volumePropertyNodes:
+      if intensityRange is not None:
+        colorRange = opacityRange = tuple(intensityRange)
+      else:
+        colorRange = volumePropertyNode.GetColor().GetRange()
+        opacityRange = volumePropertyNode.GetScalarOpacity().GetRange()
+      key = (colorRange, opacityRange)
+      if key not in denormalizedPoints:
+        denormalizedPoints[key] = self.denormalizeTFPoints(points, colorRange, opacityRange)
+      if self.syncTransferFunctionNodes(volumePropertyNode, *denormalizedPoints[key]):
+        modifiedCount += 1
+    return modifiedCount
+
   def takeScreenshot(self,name,description,type=-1):
     # show the message even if not taking a screen shot
     slicer.util.delayDisplay('Take screenshot: '+description+'.\nResult is available in the Annotations module.', 3000)
@@ -238,6 +872,567 @@ class TransferFunctionEditorLogic(ScriptedLoadableModuleLogic):
     return True
 
 
+#
+# QuantileSketch
+#
+
+class QuantileSketch(object):
+  """Approximate quantiles of a stream of value chunks in a single pass, without knowing
+  the value range in advance. Every chunk is reduced to `resolution` evenly spaced
+  order statistics of a strided subsample, each weighted by the number of values it
+  stands for. Quantiles are interpolated from the merged, weighted summaries.
+  """
+
+  def __init__(self, resolution=1024, sampleStep=16):
+    self.resolution = resolution
+    # callers feed every sampleStep-th value of a chunk, sorting is the dominant cost
+    self.sampleStep = sampleStep
+    self.values = []
+    self.weights = []
+    self.storedCount = 0
+
+  def update(self, values, weight=1.0):
+    """Adds values, each standing for weight values of the stream.
+    """
+    count = values.shape[0]
+    if count == 0:
+      return
+    values = numpy.sort(values)
+    if count > self.resolution:
+      indices = ((numpy.arange(self.resolution) + 0.5) * count / self.resolution).astype(numpy.intp)
+      values = values[indices]
+      weight = weight * count / float(self.resolution)
+    self.values.append(values.astype(numpy.float64))
+    self.weights.append(numpy.full(values.shape[0], weight))
+    self.storedCount += values.shape[0]
+    if self.storedCount > 64 * self.resolution:
+      self.compact()
+
+  def merged(self):
+    """Returns all stored values sorted, with their weights.
+    """
+    values = numpy.concatenate(self.values)
+    weights = numpy.concatenate(self.weights)
+    order = numpy.argsort(values, kind='mergesort')
+    return values[order], weights[order]
+
+  def compact(self):
+    """Replaces the stored summaries by a single one of 4 * resolution values.
+    """
+    values, weights = self.merged()
+    summarySize = 4 * self.resolution
+    self.values = [self.quantiles((numpy.arange(summarySize) + 0.5) / summarySize)]
+    self.weights = [numpy.full(summarySize, weights.sum() / summarySize)]
+    self.storedCount = summarySize
+
+  def quantiles(self, fractions):
+    """Returns the values below which the given fractions (0-1) of the stream lie.
+    """
+    values, weights = self.merged()
+    cumulative = numpy.cumsum(weights)
+    # rank of each stored value is the middle of the interval it stands for
+    ranks = (cumulative - 0.5 * weights) / cumulative[-1]
+    return numpy.interp(fractions, ranks, values)
+
+
+#
+# VolumeStatisticsCache
+#
+
+class VolumeStatisticsCache(object):
+  """Keeps the scalar range, histograms (also of intensity x gradient magnitude) and
+  percentiles of recently used volumes, so that the editor and other modules
+  (e.g. ExposureRenderLink) scan each volume only once. Entries are keyed by volume node ID and are dropped when the
+  MTime of the node's image data changes. The least recently used entries are
+  evicted once their arrays exceed memoryBudget bytes.
+  Use the shared instance volumeStatisticsCache.
+  """
+
+  # histograms with fewer bins are summed up from this one if the bin count divides it
+  finestNumBins = 4096
+  # intensity bins of the joint histogram that the others are summed up or re-binned from
+  finestNumBins2D = 1024
+  # percentiles are tabulated in steps of 0.1
+  numPercentiles = 1001
+
+  def __init__(self, memoryBudget=64 * 1024 * 1024):
+    self.memoryBudget = memoryBudget
+    self.entries = OrderedDict()
+    self.logic = TransferFunctionEditorLogic()
+
+  def getEntry(self, volumeNode):
+    """Returns the cache entry of volumeNode, a new one if its image data was modified.
+    """
+    imageData = volumeNode.GetImageData()
+    key = volumeNode.GetID() or id(volumeNode)
+    entry = self.entries.pop(key, None)
+    if entry is None or entry['mtime'] != imageData.GetMTime():
+      entry = {'mtime': imageData.GetMTime(), 'scalarRange': None, 'histograms': {}, 'histograms2D': {},
+               'percentiles': None}
+    self.entries[key] = entry # most recently used entries are at the end
+    return entry
+
+  def invalidate(self, volumeNode=None):
+    """Drops the entry of volumeNode, or all entries.
+    """
+    if volumeNode is None:
+      self.entries.clear()
+    else:
+      self.entries.pop(volumeNode.GetID() or id(volumeNode), None)
+
+  def entrySize(self, entry):
+    size = sum(bins.nbytes for bins in entry['histograms'].values())
+    size += sum(bins.nbytes for bins, gradientRange in entry['histograms2D'].values())
+    if entry['percentiles'] is not None:
+      size += entry['percentiles'].nbytes
+    return size
+
+  def evict(self):
+    """Drops least recently used entries until the cache fits into memoryBudget,
+    the most recently used entry is always kept.
+    """
+    totalSize = sum(self.entrySize(entry) for entry in self.entries.values())
+    while totalSize > self.memoryBudget and len(self.entries) > 1:
+      key, entry = self.entries.popitem(last=False)
+      totalSize -= self.entrySize(entry)
+
+  def getScalarRange(self, volumeNode):
+    """Returns (min, max) of the first scalar component of volumeNode.
+    The percentile table is filled in the same pass over the voxels.
+    """
+    entry = self.getEntry(volumeNode)
+    if entry['scalarRange'] is None:
+      array = self.logic.getScalarArray(volumeNode.GetImageData())
+      sketch = QuantileSketch()
+      entry['scalarRange'] = self.logic.computeScalarRange(array, sketch=sketch)
+      entry['percentiles'] = sketch.quantiles(numpy.linspace(0, 1, self.numPercentiles))
+      self.evict()
+    return entry['scalarRange']
+
+  def getHistogram(self, volumeNode, numBins=256, window=None):
+    """Returns the histogram of volumeNode over its scalar range as array of numBins counts.
+    With a (min, max) window the counts are spread over the window instead (see rebinHistogram).
+    """
+    scalarRange = self.getScalarRange(volumeNode)
+    if window is not None and tuple(window) != scalarRange:
+      return self.rebinHistogram(self.getHistogram(volumeNode, self.finestNumBins), scalarRange, numBins, window)
+    entry = self.getEntry(volumeNode)
+    histograms = entry['histograms']
+    if numBins not in histograms:
+      if self.finestNumBins % numBins == 0:
+        finest = self.getHistogram(volumeNode, self.finestNumBins) if numBins != self.finestNumBins else None
+        if finest is not None:
+          histograms[numBins] = finest.reshape(numBins, -1).sum(axis=1)
+      if numBins not in histograms:
+        array = self.logic.getScalarArray(volumeNode.GetImageData())
+        histograms[numBins] = self.logic.computeHistogramBins(array, numBins, scalarRange)
+      self.evict()
+    return histograms[numBins]
+
+  def rebinHistogram(self, bins, scalarRange, numBins, window):
+    """Returns the counts of bins (over scalarRange along the first axis) in numBins bins over
+    window, assuming the values are evenly spread within each bin. Values outside of window
+    are counted in the first and last bin, like computeHistogramBins does. Further axes
+    (e.g. the gradient magnitude of a joint histogram) are kept.
+    """
+    if scalarRange[1] <= scalarRange[0]:
+      # all values are the same
+      windowBins = numpy.zeros((numBins,) + bins.shape[1:], dtype=numpy.int64)
+      binScale = numBins / (window[1] - window[0]) if window[1] > window[0] else 0.0
+      windowBins[int(numpy.clip((scalarRange[0] - window[0]) * binScale, 0, numBins - 1))] = bins.sum(axis=0)
+      return windowBins
+    count = bins.shape[0]
+    cumulative = numpy.concatenate((numpy.zeros((1,) + bins.shape[1:]), numpy.cumsum(bins, axis=0)))
+    # fractional bin indices of the window bin edges, the cumulative counts are interpolated there
+    positions = numpy.interp(numpy.linspace(window[0], window[1], numBins + 1),
+                             numpy.linspace(scalarRange[0], scalarRange[1], count + 1), numpy.arange(count + 1))
+    lower = numpy.minimum(positions.astype(numpy.intp), count - 1)
+    fraction = (positions - lower).reshape((-1,) + (1,) * (bins.ndim - 1))
+    windowCumulative = numpy.rint(cumulative[lower] * (1 - fraction) + cumulative[lower + 1] * fraction)
+    # rounding the cumulative counts keeps the total, the values outside go to the border bins
+    windowCumulative[0] = 0
+    windowCumulative[-1] = cumulative[-1]
+    return numpy.diff(windowCumulative, axis=0).astype(numpy.int64)
+
+  def getHistogram2D(self, volumeNode, numBins=256, numGradientBins=128, window=None):
+    """Returns the joint histogram of intensity and gradient magnitude of volumeNode as
+    numBins x numGradientBins array of counts, and the gradient magnitude range it spans.
+    The voxels are counted once, in finestNumBins2D intensity bins over the scalar range;
+    other bin counts and a (min, max) intensity window are derived from that (see
+    rebinHistogram), so moving the window does not touch the voxels again.
+    """
+    scalarRange = self.getScalarRange(volumeNode)
+    spacing = tuple(volumeNode.GetSpacing())
+    entry = self.getEntry(volumeNode)
+    histograms = entry['histograms2D']
+    finestKey = (self.finestNumBins2D, numGradientBins, scalarRange, spacing)
+    if finestKey not in histograms:
+      volume = self.logic.getVolumeArray(volumeNode.GetImageData())
+      # the gradient range only depends on the spacing, reuse it from the other histograms
+      gradientRanges = [gradientRange for otherKey, (bins, gradientRange) in histograms.items() if otherKey[3] == spacing]
+      gradientRange = gradientRanges[0] if gradientRanges else self.logic.estimateGradientRange(volume, spacing)
+      histograms[finestKey] = (self.logic.computeJointHistogram(volume, spacing, self.finestNumBins2D, numGradientBins,
+                                                                scalarRange, gradientRange), gradientRange)
+      self.evict()
+    finest, gradientRange = histograms[finestKey]
+    if window is not None and tuple(window) != scalarRange:
+      # windowed histograms change with every tick of the window, they are not kept
+      return self.rebinHistogram(finest, scalarRange, numBins, window), gradientRange
+    key = (numBins, numGradientBins, scalarRange, spacing)
+    if key not in histograms:
+      if self.finestNumBins2D % numBins == 0:
+        bins = finest.reshape(numBins, -1, numGradientBins).sum(axis=1)
+      else:
+        bins = self.rebinHistogram(finest, scalarRange, numBins, scalarRange)
+      histograms[key] = (bins, gradientRange)
+      self.evict()
+    return histograms[key]
+
+  def getPercentiles(self, volumeNode):
+    """Returns a table of numPercentiles values, entry i being the value below which
+    i / (numPercentiles - 1) of the voxels lie. Estimated by a QuantileSketch.
+    """
+    self.getScalarRange(volumeNode)
+    return self.getEntry(volumeNode)['percentiles']
+
+  def getPercentile(self, volumeNode, percent):
+    """Returns the value below which percent (0-100) of the voxels of volumeNode lie.
+    """
+    table = self.getPercentiles(volumeNode)
+    return float(numpy.interp(percent / 100.0, numpy.linspace(0, 1, table.shape[0]), table))
+
+# shared by all users of the statistics
+volumeStatisticsCache = VolumeStatisticsCache()
+
+#
+# PipelineInstrumentation
+#
+
+def getPeakMemory():
+  """Returns the peak resident memory of this process in bytes, None if unknown.
+  """
+  try:
+    if sys.platform == 'win32':
+      import ctypes
+      from ctypes import wintypes
+      class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+      counters = ProcessMemoryCounters()
+      counters.cb = ctypes.sizeof(counters)
+      process = ctypes.windll.kernel32.GetCurrentProcess()
+      if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+      return counters.PeakWorkingSetSize
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+  except (ImportError, AttributeError, OSError):
+    return None
+
+class PipelineStage(object):
+  """Context manager measuring one run of a pipeline stage, see PipelineInstrumentation.stage.
+  Set numberOfBytes inside the block if the amount of data is only known there.
+  """
+
+  def __init__(self, instrumentation, name, numberOfBytes=None):
+    self.instrumentation = instrumentation
+    self.name = name
+    self.numberOfBytes = numberOfBytes
+
+  def __enter__(self):
+    self.peakMemory = getPeakMemory()
+    self.startTime = time.time()
+    return self
+
+  def finish(self):
+    """Ends a stage begun with PipelineInstrumentation.start.
+    """
+    self.__exit__(None, None, None)
+
+  def __exit__(self, excType, excValue, traceback):
+    seconds = time.time() - self.startTime
+    peakMemory = getPeakMemory()
+    self.instrumentation.record({
+      'stage': self.name,
+      'seconds': seconds,
+      'bytes': self.numberOfBytes,
+      'peakMemory': peakMemory,
+      # how much the stage raised the peak memory of the process
+      'peakMemoryIncrease': peakMemory - self.peakMemory if peakMemory is not None and self.peakMemory is not None else None,
+      'failed': excType is not None,
+      'thread': threading.current_thread().name
+    })
+    return False
+
+class DisabledPipelineStage(object):
+  """What PipelineInstrumentation.stage returns while disabled: does nothing.
+  """
+  numberOfBytes = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    return False
+
+  def finish(self):
+    pass
+
+  def __setattr__(self, name, value):
+    pass
+
+class PipelineInstrumentation(object):
+  """Measures wall time, bytes moved and peak memory of the stages of the volume
+  rendering pipelines (statistics, transfer function updates, sends to ExposureRender):
+    with pipelineInstrumentation.stage('export volume', numberOfBytes=n):
+      ...
+  Each measurement is a dict (see PipelineStage) passed to every collector added with
+  addCollector, from the thread that ran the stage, and kept in a rolling history of
+  historySize runs per stage for summary. While disabled, stage returns a shared
+  object that does nothing. Stages that end in a later callback are measured with
+  start(name) and finish() on its result. Use the shared instance pipelineInstrumentation,
+  it is enabled from startup on if the environment variable VRE_INSTRUMENTATION is set,
+  so that module setup and first interactive time are measured too.
+  """
+
+  def __init__(self, historySize=20, enabled=False):
+    self.enabled = enabled
+    self.historySize = historySize
+    self.collectors = []
+    # stage name -> deque of the latest records, in first run order
+    self.history = OrderedDict()
+    self.lock = threading.Lock()
+    self.disabledStage = DisabledPipelineStage()
+
+  def stage(self, name, numberOfBytes=None):
+    if not self.enabled:
+      return self.disabledStage
+    return PipelineStage(self, name, numberOfBytes)
+
+  def start(self, name, numberOfBytes=None):
+    stage = self.stage(name, numberOfBytes)
+    stage.__enter__()
+    return stage
+
+  def addCollector(self, collector):
+    """collector(record) is called after every measured stage.
+    """
+    self.collectors.append(collector)
+
+  def removeCollector(self, collector):
+    if collector in self.collectors:
+      self.collectors.remove(collector)
+
+  def record(self, record):
+    with self.lock:
+      if record['stage'] not in self.history:
+        self.history[record['stage']] = deque(maxlen=self.historySize)
+      self.history[record['stage']].append(record)
+    for collector in list(self.collectors):
+      try:
+        collector(record)
+      except Exception as e:
+        logging.error('Pipeline instrumentation collector failed: %s' % e)
+
+  def clear(self):
+    with self.lock:
+      self.history.clear()
+
+  def summary(self):
+    """Returns per stage (in first run order) the number of kept runs, the last and mean
+    wall time, the bytes of the last run and the largest peak memory increase.
+    """
+    with self.lock:
+      history = [(name, list(records)) for name, records in self.history.items()]
+    summary = OrderedDict()
+    for name, records in history:
+      increases = [record['peakMemoryIncrease'] for record in records if record['peakMemoryIncrease'] is not None]
+      summary[name] = {
+        'runs': len(records),
+        'lastSeconds': records[-1]['seconds'],
+        'meanSeconds': sum(record['seconds'] for record in records) / len(records),
+        'lastBytes': records[-1]['bytes'],
+        'peakMemoryIncrease': max(increases) if increases else None
+      }
+    return summary
+
+  def formatSummary(self):
+    """Returns summary as one line of text per stage.
+    """
+    lines = []
+    for name, stage in self.summary().items():
+      line = '%s: %.3f s (mean %.3f s of %d)' % (name, stage['lastSeconds'], stage['meanSeconds'], stage['runs'])
+      if stage['lastBytes']:
+        line += ', %.1f MB' % (stage['lastBytes'] / 1e6)
+      if stage['peakMemoryIncrease']:
+        line += ', peak +%.1f MB' % (stage['peakMemoryIncrease'] / 1e6)
+      lines.append(line)
+    return '\n'.join(lines)
+
+# shared by both modules, so that one summary covers the whole pipeline
+pipelineInstrumentation = PipelineInstrumentation(enabled=bool(os.environ.get('VRE_INSTRUMENTATION')))
+
+#
+# TransferFunctionEditorPageBundle
+#
+
+class TransferFunctionEditorPageBundle(object):
+  """Inlines the style sheets and scripts a page references into one minified file, so that
+  the web view loads a single file instead of one per script. The bundle is written to the
+  Slicer temporary directory, never next to the page, and rebuilt when it is older than any
+  of its sources. Scripts named *.min.js are inlined unchanged.
+  """
+
+  styleSheetPattern = re.compile(r'<link rel="stylesheet" href="([^"]+)"\s*/?>')
+  scriptPattern = re.compile(r'<script(?: src="([^"]+)")?>(.*?)</script>', re.DOTALL)
+  commentPattern = re.compile(r'<!--.*?-->', re.DOTALL)
+  sourceMapPattern = re.compile(r'^//# sourceMappingURL=.*$', re.MULTILINE)
+  # a / after one of these characters or keywords starts a regular expression, otherwise it divides,
+  # as it does after a postfix ++ or --
+  regexPrecedingCharacters = set('(,=:[!&|?{};+-*%<>~^')
+  regexPrecedingKeywords = set(['return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw'])
+
+  def __init__(self, pageFilename, bundleFilename=None):
+    self.pageFilename = pageFilename
+    self.bundleFilename = bundleFilename or os.path.join(
+      slicer.app.temporaryPath, os.path.splitext(os.path.basename(pageFilename))[0] + '.min.html')
+
+  def getSources(self):
+    """Returns the page and the files it references, missing files included.
+    """
+    directory = os.path.dirname(self.pageFilename)
+    with open(self.pageFilename) as fp:
+      html = self.commentPattern.sub('', fp.read())
+    references = self.styleSheetPattern.findall(html) + [src for src, body in self.scriptPattern.findall(html) if src]
+    return [self.pageFilename] + [os.path.join(directory, reference) for reference in references]
+
+  def isStale(self, bundleFilename):
+    if not os.path.exists(bundleFilename):
+      return True
+    bundleTime = os.path.getmtime(bundleFilename)
+    return any(os.path.getmtime(source) > bundleTime for source in self.getSources())
+
+  def getPageFilename(self):
+    """Returns the file to load: an up to date bundle, the page itself if bundling failed.
+    """
+    try:
+      if self.isStale(self.bundleFilename):
+        self.build()
+      return self.bundleFilename
+    except (IOError, OSError) as e:
+      logging.warning('Bundling %s into %s failed: %s' % (self.pageFilename, self.bundleFilename, e))
+    return self.pageFilename
+
+  def build(self, bundleFilename=None):
+    """Writes the bundle, returns its size in bytes.
+    """
+    bundleFilename = bundleFilename or self.bundleFilename
+    directory = os.path.dirname(self.pageFilename)
+    def read(reference):
+      with open(os.path.join(directory, reference)) as fp:
+        return fp.read()
+    def inlineStyleSheet(match):
+      return '<style>%s</style>' % self.minifyStyleSheet(read(match.group(1)))
+    def inlineScript(match):
+      src, body = match.groups()
+      if src and src.endswith('.min.js'):
+        body = self.sourceMapPattern.sub('', read(src)).strip()
+      else:
+        body = self.minifyJavaScript(read(src) if src else body)
+      # the parser would end the element at the first </script in the code
+      return '<script>\n%s\n</script>' % body.replace('</script', '<\\/script')
+
+    with open(self.pageFilename) as fp:
+      html = self.commentPattern.sub('', fp.read())
+    html = '\n'.join(line.strip() for line in html.splitlines() if line.strip())
+    html = self.styleSheetPattern.sub(inlineStyleSheet, html)
+    html = self.scriptPattern.sub(inlineScript, html)
+    # written next to the bundle and renamed, so that a web view never loads half a file
+    temporaryFilename = bundleFilename + '.tmp'
+    with open(temporaryFilename, 'w') as fp:
+      fp.write(html)
+    if os.path.exists(bundleFilename):
+      os.remove(bundleFilename)
+    os.rename(temporaryFilename, bundleFilename)
+    return len(html)
+
+  @classmethod
+  def minifyJavaScript(cls, text):
+    """Drops comments, indentation, blank lines and repeated blanks. Line breaks stay where
+    they are, so that automatic semicolon insertion works as before.
+    """
+    output = []
+    length = len(text)
+    index = 0
+    last = '' # last character emitted that is not a blank
+    while index < length:
+      character = text[index]
+      following = text[index + 1] if index + 1 < length else ''
+      if character in '"\'`':
+        end = index + 1
+        while end < length and text[end] != character:
+          end += 2 if text[end] == '\\' else 1
+        output.append(text[index:end + 1])
+        index = end + 1
+        last = character
+      elif character == '/' and following == '/':
+        end = text.find('\n', index)
+        index = length if end < 0 else end
+      elif character == '/' and following == '*':
+        end = text.find('*/', index + 2)
+        end = length if end < 0 else end + 2
+        output.append('\n' if '\n' in text[index:end] else ' ')
+        index = end
+      elif character == '/' and cls.startsRegex(last, ''.join(output[-12:])):
+        end = index + 1
+        inClass = False
+        while end < length and (inClass or text[end] != '/') and text[end] != '\n':
+          if text[end] == '\\':
+            end += 1
+          elif text[end] == '[':
+            inClass = True
+          elif text[end] == ']':
+            inClass = False
+          end += 1
+        end += 1
+        while end < length and text[end].isalpha():
+          end += 1
+        output.append(text[index:end])
+        index = end
+        last = '/'
+      elif character in ' \t':
+        while index < length and text[index] in ' \t':
+          index += 1
+        output.append(' ')
+      else:
+        output.append(character)
+        index += 1
+        if not character.isspace():
+          last = character
+    lines = (line.strip() for line in ''.join(output).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+  @classmethod
+  def startsRegex(cls, last, preceding):
+    if preceding.rstrip().endswith(('++', '--')):
+      return False
+    if not last or last in cls.regexPrecedingCharacters:
+      return True
+    words = re.findall(r'[A-Za-z_$][\w$]*$', preceding.rstrip())
+    return bool(words) and words[0] in cls.regexPrecedingKeywords
+
+  @staticmethod
+  def minifyStyleSheet(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,])\s*', r'\1', text).strip()
+
+
 class TransferFunctionEditorTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -255,6 +1450,24 @@ class TransferFunctionEditorTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_TransferFunctionEditor1()
+    self.setUp()
+    self.test_TransferFunctionEditorHistogram()
+    self.setUp()
+    self.test_TransferFunctionEditorSync()
+    self.setUp()
+    self.test_TransferFunctionEditorCompositor()
+    self.setUp()
+    self.test_TransferFunctionEditorBatch()
+    self.setUp()
+    self.test_TransferFunctionEditorInstrumentation()
+    self.setUp()
+    self.test_TransferFunctionEditorHistogram2D()
+    self.setUp()
+    self.test_TransferFunctionEditorPageBundle()
+    self.setUp()
+    self.test_TransferFunctionEditorStatisticsCache()
+    self.setUp()
+    self.test_TransferFunctionEditorAutoWindow()
 
   def test_TransferFunctionEditor1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -291,3 +1504,343 @@ class TransferFunctionEditorTest(ScriptedLoadableModuleTest):
     logic = TransferFunctionEditorLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorHistogram(self):
+    """ Checks the chunked histogram against numpy.histogram on a synthetic volume.
+    """
+    self.delayDisplay("Starting the histogram test")
+    logic = TransferFunctionEditorLogic()
+    logic.histogramChunkSize = 1000 # force several chunks
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(32, 32, 32)
+    voxels = numpy.random.RandomState(0).randint(-1000, 3000, 32 * 32 * 32).astype(numpy.int16)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+
+    # the chunks are merged by this logic, computeHistogram reads through volumeStatisticsCache
+    scalarRange = logic.computeScalarRange(voxels)
+    self.assertEqual(scalarRange, (voxels.min(), voxels.max()))
+    bins = logic.computeHistogramBins(voxels, 64, scalarRange)
+    expected, edges = numpy.histogram(voxels, bins=64, range=scalarRange)
+    self.assertEqual(bins.sum(), voxels.size)
+    self.assertTrue(numpy.abs(bins - expected).max() <= 1)
+
+    histogram = logic.computeHistogram(volumeNode, numBins=64)
+    self.assertEqual(histogram['range']['min'], voxels.min())
+    self.assertEqual(histogram['range']['max'], voxels.max())
+    self.assertEqual(sum(histogram['bins']), voxels.size)
+    self.assertTrue(numpy.abs(numpy.array(histogram['bins']) - expected).max() <= 1)
+
+    preview = logic.computeHistogram(volumeNode, numBins=64, preview=True)
+    self.assertEqual(preview['numBins'], 64)
+
+    # NaN and infinite voxels of float volumes are left out
+    floatVoxels = voxels.astype(numpy.float32)
+    floatVoxels[::7] = numpy.nan
+    floatVoxels[1] = numpy.inf
+    floatVoxels[2] = -numpy.inf
+    finiteVoxels = floatVoxels[numpy.isfinite(floatVoxels)]
+    scalarRange = logic.computeScalarRange(floatVoxels)
+    self.assertEqual(scalarRange, (finiteVoxels.min(), finiteVoxels.max()))
+    bins = logic.computeHistogramBins(floatVoxels, 64, scalarRange)
+    expected, edges = numpy.histogram(finiteVoxels, bins=64, range=scalarRange)
+    self.assertTrue(numpy.abs(bins - expected).max() <= 1)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(floatVoxels))
+    histogram = logic.computeHistogram(volumeNode, numBins=64, scalarRange=scalarRange)
+    self.assertEqual(histogram['range']['min'], finiteVoxels.min())
+    self.assertEqual(histogram['range']['max'], finiteVoxels.max())
+    self.assertEqual(sum(histogram['bins']), finiteVoxels.size)
+    self.assertEqual(logic.computeScalarRange(numpy.full(10, numpy.nan)), (0.0, 0.0))
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorSync(self):
+    """ Checks that syncTransferFunction only touches the functions when the points change.
+    """
+    self.delayDisplay("Starting the sync test")
+    logic = TransferFunctionEditorLogic()
+    vp = slicer.vtkMRMLVolumePropertyNode()
+    slicer.mrmlScene.AddNode(vp)
+    vp.GetColor().AddRGBPoint(0, 0, 0, 0)
+    vp.GetColor().AddRGBPoint(255, 1, 1, 1)
+    vp.GetScalarOpacity().AddPoint(0, 0)
+    vp.GetScalarOpacity().AddPoint(255, 1)
+
+    points = [(0.25, 1.0, 0.0, 0.0, 0.5), (0.75, 0.0, 0.0, 1.0, 1.0)]
+    self.assertTrue(logic.syncTransferFunction(vp, points))
+    self.assertEqual(vp.GetColor().GetSize(), 4)
+    self.assertAlmostEqual(vp.GetScalarOpacity().GetValue(0.75 * 255), 1.0)
+
+    colorMTime = vp.GetColor().GetMTime()
+    self.assertFalse(logic.syncTransferFunction(vp, points))
+    self.assertEqual(vp.GetColor().GetMTime(), colorMTime)
+
+    # moving a point keeps the node count and updates it in place
+    points[0] = (0.5, 1.0, 0.0, 0.0, 0.5)
+    self.assertTrue(logic.syncTransferFunction(vp, points))
+    self.assertEqual(vp.GetColor().GetSize(), 4)
+    self.assertAlmostEqual(vp.GetScalarOpacity().GetValue(0.5 * 255), 0.5)
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorCompositor(self):
+    """ Checks the blending of two overlapping widgets.
+    """
+    self.delayDisplay("Starting the compositor test")
+    logic = TransferFunctionEditorLogic()
+    back = {'controlPoints': [{'value': 0.2, 'alpha': 0.5, 'color': '#ff0000'},
+                              {'value': 0.6, 'alpha': 0.5, 'color': '#ff0000'}]}
+    front = [(0.4, 0.0, 0.0, 1.0, 0.5), (0.8, 0.0, 0.0, 1.0, 0.5)]
+    tf = logic.compositeTFWidgets([back, front])
+
+    def sampleAt(x):
+      return tf[numpy.argmin(numpy.abs(tf[:, 0] - x))]
+
+    self.assertEqual(sampleAt(0.1)[4], 0)
+    numpy.testing.assert_allclose(sampleAt(0.2)[1:], [1, 0, 0, 0.5])
+    # front blue over back red, both at alpha 0.5
+    numpy.testing.assert_allclose(sampleAt(0.4)[1:], [1 / 3.0, 0, 2 / 3.0, 0.75])
+    numpy.testing.assert_allclose(sampleAt(0.8)[1:], [0, 0, 1, 0.5])
+    self.assertEqual(sampleAt(0.9)[4], 0)
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorBatch(self):
+    """ Applies one serialized transfer function to several volume properties.
+    """
+    self.delayDisplay("Starting the batch test")
+    logic = TransferFunctionEditorLogic()
+    tf = json.dumps({'widgets': [{'controlPoints': [{'value': 0.25, 'alpha': 0.0, 'color': '#000000'},
+                                                    {'value': 0.75, 'alpha': 1.0, 'color': '#ffffff'}]}]})
+    volumePropertyNodes = []
+    for index in range(3):
+      vp = slicer.vtkMRMLVolumePropertyNode()
+      slicer.mrmlScene.AddNode(vp)
+      volumePropertyNodes.append(vp)
+
+    self.assertEqual(logic.applyTransferFunction(volumePropertyNodes, tf, intensityRange=(0, 1000)), 3)
+    self.assertEqual(logic.applyTransferFunction(volumePropertyNodes, tf, intensityRange=(0, 1000)), 0)
+    for vp in volumePropertyNodes:
+      self.assertAlmostEqual(vp.GetScalarOpacity().GetValue(750), 1.0)
+      self.assertAlmostEqual(vp.GetScalarOpacity().GetValue(500), 0.5)
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorInstrumentation(self):
+    """ Measures stages only while enabled and keeps a rolling history per stage.
+    """
+    self.delayDisplay("Starting the instrumentation test")
+    instrumentation = PipelineInstrumentation(historySize=3)
+    records = []
+    instrumentation.addCollector(records.append)
+    with instrumentation.stage('disabled') as stage:
+      stage.numberOfBytes = 10
+    self.assertEqual(records, [])
+
+    instrumentation.enabled = True
+    for run in range(5):
+      with instrumentation.stage('allocate', numberOfBytes=1000):
+        numpy.ones(1000, dtype=numpy.uint8)
+    with instrumentation.stage('measured later') as stage:
+      stage.numberOfBytes = 42
+    self.assertEqual(len(records), 6)
+    self.assertEqual(records[-1]['bytes'], 42)
+    self.assertGreaterEqual(records[0]['seconds'], 0)
+
+    summary = instrumentation.summary()
+    self.assertEqual(list(summary.keys()), ['allocate', 'measured later'])
+    self.assertEqual(summary['allocate']['runs'], 3)
+    self.assertIn('allocate', instrumentation.formatSummary())
+
+    # failing stages are measured too and the error passes through
+    with self.assertRaises(ValueError):
+      with instrumentation.stage('failing'):
+        raise ValueError()
+    self.assertTrue(records[-1]['failed'])
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorHistogram2D(self):
+    """ Checks the slab by slab, multi-threaded joint histogram of intensity and gradient
+    magnitude against one numpy.gradient over the whole volume.
+    """
+    self.delayDisplay("Starting the 2D histogram test")
+    logic = TransferFunctionEditorLogic()
+    logic.gradientSlabVoxels = 1000 # force slabs of the minimum thickness
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(24, 20, 18)
+    voxels = numpy.random.RandomState(0).randint(0, 1000, 24 * 20 * 18).astype(numpy.int16)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels))
+    volume = voxels.reshape(18, 20, 24)
+    spacing = (0.5, 1.0, 2.0)
+
+    gradients = numpy.gradient(volume.astype(numpy.float32), spacing[2], spacing[1], spacing[0])
+    magnitude = numpy.sqrt(sum(gradient * gradient for gradient in gradients))
+    self.assertEqual(logic.getSlabs(volume), [(0, 8), (8, 16), (16, 18)])
+    for start, stop in logic.getSlabs(volume):
+      self.assertTrue(numpy.allclose(logic.computeGradientMagnitude(volume, spacing, start, stop), magnitude[start:stop], atol=1e-3))
+
+    gradientRange = logic.estimateGradientRange(volume, spacing)
+    bins = logic.computeJointHistogram(volume, spacing, 16, 8, (0, 999), gradientRange, numberOfThreads=3)
+    self.assertEqual(bins.shape, (16, 8))
+    self.assertEqual(bins.sum(), voxels.size)
+    self.assertEqual(bins.sum(axis=1).tolist(), logic.computeHistogramBins(voxels, 16, (0, 999)).tolist())
+    gradientIndices = numpy.clip(magnitude * 8 / gradientRange[1], 0, 7).astype(int)
+    expected = numpy.bincount(gradientIndices.ravel(), minlength=8)
+    self.assertTrue(numpy.abs(bins.sum(axis=0) - expected).max() <= 2)
+
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.SetSpacing(*spacing)
+    histogram2D = logic.computeHistogram2D(volumeNode, numBins=16, numGradientBins=8)
+    self.assertEqual(len(base64.b64decode(histogram2D['densities'])), 16 * 8)
+    self.assertEqual(histogram2D['gradientRange']['max'], gradientRange[1])
+    cached = volumeStatisticsCache.getHistogram2D(volumeNode, 16, 8)[0]
+    self.assertIs(volumeStatisticsCache.getHistogram2D(volumeNode, 16, 8)[0], cached)
+    self.assertEqual(cached.tolist(), bins.tolist())
+
+    # moving the intensity window re-bins the cached counts instead of visiting the voxels again
+    def failingJointHistogram(*args, **kwargs):
+      raise AssertionError('joint histogram recomputed')
+    volumeStatisticsCache.logic.computeJointHistogram = failingJointHistogram
+    try:
+      for window in ((200, 800), (250.5, 760.25)):
+        windowed, windowGradientRange = volumeStatisticsCache.getHistogram2D(volumeNode, 16, 8, window)
+        self.assertEqual(windowed.shape, (16, 8))
+        self.assertEqual(windowGradientRange, gradientRange)
+        self.assertEqual(windowed.sum(), voxels.size)
+        expected = logic.computeJointHistogram(volume, spacing, 16, 8, window, gradientRange)
+        # the values are assumed to be spread evenly within a finest bin, which is about one intensity wide
+        self.assertTrue(numpy.abs(windowed - expected).max() <= 2 * voxels.size / 1000.0)
+    finally:
+      del volumeStatisticsCache.logic.computeJointHistogram
+    volumeStatisticsCache.invalidate(volumeNode)
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorPageBundle(self):
+    """ Bundles the editor page into one minified file and rebuilds it when a source changes.
+    """
+    self.delayDisplay("Starting the page bundle test")
+    minify = TransferFunctionEditorPageBundle.minifyJavaScript
+    self.assertEqual(minify("var a = 1; // one\n\n    /* two\n */  var b = '//' + \"/*\";\n"),
+                     "var a = 1;\nvar b = '//' + \"/*\";")
+    self.assertEqual(minify("x = a / b / c;\ny = s.replace( /\\/\\/[^/]*/g, '' );"),
+                     "x = a / b / c;\ny = s.replace( /\\/\\/[^/]*/g, '' );")
+    self.assertEqual(minify("return /[/]x/.test( s )"), "return /[/]x/.test( s )")
+    # a / after postfix ++ or -- divides
+    self.assertEqual(minify("a = i++ / 2 + j; // don't\nb = k-- /2; /* it's */\nc = [ 1, -/x/.exec( s ).length ];"),
+                     "a = i++ / 2 + j;\nb = k-- /2;\nc = [ 1, -/x/.exec( s ).length ];")
+
+    pageFilename = os.path.abspath( os.path.join( os.path.dirname( __file__ ), "Resources/web/TF.html" ) )
+    bundleFilename = os.path.join(slicer.app.temporaryPath, 'TransferFunctionEditorTest.min.html')
+    if os.path.exists(bundleFilename):
+      os.remove(bundleFilename)
+    self.assertEqual(os.path.dirname(TransferFunctionEditorPageBundle(pageFilename).bundleFilename), slicer.app.temporaryPath)
+    bundle = TransferFunctionEditorPageBundle(pageFilename, bundleFilename)
+    sources = bundle.getSources()
+    self.assertEqual([os.path.basename(source) for source in sources],
+                     ['TF.html', 'ui.css', 'es5-shim.min.js', 'es6-shim.min.js', 'ui.js', 'CP_widget.js', 'TF_panel.js'])
+    self.assertTrue(bundle.isStale(bundleFilename))
+    size = bundle.build()
+    self.assertFalse(bundle.isStale(bundleFilename))
+    self.assertEqual(bundle.getPageFilename(), bundleFilename)
+    self.assertLess(size, sum(os.path.getsize(source) for source in sources))
+    with open(bundleFilename) as fp:
+      html = fp.read()
+    self.assertNotIn(' src=', html)
+    self.assertNotIn('stylesheet', html)
+    self.assertIn('TF_panel.prototype.setHistogram2D', html)
+    self.assertEqual(html.count('<script>'), 6)
+
+    # a bundle older than one of its sources is rebuilt
+    modified = max(os.path.getmtime(source) for source in sources) - 10
+    os.utime(bundleFilename, (modified, modified))
+    self.assertTrue(bundle.isStale(bundleFilename))
+    self.assertEqual(bundle.getPageFilename(), bundleFilename)
+    self.assertFalse(bundle.isStale(bundleFilename))
+    os.remove(bundleFilename)
+
+    # stages ending in a later callback
+    instrumentation = PipelineInstrumentation(enabled=True)
+    stage = instrumentation.start('first interactive')
+    stage.finish()
+    self.assertEqual(list(instrumentation.summary().keys()), ['first interactive'])
+    PipelineInstrumentation().start('disabled').finish()
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorStatisticsCache(self):
+    """ Recomputes the statistics of modified image data and evicts the least recently used volume.
+    """
+    self.delayDisplay("Starting the statistics cache test")
+    cache = VolumeStatisticsCache()
+    volumeNodes = []
+    for index in range(3):
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(16, 16, 16)
+      voxels = numpy.arange(16 * 16 * 16, dtype=numpy.int16) % (100 * (index + 1))
+      imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels, deep=1))
+      volumeNode = slicer.vtkMRMLScalarVolumeNode()
+      volumeNode.SetAndObserveImageData(imageData)
+      slicer.mrmlScene.AddNode(volumeNode)
+      volumeNodes.append(volumeNode)
+    first, second, third = volumeNodes
+
+    histogram = cache.getHistogram(first, 64)
+    self.assertIs(cache.getHistogram(first, 64), histogram)
+    self.assertEqual(cache.getScalarRange(first), (0.0, 99.0))
+
+    # writing into the image data and marking it modified drops the cached statistics
+    imageData = first.GetImageData()
+    numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[0] = 500
+    imageData.Modified()
+    self.assertEqual(cache.getScalarRange(first), (0.0, 500.0))
+    self.assertIsNot(cache.getHistogram(first, 64), histogram)
+
+    # room for the statistics of two volumes, the least recently used one goes
+    cache.invalidate()
+    cache.getScalarRange(first)
+    entrySize = cache.entrySize(cache.getEntry(first))
+    cache.memoryBudget = 2 * entrySize
+    cache.getScalarRange(second)
+    cache.getScalarRange(first) # first is now used more recently than second
+    cache.getScalarRange(third)
+    self.assertEqual(len(cache.entries), 2)
+    self.assertEqual(sum(cache.entrySize(entry) for entry in cache.entries.values()), 2 * entrySize)
+    self.assertEqual(list(cache.entries.keys()), [node.GetID() or id(node) for node in (first, third)])
+    self.delayDisplay('Test passed!')
+
+  def test_TransferFunctionEditorAutoWindow(self):
+    """ Compares the sketched percentiles and the windowed histogram with NumPy on a skewed volume.
+    """
+    self.delayDisplay("Starting the auto window test")
+    logic = TransferFunctionEditorLogic()
+    # mostly dark voxels with a long tail of bright outliers
+    voxels = numpy.random.RandomState(1).lognormal(3.0, 1.0, 64 * 64 * 64).astype(numpy.float32)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(64, 64, 64)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels, deep=1))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+
+    sketch = QuantileSketch()
+    sketch.update(voxels[::sketch.sampleStep], sketch.sampleStep)
+    percents = [1.0, 5.0, 50.0, 95.0, 99.0]
+    expected = numpy.percentile(voxels, percents)
+    sketched = sketch.quantiles(numpy.array(percents) / 100.0)
+    # within half a percentile of the exact value
+    for percent, value in zip(percents, sketched):
+      self.assertTrue(numpy.percentile(voxels, percent - 0.5) <= value <= numpy.percentile(voxels, percent + 0.5))
+
+    window = logic.computeAutoWindow(volumeNode, 1.0, 99.0)
+    self.assertAlmostEqual(window[0] / expected[0], 1.0, delta=0.05)
+    self.assertAlmostEqual(window[1] / expected[4], 1.0, delta=0.05)
+    self.assertEqual(logic.getIntensityRange(volumeNode, (1.0, 99.0)), window)
+    self.assertEqual(logic.getIntensityRange(volumeNode), (float(voxels.min()), float(voxels.max())))
+    self.assertEqual(logic.getIntensityRange(None), None)
+
+    # the windowed histogram is re-binned from the cached one, outliers land in the outer bins
+    histogram = logic.computeHistogram(volumeNode, numBins=32, scalarRange=window)
+    exact, edges = numpy.histogram(numpy.clip(voxels, window[0], window[1]), bins=32, range=window)
+    self.assertEqual(histogram['range'], {'min': window[0], 'max': window[1]})
+    self.assertAlmostEqual(sum(histogram['bins']), voxels.size, delta=32)
+    self.assertTrue(numpy.abs(numpy.array(histogram['bins']) - exact).max() < 0.02 * exact.max())
+    volumeStatisticsCache.invalidate(volumeNode)
+    self.delayDisplay('Test passed!')